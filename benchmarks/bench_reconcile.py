@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Benchmark `update` and `status` against fake vendor backends.
+
+Usage:
+    python benchmarks/bench_reconcile.py [--sizes 10 1000 50000] [--latency 0.0] [--drift 0.01] [--workers 1]
+                                         [--async] [--json]
+
+Every size seeds one domain per vendor with that many records, writes a config managing all of them with
+a `drift` fraction of values changed, then runs update followed by status.
+Each run reports wall time, cpu time, peak traced memory and api calls by vendor and operation.
+"""
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import functools
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from dnsmanager import dns_cli, plugins  # noqa: E402
+from fake_ops import FakeBackend, FAKE_OPS  # noqa: E402
+
+VENDORS = ('aliyun', 'cloudflare', 'namecheap')
+
+
+def _value(i: int, changed: bool) -> str:
+    return '10.{}.{}.{}'.format(i // 65536 % 256, i // 256 % 256, i % 256) if not changed \
+        else '172.16.{}.{}'.format(i // 256 % 256, i % 256)
+
+
+def seed_backend(backend: FakeBackend, size: int):
+    for vendor in VENDORS:
+        records = [{'id': 'seed-{}'.format(i), 'name': 'host{}'.format(i), 'type': 'A', 'value': _value(i, False),
+                    'ttl': 600} for i in range(size)]
+        if vendor == 'cloudflare':
+            for record in records:
+                record['proxied'] = False
+        backend.seed(vendor, _domain(vendor), records)
+
+
+def _domain(vendor: str) -> str:
+    return 'bench-{}.com'.format(vendor)
+
+
+def write_config(path: str, size: int, drift: float):
+    changed_every = int(1 / drift) if drift else 0
+    dns = []
+    for vendor in VENDORS:
+        records = [{'rr': 'host{}'.format(i), 'type': 'A', 'ttl': 600,
+                    'value': _value(i, bool(changed_every) and i % changed_every == 0)}
+                   for i in range(size)]
+        dns.append({'domain': _domain(vendor), 'vendor': vendor, 'records': records})
+    conf = {'clients': {vendor: {'fake': True} for vendor in VENDORS}, 'dns': dns}
+    with open(path, 'w') as fp:
+        yaml.safe_dump(conf, fp)
+
+
+def install_fake_clients(backend: FakeBackend):
+    for vendor in VENDORS:
+        factory = functools.partial(lambda conf, ops_class: ops_class(backend), ops_class=FAKE_OPS[vendor])
+        plugins.register_vendor(plugins.VendorPlugin(vendor, factory, plugins.get_vendor(vendor).record_parser))
+
+
+def measure(fn, trace_memory: bool) -> dict:
+    if trace_memory:
+        tracemalloc.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        fn()
+    result = {'wall': time.perf_counter() - wall, 'cpu': time.process_time() - cpu}
+    if trace_memory:
+        result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def run_size(size: int, latency: float, drift: float, workers: int, use_async: bool, workdir: str) -> list:
+    cfg_path = os.path.join(workdir, 'bench-{}.yml'.format(size))
+    write_config(cfg_path, size, drift)
+
+    results = []
+    for trace_memory in (False, True):
+        backend = FakeBackend(latency=latency)
+        seed_backend(backend, size)
+        install_fake_clients(backend)
+        operations = (
+            ('update', lambda: dns_cli.load_and_update_dns_config(cfg_path, workers=workers, use_async=use_async)),
+            ('status', lambda: dns_cli.show_online_config(cfg_path, workers=workers, use_async=use_async)),
+        )
+        for index, (name, fn) in enumerate(operations):
+            backend.calls.clear()
+            stats = measure(fn, trace_memory)
+            if trace_memory:
+                results[index]['peak_memory'] = stats['peak_memory']
+                continue
+            stats.update({
+                'size': size,
+                'operation': name,
+                'api_calls': {'{}.{}'.format(vendor, op): n for (vendor, op), n in sorted(backend.calls.items())},
+            })
+            results.append(stats)
+    return results
+
+
+def print_report(results: list):
+    print('{:>8} {:>8} {:>10} {:>10} {:>12}  {}'.format('size', 'op', 'wall(s)', 'cpu(s)', 'peak(MiB)', 'api calls'))
+    for r in results:
+        calls = ' '.join('{}={}'.format(k, v) for k, v in r['api_calls'].items())
+        print('{:>8} {:>8} {:>10.3f} {:>10.3f} {:>12.1f}  {}'.format(
+            r['size'], r['operation'], r['wall'], r['cpu'], r['peak_memory'] / 1024.0 / 1024.0, calls))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark dns-manager against fake vendor backends')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 50000])
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds each fake api call takes')
+    parser.add_argument('--drift', type=float, default=0.01, help='fraction of config values changed')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--async', dest='use_async', action='store_true', help='use the asyncio driver')
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.environ['DNS_MANAGER_CACHE_DIR'] = os.path.join(workdir, 'cache')
+        results = []
+        for size in args.sizes:
+            results += run_size(size, args.latency, args.drift, args.workers, args.use_async, workdir)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+
+
+if __name__ == '__main__':
+    main()
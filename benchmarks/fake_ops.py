@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+In-process stand-ins for the vendor ops classes, backed by in-memory zones with configurable latency
+"""
+
+import itertools
+import math
+import threading
+import time
+from collections import Counter
+
+from dnsmanager.model import DnsRecord, AliyunDnsRecord, CloudflareDnsRecord, NamecheapDnsRecord, ACTION_ADD, \
+    ACTION_UPDATE, ACTION_DELETE
+
+
+class FakeBackend:
+    """
+    Zones of every fake vendor, counts api calls by vendor and operation
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.zones = {}
+        self.calls = Counter()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def call(self, vendor: str, op: str, count: int = 1):
+        with self._lock:
+            self.calls[(vendor, op)] += count
+        if self.latency:
+            time.sleep(self.latency * count)
+
+    def next_id(self) -> str:
+        with self._lock:
+            return str(next(self._ids))
+
+    def seed(self, vendor: str, domain: str, records):
+        self.zones[(vendor, domain)] = {r['id']: r for r in records}
+
+
+class FakeDnsOps:
+    vendor = 'fake'
+    record_class = DnsRecord
+    page_size = None
+
+    def __init__(self, backend: FakeBackend):
+        self.backend = backend
+
+    def _zone(self, domain: str) -> dict:
+        return self.backend.zones.setdefault((self.vendor, domain), {})
+
+    def get_domain_records(self, domain: str, *args, **kwargs):
+        zone = self._zone(domain)
+        pages = max(1, math.ceil(len(zone) / self.page_size)) if self.page_size else 1
+        self.backend.call(self.vendor, 'list', pages)
+        return [self.record_class(**r) for r in list(zone.values())]
+
+    @staticmethod
+    def record_id_from_response(response: dict):
+        return response.get('id')
+
+    def _to_dict(self, record, record_id: str) -> dict:
+        data = record.to_dict()
+        data.pop('kind')
+        data['id'] = record_id
+        return data
+
+    def add_domain_record(self, domain: str, record):
+        self.backend.call(self.vendor, 'add')
+        record_id = self.backend.next_id()
+        self._zone(domain)[record_id] = self._to_dict(record, record_id)
+        return {'id': record_id}
+
+    def update_domain_record(self, domain: str, record):
+        self.backend.call(self.vendor, 'update')
+        self._zone(domain)[record.id] = self._to_dict(record, record.id)
+        return {'id': record.id}
+
+    def delete_domain_record(self, domain: str, record):
+        self.backend.call(self.vendor, 'delete')
+        self._zone(domain).pop(record.id, None)
+        return {'id': record.id}
+
+
+class FakeAliyunDnsOps(FakeDnsOps):
+    vendor = 'aliyun'
+    record_class = AliyunDnsRecord
+    page_size = 500
+
+
+class FakeCloudflareDnsOps(FakeDnsOps):
+    vendor = 'cloudflare'
+    record_class = CloudflareDnsRecord
+    page_size = 1000
+
+    def prefetch_zone_ids(self, domains):
+        self.backend.call(self.vendor, 'list_zones')
+
+
+class FakeNamecheapDnsOps(FakeDnsOps):
+    vendor = 'namecheap'
+    record_class = NamecheapDnsRecord
+
+    def __init__(self, backend: FakeBackend, batch: bool = False):
+        super(FakeNamecheapDnsOps, self).__init__(backend)
+        self.batch = batch
+
+    def apply_changeset(self, domain: str, changeset):
+        self.backend.call(self.vendor, 'list')
+        self.backend.call(self.vendor, 'set_hosts')
+        zone = self._zone(domain)
+        for change in changeset:
+            if change.action != ACTION_ADD:
+                zone.pop((change.old if change.action == ACTION_UPDATE else change.record).id, None)
+            if change.action != ACTION_DELETE:
+                record_id = self.backend.next_id()
+                zone[record_id] = self._to_dict(change.record, record_id)
+        return {'IsSuccess': True}
+
+
+FAKE_OPS = {
+    'aliyun': FakeAliyunDnsOps,
+    'cloudflare': FakeCloudflareDnsOps,
+    'namecheap': FakeNamecheapDnsOps,
+}
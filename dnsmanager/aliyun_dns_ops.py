@@ -1,53 +1,119 @@
 #!/usr/bin/env python
 # coding=utf-8
 
+import functools
 import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from aliyunsdkcore import client
-from typing import List
+from aliyunsdkcore.acs_exception.exceptions import ServerException
+from typing import Iterator, List
 from aliyunsdkalidns.request.v20150109.DescribeDomainRecordsRequest import DescribeDomainRecordsRequest
+from aliyunsdkalidns.request.v20150109.DescribeSubDomainRecordsRequest import DescribeSubDomainRecordsRequest
 from aliyunsdkalidns.request.v20150109.UpdateDomainRecordRequest import UpdateDomainRecordRequest
 from aliyunsdkalidns.request.v20150109.AddDomainRecordRequest import AddDomainRecordRequest
 from aliyunsdkalidns.request.v20150109.DescribeDomainRecordInfoRequest import DescribeDomainRecordInfoRequest
 from aliyunsdkalidns.request.v20150109.DeleteDomainRecordRequest import DeleteDomainRecordRequest
-from dnsmanager.model import DnsRecord
+from dnsmanager.model import AliyunDnsRecord, DnsRecord, CFG_KEY_CLIENT_MAX_IN_FLIGHT, DEFAULT_MAX_IN_FLIGHT
+from dnsmanager.scheduler import RequestScheduler, build_request_scheduler
+
+# https://help.aliyun.com/document_detail/29776.html
+MAX_PAGE_SIZE = 500
+DEFAULT_PAGE_WORKERS = 4
 
 
 class AliyunDnsOps:
-    def __init__(self, access_key_id, access_key_secret, region_id: str = 'cn-hangzhou'):
-        self.clt = client.AcsClient(access_key_id, access_key_secret, region_id=region_id)
-
-    def get_domain_records(self, domain, rr, record_type) -> List[DnsRecord]:
-        page_no = 1
-        result = []
-        while True:
-            res = self._get_domain_records_by_page(domain, rr, record_type, page_no)
-            result += res.get('DomainRecords').get('Record')
-            if self.no_more(res):
-                break
-            page_no = page_no + 1
-        return [self._convert_to_dns_record(record) for record in result]
+    LIST_PAGE_SIZE = MAX_PAGE_SIZE
+    def __init__(self, access_key_id, access_key_secret, region_id: str = 'cn-hangzhou',
+                 page_workers: int = DEFAULT_PAGE_WORKERS, scheduler: RequestScheduler = None,
+                 pool_size: int = DEFAULT_MAX_IN_FLIGHT):
+        # the client keeps a pooled keep-alive session, sized for the calls it may have in flight
+        self.clt = client.AcsClient(access_key_id, access_key_secret, region_id=region_id,
+                                    pool_size=max(pool_size, page_workers))
+        self.page_workers = page_workers
+        self.scheduler = scheduler or RequestScheduler(is_throttle_error=self.is_throttle_error)
+
+    # https://help.aliyun.com/document_detail/29807.html
+    @staticmethod
+    def is_throttle_error(e: Exception) -> bool:
+        if not isinstance(e, ServerException):
+            return False
+        return e.get_http_status() == 429 or (e.get_error_code() or '').startswith('Throttling')
+
+    def _do_action(self, request) -> dict:
+        return json.loads(self.scheduler.call(self.clt.do_action_with_exception, request))
+
+    def get_domain_records(self, domain, rr=None, record_type=None) -> List[AliyunDnsRecord]:
+        return list(self.iter_domain_records(domain, rr, record_type))
+
+    # https://help.aliyun.com/document_detail/29778.html
+    def get_records_by_name(self, domain, name: str) -> List[AliyunDnsRecord]:
+        # SubDomain matches the full name exactly, unlike RRKeyWord that matches every name containing the rr
+        sub_domain = domain if name == '@' else '{}.{}'.format(name, domain)
+        return list(self._iter_pages(functools.partial(self._get_sub_domain_records_by_page, domain, sub_domain)))
+
+    def iter_domain_records(self, domain, rr=None, record_type=None) -> Iterator[AliyunDnsRecord]:
+        """
+        Stream the records of a domain. Once the first page tells the total count,
+        the remaining pages are fetched concurrently, at most page_workers of them at a time.
+        """
+        return self._iter_pages(functools.partial(self._get_domain_records_by_page, domain, rr, record_type))
+
+    def _iter_pages(self, get_page) -> Iterator[AliyunDnsRecord]:
+        res = get_page(1)
+        for record in res.get('DomainRecords').get('Record'):
+            yield self._convert_to_dns_record(record)
+        if self.no_more(res):
+            return
+
+        page_size = res.get('PageSize')
+        page_count = (res.get('TotalCount') + page_size - 1) // page_size
+        page_numbers = iter(range(2, page_count + 1))
+        workers = max(1, min(self.page_workers, page_count - 1))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            for page_no in page_numbers:
+                pending.append(pool.submit(get_page, page_no))
+                if len(pending) == workers:
+                    break
+            while pending:
+                res = pending.popleft().result()
+                page_no = next(page_numbers, None)
+                if page_no is not None:
+                    pending.append(pool.submit(get_page, page_no))
+                for record in res.get('DomainRecords').get('Record'):
+                    yield self._convert_to_dns_record(record)
 
     @staticmethod
-    def _convert_to_dns_record(dict_record) -> DnsRecord:
-        record = DnsRecord()
-        record.id = dict_record['RecordId']
-        record.name = dict_record['RR']
-        record.type = dict_record['Type']
-        record.value = dict_record['Value']
-        record.ttl = dict_record['TTL']
-        return record
+    def _convert_to_dns_record(dict_record) -> AliyunDnsRecord:
+        # Priority is only set on MX records, it is kept for the export and not reconciled
+        return AliyunDnsRecord(id=dict_record['RecordId'],
+                               name=dict_record['RR'],
+                               type=dict_record['Type'],
+                               value=dict_record['Value'],
+                               ttl=dict_record['TTL'],
+                               priority=dict_record.get('Priority') if dict_record['Type'] == 'MX' else None)
 
     def _get_domain_records_by_page(self, domain, rr, record_type, page_no):
         desc_domain_req = DescribeDomainRecordsRequest()
         desc_domain_req.set_DomainName(domain)
         desc_domain_req.set_accept_format('JSON')
         desc_domain_req.set_PageNumber(page_no)
+        desc_domain_req.set_PageSize(MAX_PAGE_SIZE)
         if rr is not None:
             desc_domain_req.set_RRKeyWord(rr)
         if record_type is not None:
             desc_domain_req.set_TypeKeyWord(record_type)
-        desc_domain_res = self.clt.do_action_with_exception(desc_domain_req)
-        return json.loads(desc_domain_res)
+        return self._do_action(desc_domain_req)
+
+    def _get_sub_domain_records_by_page(self, domain, sub_domain, page_no):
+        desc_sub_domain_req = DescribeSubDomainRecordsRequest()
+        desc_sub_domain_req.set_DomainName(domain)
+        desc_sub_domain_req.set_SubDomain(sub_domain)
+        desc_sub_domain_req.set_accept_format('JSON')
+        desc_sub_domain_req.set_PageNumber(page_no)
+        desc_sub_domain_req.set_PageSize(MAX_PAGE_SIZE)
+        return self._do_action(desc_sub_domain_req)
 
     @staticmethod
     def no_more(desc_domain_res):
@@ -61,7 +127,11 @@ class AliyunDnsOps:
         desc_record_req = DescribeDomainRecordInfoRequest()
         desc_record_req.set_RecordId(record_id)
         desc_record_req.set_accept_format('JSON')
-        return json.loads(self.clt.do_action_with_exception(desc_record_req))
+        return self._do_action(desc_record_req)
+
+    @staticmethod
+    def record_id_from_response(response: dict):
+        return response.get('RecordId')
 
     # https://help.aliyun.com/document_detail/29774.html
     def update_domain_record(self, domain: str, record: DnsRecord):
@@ -71,7 +141,7 @@ class AliyunDnsOps:
         request.set_Type(record.type)
         request.set_Value(record.value)
         request.set_accept_format('JSON')
-        return json.loads(self.clt.do_action_with_exception(request))
+        return self._do_action(request)
 
     def add_domain_record(self, domain, record: DnsRecord):
         request = AddDomainRecordRequest()
@@ -82,17 +152,20 @@ class AliyunDnsOps:
         request.set_Value(record.value)
         request.set_DomainName(domain)
         request.set_accept_format('JSON')
-        return json.loads(self.clt.do_action_with_exception(request))
+        return self._do_action(request)
 
     def delete_domain_record(self, domain, record: DnsRecord):
         request = DeleteDomainRecordRequest()
         request.set_DomainName(domain)
         request.set_RecordId(record.id)
         request.set_accept_format('JSON')
-        return json.loads(self.clt.do_action_with_exception(request))
+        return self._do_action(request)
 
 
 def build_aliyun_dns_client_from_config(config: dict) -> AliyunDnsOps:
     key_id = config.get('id')
     key_secret = config.get('secret')
-    return AliyunDnsOps(key_id, key_secret)
+    page_workers = config.get('page_workers', DEFAULT_PAGE_WORKERS)
+    scheduler = build_request_scheduler(config, AliyunDnsOps.is_throttle_error)
+    pool_size = config.get(CFG_KEY_CLIENT_MAX_IN_FLIGHT) or DEFAULT_MAX_IN_FLIGHT
+    return AliyunDnsOps(key_id, key_secret, page_workers=page_workers, scheduler=scheduler, pool_size=pool_size)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from dnsmanager.metrics import INSTRUMENTED_METHODS
+from dnsmanager.model import DEFAULT_MAX_IN_FLIGHT
+
+
+class AsyncDnsOps:
+    """
+    Awaitable facade of a vendor ops object. The vendor sdks are blocking, so every vendor call runs on a
+    thread pool of the account, sized by its max_in_flight. Those threads share the pooled keep-alive
+    http session of the ops object, which the builders size to the same limit.
+    """
+
+    def __init__(self, ops, max_in_flight: int = None):
+        self._ops = ops
+        self.max_in_flight = max_in_flight or DEFAULT_MAX_IN_FLIGHT
+        self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix='dns-ops')
+
+    def __getattr__(self, name):
+        attr = getattr(self._ops, name)
+        if name not in INSTRUMENTED_METHODS:
+            return attr
+
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(attr, *args, **kwargs))
+
+        return call
+
+    def close(self):
+        self._executor.shutdown(wait=True)
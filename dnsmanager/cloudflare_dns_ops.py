@@ -1,18 +1,123 @@
 #!/usr/bin/env python
 # coding=utf-8
 
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import CloudFlare
-from dnsmanager.model import CloudflareDnsRecord, DnsManipulationException
-from dnsmanager.utils import remove_suffix
-from typing import List
+import requests
+from CloudFlare.exceptions import CloudFlareAPIError
+from requests.adapters import HTTPAdapter
+from dnsmanager.model import CloudflareDnsRecord, ChangeSet, DnsManipulationException, CFG_KEY_CLIENT_MAX_IN_FLIGHT, \
+    DEFAULT_MAX_IN_FLIGHT, ACTION_ADD, ACTION_UPDATE
+from dnsmanager.scheduler import RequestScheduler, build_request_scheduler, parse_retry_after, \
+    retry_after_from_exception
+from dnsmanager.utils import remove_suffix, default_cache_dir, read_json, write_json_atomic
+from typing import Dict, Iterable, Iterator, List, Optional
+
+DEFAULT_ZONE_CACHE_TTL = 24 * 3600
+# https://api.cloudflare.com/#zone-list-zones
+ZONES_PER_PAGE = 50
+# https://api.cloudflare.com/#dns-records-for-a-zone-list-dns-records
+RECORDS_PER_PAGE = 1000
+# https://developers.cloudflare.com/fundamentals/api/reference/limits/
+THROTTLE_ERROR_CODES = (429, 971, 10429)
+# https://developers.cloudflare.com/dns/manage-dns-records/how-to/batch-record-changes/ , 200 on the free plan
+DEFAULT_BATCH_SIZE = 200
+
+
+class ZoneIdCache:
+    """
+    Zone name to zone id mapping, optionally persisted to a json file whose entries expire after ttl seconds
+    """
+
+    def __init__(self, path: str = None, ttl: int = DEFAULT_ZONE_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._zones = {}  # type: Dict[str, list]
+        if path is not None:
+            self._zones = read_json(path, default={})
+
+    def get(self, name: str):
+        entry = self._zones.get(name)
+        if entry is None:
+            return None
+        zone_id, cached_at = entry
+        if self.path is not None and time.time() - cached_at > self.ttl:
+            return None
+        return zone_id
+
+    def update(self, zone_ids: Dict[str, str]):
+        now = time.time()
+        with self._lock:
+            for name, zone_id in zone_ids.items():
+                self._zones[name] = [zone_id, now]
+            if self.path is not None:
+                write_json_atomic(self.path, self._zones)
+
+    def __len__(self):
+        # expired entries still tell how many zones the account had when it was last listed
+        return len(self._zones)
 
 
 class CloudflareDnsOps:
+    LIST_PAGE_SIZE = RECORDS_PER_PAGE
 
-    def __init__(self, email=None, token=None, certtoken=None, debug=False):
+    def __init__(self, email=None, token=None, certtoken=None, debug=False, zone_cache: ZoneIdCache = None,
+                 scheduler: RequestScheduler = None, pool_size: int = DEFAULT_MAX_IN_FLIGHT, batch=False,
+                 batch_size: int = DEFAULT_BATCH_SIZE, prefetch_pages: bool = True):
         self.cf = CloudFlare.CloudFlare(email=email, token=token, certtoken=certtoken, debug=debug)
+        # the Retry-After of the last throttled response of each thread, CloudFlareAPIError does not carry it
+        self._throttled = threading.local()
+        self._use_pooled_session(pool_size)
+        self.batch = batch
+        self.batch_size = batch_size
+        self.prefetch_pages = prefetch_pages
+        self.zone_cache = zone_cache if zone_cache is not None else ZoneIdCache()
+        self.scheduler = scheduler or RequestScheduler(is_throttle_error=self.is_throttle_error)
+        self.scheduler.retry_after = self.retry_after
+
+    def _use_pooled_session(self, pool_size: int):
+        # the sdk creates its session lazily with the default pool of 10 connections, set one up front instead,
+        # so concurrent calls keep their connections alive and threads do not race to create the session
+        network = getattr(getattr(self.cf, '_base', None), 'network', None)
+        if network is None or not getattr(network, 'use_sessions', False):
+            return
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.hooks['response'].append(self._remember_retry_after)
+        network.session = session
+
+    def _remember_retry_after(self, response, *args, **kwargs):
+        # hooks run on the thread that made the call, the one the scheduler retries it from
+        self._throttled.retry_after = response.headers.get('Retry-After') if response.status_code == 429 else None
+
+    def retry_after(self, e: Exception) -> Optional[float]:
+        """
+        Seconds the api asked to wait before retrying the call that failed with e on this thread
+        """
+        retry_after = getattr(self._throttled, 'retry_after', None)
+        if retry_after is not None:
+            return parse_retry_after(retry_after)
+        return retry_after_from_exception(e)
+
+    @staticmethod
+    def is_throttle_error(e: Exception) -> bool:
+        return isinstance(e, CloudFlareAPIError) and int(e) in THROTTLE_ERROR_CODES
 
     def get_domain_records(self, domain: str, record: CloudflareDnsRecord = None) -> List[CloudflareDnsRecord]:
+        return list(self.iter_domain_records(domain, record))
+
+    def iter_domain_records(self, domain: str, record: CloudflareDnsRecord = None) -> Iterator[CloudflareDnsRecord]:
+        """
+        Stream the records of a domain page by page, so at most two pages are held at once.
+        With prefetch_pages, the next page is fetched while the records of a full page are consumed.
+        """
         if record is None:
             record = CloudflareDnsRecord()
 
@@ -22,8 +127,7 @@ class CloudflareDnsOps:
         # https://api.cloudflare.com/#dns-records-for-a-zone-list-dns-records
         params = {
             'match': 'all',
-            'page': 1,
-            'per_page': 1000,
+            'per_page': RECORDS_PER_PAGE,
         }
         if record.name == '@':
             params['name'] = domain
@@ -37,40 +141,95 @@ class CloudflareDnsOps:
         if record.proxied is not None:
             params['proxied'] = record.proxied
 
-        dns_records = self.cf.zones.dns_records.get(record.zone_id, params=params)
-        return [self._convert_resp_to_dns_record(domain, record) for record in dns_records]
+        def get_page(page_no):
+            return self.scheduler.call(self.cf.zones.dns_records.get, record.zone_id,
+                                       params=dict(params, page=page_no))
+
+        if not self.prefetch_pages:
+            page_no = 1
+            while True:
+                dns_records = get_page(page_no)
+                for dict_record in dns_records:
+                    yield self._convert_resp_to_dns_record(domain, dict_record)
+                # the sdk returns the records without the page info, a short page is the last one
+                if len(dns_records) < RECORDS_PER_PAGE:
+                    return
+                page_no += 1
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            page_no = 1
+            pending = pool.submit(get_page, page_no)
+            while pending is not None:
+                dns_records = pending.result()
+                pending = None
+                if len(dns_records) == RECORDS_PER_PAGE:
+                    page_no += 1
+                    pending = pool.submit(get_page, page_no)
+                for dict_record in dns_records:
+                    yield self._convert_resp_to_dns_record(domain, dict_record)
+
+    def get_records_by_name(self, domain: str, name: str) -> List[CloudflareDnsRecord]:
+        return self.get_domain_records(domain, CloudflareDnsRecord(name=name))
 
     @staticmethod
     def _convert_resp_to_dns_record(domain:str, dict_record: dict) -> CloudflareDnsRecord:
-        record = CloudflareDnsRecord()
-        record.id = dict_record.get('id')
-        record.type = dict_record.get('type')
-        record.value = dict_record.get('content')
-        record.ttl = dict_record.get('ttl')
-        record.proxiable = dict_record.get('proxiable')
-        record.proxied = dict_record.get('proxied', False)
-        record.priority = dict_record.get('priority')
-        record.zone_id = dict_record.get('zone_id')
-        record.zone_name = dict_record.get('zone_name')
-
         record_name = remove_suffix(dict_record['name'], '.' + domain)
         if record_name == domain:
             record_name = '@'
-        record.name = record_name
-        return record
+        return CloudflareDnsRecord(id=dict_record.get('id'),
+                                   name=record_name,
+                                   type=dict_record.get('type'),
+                                   value=dict_record.get('content'),
+                                   ttl=dict_record.get('ttl'),
+                                   proxiable=dict_record.get('proxiable'),
+                                   proxied=dict_record.get('proxied', False),
+                                   priority=dict_record.get('priority'),
+                                   zone_id=dict_record.get('zone_id'),
+                                   zone_name=dict_record.get('zone_name'))
 
     def _get_zone_id(self, domain: str) -> str:
+        zone_id = self.zone_cache.get(domain)
+        if zone_id is not None:
+            return zone_id
+
         params = {'name': domain}
-        zones = self.cf.zones.get(params=params)
+        zones = self.scheduler.call(self.cf.zones.get, params=params)
         if len(zones) == 0:
             raise DnsManipulationException('zone not found for domain {}'.format(domain))
+        self.zone_cache.update({domain: zones[0]['id']})
         return zones[0]['id']
 
-    # https://api.cloudflare.com/#dns-records-for-a-zone-create-dns-record
-    def add_domain_record(self, domain: str, record: CloudflareDnsRecord):
-        if record.zone_id is None:
-            record.zone_id = self._get_zone_id(domain)
-        data = {
+    def prefetch_zone_ids(self, domains: Iterable[str]):
+        """
+        Cache the zone ids of the domains by listing the zones of the account, instead of one lookup per domain.
+        Listing stops once every domain is found, and is skipped or cut short when it would take more calls
+        than the lookups it saves. The zones listed before tell how many pages the account has.
+        """
+        missing = {domain for domain in domains if self.zone_cache.get(domain) is None}
+        if len(missing) <= 1:
+            return
+        max_pages = len(missing)
+        if math.ceil(len(self.zone_cache) / ZONES_PER_PAGE) > max_pages:
+            return
+
+        zone_ids = {}
+        for page in range(1, max_pages + 1):
+            params = {'page': page, 'per_page': ZONES_PER_PAGE}
+            zones = self.scheduler.call(self.cf.zones.get, params=params)
+            zone_ids.update({zone['name']: zone['id'] for zone in zones})
+            missing.difference_update(zone_ids)
+            if not missing or len(zones) < ZONES_PER_PAGE:
+                break
+        # the domains not listed yet are looked up one by one when they are used
+        self.zone_cache.update(zone_ids)
+
+    @staticmethod
+    def record_id_from_response(response: dict):
+        return response.get('id')
+
+    @staticmethod
+    def _record_data(record: CloudflareDnsRecord) -> dict:
+        return {
             'type': record.type,
             'name': record.name,
             'content': record.value,
@@ -78,7 +237,12 @@ class CloudflareDnsOps:
             'priority': record.priority,
             'proxied': record.proxied,
         }
-        return self.cf.zones.dns_records.post(record.zone_id, data=data)
+
+    # https://api.cloudflare.com/#dns-records-for-a-zone-create-dns-record
+    def add_domain_record(self, domain: str, record: CloudflareDnsRecord):
+        if record.zone_id is None:
+            record.zone_id = self._get_zone_id(domain)
+        return self.scheduler.call(self.cf.zones.dns_records.post, record.zone_id, data=self._record_data(record))
 
     # https://api.cloudflare.com/#dns-records-for-a-zone-update-dns-record
     def update_domain_record(self, domain: str, record: CloudflareDnsRecord):
@@ -91,29 +255,64 @@ class CloudflareDnsOps:
             if len(records) > 1:
                 raise DnsManipulationException('multiple records for {}.{}'.format(record.name, domain))
             record.id = records[0].id
-        data = {
-            'type': record.type,
-            'name': record.name,
-            'content': record.value,
-            'ttl': record.ttl,
-            'priority': record.priority,
-            'proxied': record.proxied,
-        }
-        return self.cf.zones.dns_records.put(record.zone_id, record.id, data=data)
+        return self.scheduler.call(self.cf.zones.dns_records.put, record.zone_id, record.id,
+                                   data=self._record_data(record))
 
     # https://api.cloudflare.com/#dns-records-for-a-zone-delete-dns-record
     def delete_domain_record(self, domain: str, record: CloudflareDnsRecord):
         if record.zone_id is None:
             record.zone_id = self._get_zone_id(domain)
         if record.id is not None:
-            return self.cf.zones.dns_records.delete(record.zone_id, record.id)
+            return self.scheduler.call(self.cf.zones.dns_records.delete, record.zone_id, record.id)
 
         records = self.get_domain_records(domain, record)
         if len(records) == 0:
             raise DnsManipulationException('delete failed: record {} not exist for domain {}'.format(record, domain))
         if len(records) > 1:
             raise DnsManipulationException('delete failed: multiple records for {} in domain {}'.format(record, domain))
-        return self.cf.zones.dns_records.delete(record.zone_id, records[0].id)
+        return self.scheduler.call(self.cf.zones.dns_records.delete, record.zone_id, records[0].id)
+
+    def _batch_endpoint(self):
+        # the endpoint is newer than the sdk, register it the way the sdk declares its own endpoints
+        if not hasattr(self.cf.zones.dns_records, 'batch'):
+            self.cf.add('AUTH', 'zones', 'dns_records', 'batch')
+        return self.cf.zones.dns_records.batch.post
+
+    # https://developers.cloudflare.com/api/resources/dns/subresources/records/methods/batch/
+    def apply_changeset(self, domain: str, changeset: ChangeSet) -> dict:
+        """
+        Apply all changes of a domain with batch calls of up to batch_size changes. Each batch is applied
+        atomically, deletes first, then puts and posts, so the changeset is cut in consecutive slices
+        and conflicting records are still deleted before their replacement is added.
+        Added records get the ids of the created ones.
+        """
+        zone_id = self._get_zone_id(domain)
+        changes = list(changeset)
+        results = {'deletes': [], 'puts': [], 'posts': []}
+        for start in range(0, len(changes), self.batch_size):
+            chunk = changes[start:start + self.batch_size]
+            data = {'deletes': [], 'puts': [], 'posts': []}
+            for change in chunk:
+                record = change.record
+                if change.action == ACTION_ADD:
+                    data['posts'].append(self._record_data(record))
+                    continue
+                if record.id is None:
+                    raise DnsManipulationException('batch {} failed: record {} has no id'.format(change.action,
+                                                                                                  record))
+                if change.action == ACTION_UPDATE:
+                    data['puts'].append(dict(self._record_data(record), id=record.id))
+                else:
+                    data['deletes'].append({'id': record.id})
+            result = self.scheduler.call(self._batch_endpoint(), zone_id, data=data) or {}
+
+            added = [change.record for change in chunk if change.action == ACTION_ADD]
+            for record, created in zip(added, result.get('posts') or []):
+                record.id = created.get('id')
+                record.zone_id = zone_id
+            for key in results:
+                results[key] += result.get(key) or []
+        return results
 
 
 def build_cloudflare_dns_client_from_config(config: dict) -> CloudflareDnsOps:
@@ -121,4 +320,15 @@ def build_cloudflare_dns_client_from_config(config: dict) -> CloudflareDnsOps:
     token = config.get('token')
     certtoken = config.get('certtoken')
     debug = config.get('debug')
-    return CloudflareDnsOps(email, token, certtoken, debug)
+
+    # zone_cache: true keeps zone ids in the default cache dir, a string names the cache file
+    zone_cache_path = config.get('zone_cache')
+    if zone_cache_path is True:
+        zone_cache_path = os.path.join(default_cache_dir(), 'cloudflare_zones.json')
+    zone_cache = ZoneIdCache(zone_cache_path or None, config.get('zone_cache_ttl', DEFAULT_ZONE_CACHE_TTL))
+    scheduler = build_request_scheduler(config, CloudflareDnsOps.is_throttle_error)
+    pool_size = config.get(CFG_KEY_CLIENT_MAX_IN_FLIGHT) or DEFAULT_MAX_IN_FLIGHT
+    return CloudflareDnsOps(email, token, certtoken, debug, zone_cache=zone_cache, scheduler=scheduler,
+                            pool_size=pool_size, batch=config.get('batch', False),
+                            batch_size=config.get('batch_size', DEFAULT_BATCH_SIZE),
+                            prefetch_pages=config.get('prefetch_pages', True))
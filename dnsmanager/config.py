@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import hashlib
+import os
+import pickle
+import tempfile
+from typing import Callable, Dict, List, Tuple
+
+from dnsmanager import __version__
+from dnsmanager.model import DnsRecord, DnsManipulationException, CFG_KEY_CLIENTS, CFG_KEY_ACCOUNTS, \
+    CFG_KEY_ACCOUNT_VENDOR, CFG_KEY_DNS, CFG_KEY_DNS_DOMAIN, CFG_KEY_DNS_VENDOR, CFG_KEY_DNS_ACCOUNT, \
+    CFG_KEY_DNS_RECORDS, CFG_KEY_DNS_RECORD_VALUE_FROM
+from dnsmanager.snapshot import content_hash
+from dnsmanager.utils import default_cache_dir
+
+# bump when the layout of compiled configs changes
+CACHE_FORMAT = 4
+
+
+class DomainConfig:
+    """
+    A `dns` entry of the config file, with its record blocks parsed by the vendor's record parser.
+    `account` names the client the domain is managed with, the vendor itself for entries of legacy `clients`.
+    `block_hashes` are the content hashes of the record blocks and `hash` covers the whole entry.
+    `value_sources` maps the index of a block whose values come from a `value_from` source to that source.
+    """
+    __slots__ = ('domain', 'vendor', 'account', 'record_groups', 'value_sources', 'block_hashes', 'hash')
+
+    def __init__(self, domain: str, vendor: str, record_groups: List[List[DnsRecord]],
+                 value_sources: Dict[int, dict] = None, account: str = None):
+        self.domain = domain
+        self.vendor = vendor
+        self.account = account or vendor
+        self.record_groups = record_groups
+        self.value_sources = value_sources or {}
+        self.block_hashes = [content_hash(records) for records in record_groups]
+        digest = hashlib.sha256('{}\t{}\n'.format(self.account, domain).encode('utf-8'))
+        for block_hash in self.block_hashes:
+            digest.update(block_hash.encode('ascii'))
+        self.hash = digest.hexdigest()
+
+
+class DnsConfig:
+    """
+    Parsed config file, `conf` keeps the raw yaml document for the client settings
+    """
+
+    def __init__(self, conf: dict, domains: List[DomainConfig]):
+        self.conf = conf
+        self.domains = domains
+
+
+def _parse_yaml(stream) -> dict:
+    # yaml is imported here, runs answered from the compiled cache never need it
+    import yaml
+    # libyaml is several times faster than the pure python loader, use it when PyYAML was built with it
+    return yaml.load(stream, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+
+def load_yaml(path: str) -> dict:
+    with open(path) as fp:
+        return _parse_yaml(fp)
+
+
+def account_configs(conf: dict) -> Dict[str, dict]:
+    """
+    Client settings of every account by name, each naming its `vendor`.
+    Entries of the legacy `clients` section are accounts named after their vendor.
+    """
+    accounts = {vendor: dict(client_conf, **{CFG_KEY_ACCOUNT_VENDOR: vendor})
+                for vendor, client_conf in (conf.get(CFG_KEY_CLIENTS) or {}).items() if client_conf}
+    for name, account_conf in (conf.get(CFG_KEY_ACCOUNTS) or {}).items():
+        if not account_conf or not account_conf.get(CFG_KEY_ACCOUNT_VENDOR):
+            raise DnsManipulationException('account {} names no vendor'.format(name))
+        accounts[name] = account_conf
+    return accounts
+
+
+def _account_of(config: dict, accounts: Dict[str, dict]) -> Tuple[str, str]:
+    # entries name an account, or a vendor whose legacy client they are managed with
+    account = config.get(CFG_KEY_DNS_ACCOUNT)
+    if account is None:
+        vendor = config.get(CFG_KEY_DNS_VENDOR)
+        return vendor, vendor
+    if account not in accounts:
+        raise DnsManipulationException('unknown account {} of domain {}'.format(
+            account, config.get(CFG_KEY_DNS_DOMAIN)))
+    return accounts[account][CFG_KEY_ACCOUNT_VENDOR], account
+
+
+def compile_dns_config(conf: dict, record_parser_of: Callable[[str], Callable[[dict], List[DnsRecord]]]) -> DnsConfig:
+    accounts = account_configs(conf)
+    domains = []
+    for config in conf.get(CFG_KEY_DNS) or []:
+        vendor, account = _account_of(config, accounts)
+        record_parser = record_parser_of(vendor)
+        records_conf = config.get(CFG_KEY_DNS_RECORDS) or []
+        record_groups = [record_parser(r) for r in records_conf]
+        value_sources = {i: r[CFG_KEY_DNS_RECORD_VALUE_FROM] for i, r in enumerate(records_conf)
+                         if CFG_KEY_DNS_RECORD_VALUE_FROM in r}
+        domains.append(DomainConfig(config.get(CFG_KEY_DNS_DOMAIN), vendor, record_groups, value_sources, account))
+    return DnsConfig(conf, domains)
+
+
+def parse_shard(spec: str) -> Tuple[int, int]:
+    """
+    Parse a `i/n` shard spec, i counts from 1
+    """
+    try:
+        index, count = (int(part) for part in spec.split('/'))
+    except ValueError:
+        raise DnsManipulationException('invalid shard {}, expected i/n like 1/4'.format(spec))
+    if count < 1 or not 1 <= index <= count:
+        raise DnsManipulationException('invalid shard {}, i must be between 1 and n'.format(spec))
+    return index, count
+
+
+def in_shard(domain: str, shard: Tuple[int, int]) -> bool:
+    # a hash of the name, so every host puts a domain in the same shard whatever its config order or account
+    index, count = shard
+    digest = hashlib.sha1(domain.lower().encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count == index - 1
+
+
+def select_shard(dns_config: DnsConfig, shard: Tuple[int, int] = None) -> DnsConfig:
+    """
+    Keep the domains of shard i of n, shards of the same n never overlap and together hold every domain
+    """
+    if shard is None:
+        return dns_config
+    return DnsConfig(dns_config.conf, [d for d in dns_config.domains if in_shard(d.domain, shard)])
+
+
+def _cache_path(path: str, cache_dir: str) -> str:
+    name = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, 'config', name + '.pickle')
+
+
+def _load_cache(cache_path: str):
+    try:
+        with open(cache_path, 'rb') as fp:
+            return pickle.load(fp)
+    except Exception:
+        # missing, truncated or written by another version, compile again
+        return None
+
+
+def _save_cache(cache_path: str, entry: dict):
+    directory = os.path.dirname(cache_path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            pickle.dump(entry, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_dns_config(path: str, record_parser_of: Callable[[str], Callable[[dict], List[DnsRecord]]],
+                    use_cache: bool = True, cache_dir: str = None) -> DnsConfig:
+    """
+    Load and compile a config file. The compiled config is cached by file path, and reused while the
+    file keeps its mtime and size, or its content hash when those changed.
+    """
+    if not use_cache:
+        return compile_dns_config(load_yaml(path), record_parser_of)
+
+    cache_path = _cache_path(path, cache_dir or default_cache_dir())
+    stat = os.stat(path)
+    entry = _load_cache(cache_path)
+    if entry is not None and (entry.get('format'), entry.get('version')) != (CACHE_FORMAT, __version__):
+        entry = None
+    if entry is not None and (entry['mtime'], entry['size']) == (stat.st_mtime_ns, stat.st_size):
+        return entry['config']
+
+    with open(path, 'rb') as fp:
+        content = fp.read()
+    digest = hashlib.sha256(content).hexdigest()
+    if entry is not None and entry['hash'] == digest:
+        dns_config = entry['config']
+    else:
+        dns_config = compile_dns_config(_parse_yaml(content), record_parser_of)
+
+    _save_cache(cache_path, {
+        'format': CACHE_FORMAT,
+        'version': __version__,
+        'mtime': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'hash': digest,
+        'config': dns_config,
+    })
+    return dns_config
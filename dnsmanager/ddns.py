@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import ipaddress
+import json
+import socket
+import struct
+import subprocess
+from typing import Dict, List
+
+from dnsmanager.config import DnsConfig, DomainConfig
+from dnsmanager.model import DnsManipulationException
+
+SOURCE_INTERFACE = 'interface'
+SOURCE_COMMAND = 'command'
+SOURCE_FILE = 'file'
+
+DEFAULT_COMMAND_TIMEOUT = 30
+
+# https://man7.org/linux/man-pages/man7/netdevice.7.html
+SIOCGIFADDR = 0x8915
+PROC_IF_INET6 = '/proc/net/if_inet6'
+IPV6_SCOPE_GLOBAL = 0x00
+# temporary, deprecated and tentative addresses are not worth publishing
+_IFA_F_UNSTABLE = 0x01 | 0x20 | 0x40
+
+
+def _lines(text: str) -> List[str]:
+    values = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line and line not in values:
+            values.append(line)
+    return values
+
+
+def _interface_ipv4(name: str) -> List[str]:
+    import fcntl
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        try:
+            ifreq = fcntl.ioctl(sock.fileno(), SIOCGIFADDR, struct.pack('256s', name[:15].encode('utf-8')))
+        except OSError:
+            return []
+    return [socket.inet_ntoa(ifreq[20:24])]
+
+
+def _interface_ipv6(name: str) -> List[str]:
+    # each line: address, interface index, prefix length, scope, flags, interface name
+    values = []
+    with open(PROC_IF_INET6) as fp:
+        for line in fp:
+            fields = line.split()
+            if len(fields) != 6 or fields[5] != name:
+                continue
+            # link and host scoped addresses are only reachable on the host or its link
+            if int(fields[3], 16) == IPV6_SCOPE_GLOBAL and not int(fields[4], 16) & _IFA_F_UNSTABLE:
+                values.append(str(ipaddress.IPv6Address(int(fields[0], 16))))
+    return values
+
+
+def read_value_source(source: dict, record_type: str) -> List[str]:
+    """
+    Current values of a `value_from` source: the addresses of a network interface,
+    or the non empty lines printed by a command or held by a file
+    """
+    if SOURCE_INTERFACE in source:
+        family = source.get('family', 6 if record_type == 'AAAA' else 4)
+        name = source[SOURCE_INTERFACE]
+        return _interface_ipv6(name) if int(family) == 6 else _interface_ipv4(name)
+    if SOURCE_COMMAND in source:
+        result = subprocess.run(source[SOURCE_COMMAND], shell=True, stdout=subprocess.PIPE, check=True,
+                                timeout=source.get('timeout', DEFAULT_COMMAND_TIMEOUT), universal_newlines=True)
+        return _lines(result.stdout)
+    if SOURCE_FILE in source:
+        with open(source[SOURCE_FILE]) as fp:
+            return _lines(fp.read())
+    raise DnsManipulationException('unknown value_from source: {}'.format(source))
+
+
+def resolve_value_sources(dns_config: DnsConfig, failed: Dict[str, Exception] = None) -> DnsConfig:
+    """
+    Fill in the values of the record blocks read from `value_from` sources. Every source is read once per call,
+    and the hashes of the domains are computed over the values read. With failed, a domain whose sources cannot
+    be read is left out and its error put in failed, the other domains are still resolved.
+    """
+    if not any(domain_config.value_sources for domain_config in dns_config.domains):
+        return dns_config
+
+    values_by_source = {}
+    domains = []
+    for domain_config in dns_config.domains:
+        if not domain_config.value_sources:
+            domains.append(domain_config)
+            continue
+        try:
+            domains.append(_resolve_domain(domain_config, values_by_source))
+        except Exception as e:
+            if failed is None:
+                raise
+            failed[domain_config.domain] = e
+    return DnsConfig(dns_config.conf, domains)
+
+
+def _resolve_domain(domain_config: DomainConfig, values_by_source: dict) -> DomainConfig:
+    record_groups = list(domain_config.record_groups)
+    for index, source in domain_config.value_sources.items():
+        template = record_groups[index][0]
+        key = json.dumps([source, template.type], sort_keys=True)
+        if key not in values_by_source:
+            # a source that failed fails every domain reading it, without being read again
+            try:
+                values_by_source[key] = read_value_source(source, template.type)
+            except Exception as e:
+                values_by_source[key] = e
+        values = values_by_source[key]
+        if isinstance(values, Exception):
+            raise values
+        if not values:
+            raise DnsManipulationException('no value for [{}] {}.{} from {}'.format(
+                template.type, template.name, domain_config.domain, source))
+        record_groups[index] = [template.copy(value=value) for value in values]
+    return DomainConfig(domain_config.domain, domain_config.vendor, record_groups,
+                        domain_config.value_sources, domain_config.account)
@@ -3,184 +3,855 @@
 
 from __future__ import print_function
 
+import argparse
+import functools
+import json
+import os
 import sys
-from typing import Callable, Mapping, List, Set
-
-import yaml
-
-from dnsmanager.aliyun_dns_ops import build_aliyun_dns_client_from_config
-from dnsmanager.cloudflare_dns_ops import build_cloudflare_dns_client_from_config
-from dnsmanager.model import DnsRecord, CFG_KEY_CLIENTS, CFG_KEY_DNS, CFG_KEY_DNS_DOMAIN, CFG_KEY_DNS_VENDOR, \
-    CFG_KEY_DNS_RECORDS
-from dnsmanager.model import parse_dns_record_from_config, parse_namecheap_dns_record_from_config, \
-    parse_cloudflare_dns_record_from_config
-from dnsmanager.namecheap_dns_ops import build_namecheap_dns_client_from_config
-from dnsmanager.utils import remove_suffix
+import time
+from collections import Counter
+from typing import Callable, Mapping, List
+
+from dnsmanager.config import DnsConfig, DomainConfig, account_configs, load_dns_config, load_yaml, parse_shard, \
+    select_shard
+from dnsmanager.ddns import resolve_value_sources
+from dnsmanager.drift import DriftCheck, domain_report, drift_report, exit_status
+from dnsmanager.executor import InFlightLimit, run_domain_jobs, run_domain_jobs_async
+from dnsmanager.journal import StateJournal
+from dnsmanager.metrics import registry
+from dnsmanager.model import DnsRecord, CFG_KEY_CLIENT_MAX_IN_FLIGHT, DnsManipulationException, \
+    ACTION_ADD, ACTION_UPDATE, ACTION_DELETE, CFG_KEY_DNS_RECORD_RR, CFG_KEY_DNS_RECORD_TYPE
+from dnsmanager.fetch import fetch_named_records, fetch_named_records_async, iter_remote_records, managed_names, \
+    prefers_filtered_fetch
+from dnsmanager.plan import DomainPlan, bind_changes, fingerprint, patch_index, read_plan, touched_names, write_plan
+from dnsmanager.plugins import get_vendor
+from dnsmanager.reconciler import ZoneIndex, apply_changeset, compute_changeset, reconcile_domain, \
+    reconcile_domain_async
+from dnsmanager.snapshot import SnapshotStore
+from dnsmanager.watch import DEFAULT_DEBOUNCE, DEFAULT_POLL_INTERVAL, make_file_watcher, wait_for_change
+from dnsmanager.utils import open_atomic
+from dnsmanager.zonefile import iter_zone_records, write_zone, zone_file_origin
 
 
 class DnsProvider:
     client = any
     record_parser = Callable[[dict], List[DnsRecord]]
+    in_flight = InFlightLimit
 
-    def __init__(self, client: any,
-                 record_parser: Callable[[dict], List[DnsRecord]] = parse_dns_record_from_config):
+    def __init__(self, client: any, record_parser: Callable[[dict], List[DnsRecord]], max_in_flight: int = None):
         self.client = client
         self.record_parser = record_parser
+        self.in_flight = InFlightLimit(max_in_flight)
 
 
-client_factories = {
-    'namecheap': build_namecheap_dns_client_from_config,
-    'aliyun': build_aliyun_dns_client_from_config,
-    'cloudflare': build_cloudflare_dns_client_from_config,
-}
+def load_dns_conf_from_file(path):
+    return load_yaml(path)
 
-default_record_parser = parse_dns_record_from_config
-record_parsers = {
-    'namecheap': parse_namecheap_dns_record_from_config,
-    'cloudflare': parse_cloudflare_dns_record_from_config,
-}
 
+def _record_parser_of(vendor: str) -> Callable[[dict], List[DnsRecord]]:
+    return get_vendor(vendor).parse_records
 
-def load_dns_conf_from_file(path):
-    with open(path) as fp:
-        return yaml.safe_load(fp)
+
+def load_dns_config_from_file(path, use_cache=True, shard=None, resolve_sources=True, failed=None) -> DnsConfig:
+    """
+    Load the config of the domains of the shard. value_from sources are read on every load unless resolve_sources
+    is off, for the commands that never look at record values. With failed, a domain whose sources cannot be read
+    is left out and its error put in failed, instead of failing the whole load.
+    """
+    dns_config = select_shard(load_dns_config(path, _record_parser_of, use_cache=use_cache), shard)
+    return resolve_value_sources(dns_config, failed) if resolve_sources else dns_config
 
 
-def build_dns_clients(clients_conf) -> Mapping[str, DnsProvider]:
-    clients_conf = clients_conf.get(CFG_KEY_CLIENTS)
+def print_failed_sources(failed: Mapping[str, Exception], out=None):
+    for domain, e in sorted(failed.items()):
+        print('{}: skipped, cannot read its value_from sources: {}'.format(domain, e), file=out)
+
+
+def raise_failed_sources(failed: Mapping[str, Exception]):
+    if failed:
+        raise DnsManipulationException('skipped {} domains whose value_from sources cannot be read: {}'.format(
+            len(failed), ', '.join(sorted(failed))))
+
+
+def build_dns_clients(dns_config: DnsConfig, domains: List[DomainConfig] = None) -> Mapping[str, DnsProvider]:
+    """
+    One client per account of the domains worked on, keyed by account name.
+    Only vendors of those accounts are built, so unused vendor sdks are never imported.
+    """
+    accounts = account_configs(dns_config.conf)
     clients = {}
-    for vendor, factory in client_factories.items():
-        client_conf = clients_conf.get(vendor)
-        if client_conf:
-            record_parser = record_parsers.get(vendor, default_record_parser)
-            clients[vendor] = DnsProvider(client=factory(client_conf), record_parser=record_parser)
+    for domain_config in dns_config.domains if domains is None else domains:
+        account = domain_config.account
+        if account in clients:
+            continue
+        client_conf = accounts.get(account)
+        if not client_conf:
+            raise DnsManipulationException('no client configured for account {} of domain {}'
+                                           .format(account, domain_config.domain))
+        vendor = domain_config.vendor
+        plugin = get_vendor(vendor)
+        clients[account] = DnsProvider(client=registry.instrument(plugin.build_client(client_conf), vendor),
+                                       record_parser=plugin.parse_records,
+                                       max_in_flight=client_conf.get(CFG_KEY_CLIENT_MAX_IN_FLIGHT))
     return clients
 
 
-def load_and_update_dns_config(cfg_path):
-    dns_conf = load_dns_conf_from_file(cfg_path)
-    clients = build_dns_clients(dns_conf)
+def build_async_dns_clients(clients: Mapping[str, DnsProvider]) -> Mapping[str, DnsProvider]:
+    # asyncio takes a while to import, only runs with --async pay for it
+    from dnsmanager.async_ops import AsyncDnsOps
+    # per account, in flight calls are bounded by the thread pool of its AsyncDnsOps
+    return {account: DnsProvider(client=AsyncDnsOps(provider.client, provider.in_flight.limit),
+                                 record_parser=provider.record_parser)
+            for account, provider in clients.items()}
+
+
+def close_async_dns_clients(clients: Mapping[str, DnsProvider]):
+    for provider in clients.values():
+        provider.client.close()
+
+
+def prefetch_client_caches(domains: List[DomainConfig], clients: Mapping[str, DnsProvider]):
+    # clients like cloudflare resolve the zones of all configured domains in one call up front
+    domains_by_account = {}
+    for domain_config in domains:
+        domains_by_account.setdefault(domain_config.account, []).append(domain_config.domain)
+    for account, domains in domains_by_account.items():
+        prefetch = getattr(clients[account].client, 'prefetch_zone_ids', None)
+        if prefetch is not None:
+            prefetch(domains)
+
+
+def select_changed_domains(domains: List[DomainConfig], journal: StateJournal,
+                           snapshots: SnapshotStore) -> List[DomainConfig]:
+    """
+    Domains whose config entry changed since their last successful update, or whose last known remote state
+    is not the one that update left behind
+    """
+    return [domain_config for domain_config in domains
+            if not journal.is_unchanged(domain_config, snapshots.digest(domain_config.account, domain_config.domain))]
+
+
+def load_and_update_dns_config(cfg_path, refresh=False, workers=1, use_cache=True, use_async=False,
+                               changed_only=False, shard=None, verify=False, verify_timeout=None,
+                               nameservers=None):
+    failed = {}
+    with registry.phase('load_config'):
+        dns_config = load_dns_config_from_file(cfg_path, use_cache=use_cache, shard=shard, failed=failed)
+    print_failed_sources(failed)
+    snapshots = SnapshotStore()
+    journal = StateJournal()
+
+    domains = dns_config.domains
+    if changed_only:
+        with registry.phase('select'):
+            domains = select_changed_domains(domains, journal, snapshots)
+        print('{} of {} domains changed since their last update'.format(len(domains), len(dns_config.domains)))
+    with registry.phase('build_clients'):
+        clients = build_dns_clients(dns_config, domains)
+    with registry.phase('prefetch'):
+        prefetch_client_caches(domains, clients)
+
+    applied = {} if verify else None
+    try:
+        if use_async:
+            async_clients = build_async_dns_clients(clients)
+            try:
+                run_domain_jobs_async([functools.partial(_update_domain_async, async_clients[domain_config.account],
+                                                         domain_config, snapshots, journal, refresh, applied=applied)
+                                       for domain_config in domains], workers=workers)
+            finally:
+                close_async_dns_clients(async_clients)
+        else:
+            jobs = []
+            for domain_config in domains:
+                client = clients[domain_config.account]
+                jobs.append((client.in_flight, functools.partial(_update_domain, client, domain_config, snapshots,
+                                                                 journal, refresh, applied=applied)))
+            run_domain_jobs(jobs, workers=workers)
+    finally:
+        # domains applied before a failure are kept, the next --changed-only run skips them
+        journal.save()
+
+    if verify:
+        verify_applied([applied[d.domain] for d in domains if d.domain in applied], verify_timeout, nameservers)
+    raise_failed_sources(failed)
+    print('Done.')
+
+
+def verify_applied(applied, timeout=None, nameservers=None):
+    """
+    Wait until the authoritative nameservers serve every name and type the changesets touched,
+    and report how long each took. Fails when some were still not served after timeout seconds.
+    """
+    import asyncio
+    from dnsmanager.verify import DEFAULT_VERIFY_TIMEOUT, checks_from_changeset, print_verify_report, \
+        verify_propagation
+    timeout = DEFAULT_VERIFY_TIMEOUT if timeout is None else timeout
+    checks = [check for changeset, remote_records in applied
+              for check in checks_from_changeset(changeset, remote_records)]
+    if not checks:
+        print('Nothing to verify.')
+        return
+    print('Verifying {} records on the authoritative nameservers...'.format(len(checks)))
+    with registry.phase('verify'):
+        asyncio.run(verify_propagation(checks, nameservers, timeout))
+    pending = print_verify_report(checks)
+    if pending:
+        raise DnsManipulationException('{} of {} records not served by the nameservers after {}s'.format(
+            pending, len(checks), timeout))
+
+
+def update_dynamic_dns(cfg_path, workers=1, use_cache=True, shard=None):
+    """
+    Update the domains with records read from value_from sources, and only those whose values changed since
+    they were last applied. Idle runs read the sources and the journal, and call no vendor api.
+    """
+    failed = {}
+    with registry.phase('load_config'):
+        dns_config = load_dns_config_from_file(cfg_path, use_cache=use_cache, shard=shard, failed=failed)
+    print_failed_sources(failed)
+    snapshots = SnapshotStore()
+    journal = StateJournal()
+
+    dynamic_domains = [domain_config for domain_config in dns_config.domains if domain_config.value_sources]
+    domains = [domain_config for domain_config in dynamic_domains if not journal.is_applied(domain_config)]
+    print('{} of {} dynamic domains changed'.format(len(domains), len(dynamic_domains) + len(failed)))
+    if not domains:
+        raise_failed_sources(failed)
+        return
+
+    with registry.phase('build_clients'):
+        clients = build_dns_clients(dns_config, domains)
+    with registry.phase('prefetch'):
+        prefetch_client_caches(domains, clients)
+    jobs = []
+    for domain_config in domains:
+        client = clients[domain_config.account]
+        jobs.append((client.in_flight,
+                     functools.partial(_update_domain, client, domain_config, snapshots, journal, False)))
+    try:
+        run_domain_jobs(jobs, workers=workers)
+    finally:
+        journal.save()
+
+    raise_failed_sources(failed)
+    print('Done.')
 
-    for config in dns_conf.get(CFG_KEY_DNS):
-        domain = config.get(CFG_KEY_DNS_DOMAIN)
-        client = clients[config.get(CFG_KEY_DNS_VENDOR)]
 
+def _print_changed_blocks(journal: StateJournal, domain_config: DomainConfig, out):
+    changed = journal.changed_blocks(domain_config)
+    if changed:
+        print('{}: {} of {} record blocks changed since the last update'.format(
+            domain_config.domain, changed, len(domain_config.block_hashes)), file=out)
+
+
+def _filtered_fetch_names(client, domain_config: DomainConfig, snapshot, refresh):
+    """
+    Names to fetch one by one instead of listing the zone, None when listing is cheaper.
+    The last snapshot stands for the zone, for its size and the number of records under each name.
+    """
+    if refresh or snapshot is None:
+        return None
+    names = managed_names(domain_config.record_groups)
+    name_sizes = Counter(record.name for record in snapshot.records)
+    if not prefers_filtered_fetch(client.client, names, len(snapshot.records), name_sizes):
+        return None
+    return names
+
+
+def _merge_snapshot(snapshot, names, remote_records: List[DnsRecord]) -> List[DnsRecord]:
+    # records of the fetched names replace those of the snapshot, the rest of the zone is kept as last listed
+    return [record for record in snapshot.records if record.name not in names] + list(remote_records)
+
+
+def _update_domain(client, domain_config: DomainConfig, snapshots, journal, refresh, out, applied=None):
+    _print_changed_blocks(journal, domain_config, out)
+    account, domain = domain_config.account, domain_config.domain
+    snapshot = snapshots.load(account, domain)
+    names = _filtered_fetch_names(client, domain_config, snapshot, refresh)
+    if names is None:
+        # create records not exist and delete records whose value not present at config file, in one pass
+        changeset, remote_records = reconcile_domain(client, domain, domain_config.record_groups, refresh=refresh,
+                                                     out=out)
+        saved = snapshots.save(account, domain, remote_records)
+    else:
+        with registry.phase('list'):
+            named_records = fetch_named_records(client.client, domain, names)
+        changeset, remote_records = reconcile_domain(client, domain, domain_config.record_groups, out=out,
+                                                     remote_records=named_records)
+        saved = snapshots.save(account, domain, _merge_snapshot(snapshot, names, remote_records), snapshot.fetched_at)
+    journal.record(domain_config, saved.hash)
+    if applied is not None:
+        applied[domain] = (changeset, remote_records)
+
+
+async def _update_domain_async(client, domain_config: DomainConfig, snapshots, journal, refresh, out,
+                               applied=None):
+    _print_changed_blocks(journal, domain_config, out)
+    account, domain = domain_config.account, domain_config.domain
+    import asyncio
+    loop = asyncio.get_running_loop()
+    # large snapshots take a while to parse and serialize, keep the event loop free meanwhile
+    snapshot = await loop.run_in_executor(None, snapshots.load, account, domain)
+    names = _filtered_fetch_names(client, domain_config, snapshot, refresh)
+    if names is None:
+        changeset, remote_records = await reconcile_domain_async(client, domain, domain_config.record_groups,
+                                                                 refresh=refresh, out=out)
+        saved = await loop.run_in_executor(None, snapshots.save, account, domain, remote_records)
+    else:
+        with registry.phase('list'):
+            named_records = await fetch_named_records_async(client.client, domain, names)
+        changeset, remote_records = await reconcile_domain_async(client, domain, domain_config.record_groups,
+                                                                 out=out, remote_records=named_records)
+        saved = await loop.run_in_executor(None, snapshots.save, account, domain,
+                                           _merge_snapshot(snapshot, names, remote_records), snapshot.fetched_at)
+    journal.record(domain_config, saved.hash)
+    if applied is not None:
+        applied[domain] = (changeset, remote_records)
+
+
+def plan_dns_config(cfg_path, out_path=None, workers=1, use_cache=True, shard=None):
+    """
+    List every domain and print the changes update would make. With out_path, the changes are saved
+    as a plan that apply carries out later, with the fingerprint of the records they touch.
+    """
+    failed = {}
+    with registry.phase('load_config'):
+        dns_config = load_dns_config_from_file(cfg_path, use_cache=use_cache, shard=shard, failed=failed)
+    print_failed_sources(failed)
+    with registry.phase('build_clients'):
+        clients = build_dns_clients(dns_config)
+    with registry.phase('prefetch'):
+        prefetch_client_caches(dns_config.domains, clients)
+    snapshots = SnapshotStore()
+
+    plans = {}
+    jobs = []
+    for domain_config in dns_config.domains:
+        client = clients[domain_config.account]
+        jobs.append((client.in_flight, functools.partial(_plan_domain, client, domain_config, snapshots, plans)))
+    run_domain_jobs(jobs, workers=workers)
+
+    domain_plans = [plans[domain_config.domain] for domain_config in dns_config.domains
+                    if domain_config.domain in plans]
+    changes = [change for domain_plan in domain_plans for change in domain_plan.changeset]
+    print('Plan: {} to add, {} to update, {} to delete in {} of {} domains.'.format(
+        sum(1 for c in changes if c.action == ACTION_ADD), sum(1 for c in changes if c.action == ACTION_UPDATE),
+        sum(1 for c in changes if c.action == ACTION_DELETE), len(domain_plans), len(dns_config.domains)))
+    if out_path:
+        write_plan(out_path, os.path.abspath(cfg_path), domain_plans)
+        print('Saved the plan to {}, carry it out with: dns-manager apply {}'.format(out_path, out_path))
+    raise_failed_sources(failed)
+
+
+def _plan_domain(client, domain_config: DomainConfig, snapshots, plans, out):
+    domain = domain_config.domain
+    with registry.phase('list'):
         remote_records = client.client.get_domain_records(domain)
-        for r in config.get(CFG_KEY_DNS_RECORDS):
-            local_records = client.record_parser(r)
+    snapshot = snapshots.save(domain_config.account, domain, remote_records)
+    with registry.phase('diff'):
+        changeset = compute_changeset(domain, ZoneIndex(remote_records), domain_config.record_groups)
+    for change in changeset:
+        print(change.sprint_with_domain(domain).replace('try ', '', 1), file=out)
+    if changeset:
+        names = touched_names(changeset)
+        plans[domain] = DomainPlan(domain, domain_config.account, domain_config.hash, changeset, sorted(names),
+                                   fingerprint(r for r in remote_records if r.name in names), snapshot.hash)
+
+
+def apply_plan(plan_path, workers=1, use_cache=True):
+    """
+    Carry out a saved plan. Instead of listing the zones again, only the records of the names a plan touches
+    are fetched, and a domain whose records changed since the plan is refused.
+    """
+    cfg_path, domain_plans = read_plan(plan_path)
+    with registry.phase('load_config'):
+        dns_config = load_dns_config_from_file(cfg_path, use_cache=use_cache, resolve_sources=False)
+    config_by_domain = {(d.account, d.domain): d for d in dns_config.domains}
+    planned = [config_by_domain[(p.account, p.domain)] for p in domain_plans
+               if (p.account, p.domain) in config_by_domain]
+    with registry.phase('build_clients'):
+        clients = build_dns_clients(dns_config, planned)
+    # the plan carries the values, the sources of the planned domains are only read to journal them as applied,
+    # and a domain whose sources cannot be read is applied without being journaled
+    failed = {}
+    with registry.phase('value_sources'):
+        resolved = resolve_value_sources(DnsConfig(dns_config.conf, planned), failed)
+    print_failed_sources(failed)
+    config_by_domain = {(d.account, d.domain): d for d in resolved.domains}
+    snapshots = SnapshotStore()
+    journal = StateJournal()
+
+    drifted = []
+    jobs = []
+    for domain_plan in domain_plans:
+        if domain_plan.account not in clients:
+            raise DnsManipulationException('domain {} of the plan is no longer in {}'.format(domain_plan.domain,
+                                                                                              cfg_path))
+        client = clients[domain_plan.account]
+        domain_config = config_by_domain.get((domain_plan.account, domain_plan.domain))
+        jobs.append((client.in_flight, functools.partial(_apply_domain_plan, client, domain_plan, domain_config,
+                                                         snapshots, journal, drifted)))
+    try:
+        run_domain_jobs(jobs, workers=workers)
+    finally:
+        journal.save()
+
+    if drifted:
+        raise DnsManipulationException('refused to apply the plan to drifted domains: {}, plan them again'.format(
+            ', '.join(sorted(drifted))))
+    print('Done.')
+
 
-            # create record if not exists
-            remote_records = upsert_records(client, domain, remote_records, local_records)
+def _apply_domain_plan(client, domain_plan: DomainPlan, domain_config: DomainConfig, snapshots, journal,
+                       drifted, out):
+    domain = domain_plan.domain
+    with registry.phase('fingerprint'):
+        records = fetch_named_records(client.client, domain, domain_plan.names)
+    if fingerprint(records) != domain_plan.fingerprint:
+        print('{}: records changed since the plan was made, skipped'.format(domain), file=out)
+        drifted.append(domain)
+        return
 
-            # delete record which record's value not present at config file
-            remote_records = cleanup_staled_records(client, domain, remote_records, local_records)
+    index = ZoneIndex(records)
+    bind_changes(domain_plan.changeset, index)
+    with registry.phase('apply'):
+        apply_changeset(client, domain_plan.changeset, index, out=out)
+
+    # the saved snapshot still describes the zone the plan was made from, bring it up to date
+    snapshot = snapshots.load(domain_plan.account, domain)
+    if snapshot is not None and snapshot.hash == domain_plan.remote_hash:
+        snapshot_index = ZoneIndex(snapshot.records)
+        patch_index(snapshot_index, domain_plan.changeset)
+        saved = snapshots.save(domain_plan.account, domain, snapshot_index.records())
+        if domain_config is not None and domain_config.hash == domain_plan.config_hash:
+            journal.record(domain_config, saved.hash)
+
+
+def watch_dns_config(cfg_path, workers=1, use_cache=True, debounce=DEFAULT_DEBOUNCE,
+                     poll_interval=DEFAULT_POLL_INTERVAL, shard=None):
+    """
+    Update every domain once, then keep the clients and the remote records of every domain in memory,
+    and reconcile the domains whose config entry changed each time the config file is saved
+    """
+    watcher = make_file_watcher(cfg_path, poll_interval)
+    snapshots = SnapshotStore()
+    journal = StateJournal()
+    warm = {}  # (account, domain) -> remote records after the last apply
+    dns_config, clients = None, {}
+    print('watching {} with {}'.format(cfg_path, type(watcher).__name__))
+
+    try:
+        while True:
+            try:
+                with registry.phase('load_config'):
+                    failed = {}
+                    new_config = load_dns_config_from_file(cfg_path, use_cache=use_cache, shard=shard, failed=failed)
+                # the domains whose sources cannot be read are skipped until they can be read again
+                print_failed_sources(failed)
+            except Exception as e:
+                if dns_config is None:
+                    raise
+                print('failed to load {}, keep the previous config: {}'.format(cfg_path, e))
+            else:
+                if dns_config is None or account_configs(new_config.conf) != account_configs(dns_config.conf):
+                    # credentials or client options changed, start over with new clients and fresh listings
+                    clients = {}
+                    warm.clear()
+                dns_config = new_config
+                try:
+                    _watch_update(dns_config, clients, snapshots, journal, warm, workers)
+                except Exception as e:
+                    print('update failed, retried on the next change: {}'.format(e))
+            sys.stdout.flush()
+            wait_for_change(watcher, debounce)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def _watch_update(dns_config: DnsConfig, clients: dict, snapshots: SnapshotStore, journal: StateJournal,
+                  warm: dict, workers: int):
+    # the first round reconciles every domain, later rounds the ones not applied as they are configured now
+    domains = [domain_config for domain_config in dns_config.domains
+               if (domain_config.account, domain_config.domain) not in warm or not journal.is_applied(domain_config)]
+    if not domains:
+        return
+    print('{} of {} domains changed'.format(len(domains), len(dns_config.domains)))
+
+    missing = [domain_config for domain_config in domains if domain_config.account not in clients]
+    with registry.phase('build_clients'):
+        clients.update(build_dns_clients(dns_config, missing))
+    with registry.phase('prefetch'):
+        prefetch_client_caches(missing, clients)
+
+    jobs = []
+    for domain_config in domains:
+        client = clients[domain_config.account]
+        jobs.append((client.in_flight,
+                     functools.partial(_watch_update_domain, client, domain_config, snapshots, journal, warm)))
+    try:
+        run_domain_jobs(jobs, workers=workers)
+    finally:
+        journal.save()
+    print('Done.')
 
+
+def _watch_update_domain(client, domain_config: DomainConfig, snapshots, journal, warm, out):
+    key = (domain_config.account, domain_config.domain)
+    remote_records = warm.pop(key, None)
+    _print_changed_blocks(journal, domain_config, out)
+    try:
+        _, remote_records = reconcile_domain(client, domain_config.domain, domain_config.record_groups,
+                                             out=out, remote_records=remote_records)
+    except Exception as e:
+        if remote_records is None:
+            raise
+        # the records kept in memory went stale, someone changed the zone elsewhere
+        print('{}: {}, retry with a fresh listing'.format(domain_config.domain, e), file=out)
+        _, remote_records = reconcile_domain(client, domain_config.domain, domain_config.record_groups, out=out)
+    snapshot = snapshots.save(domain_config.account, domain_config.domain, remote_records)
+    journal.record(domain_config, snapshot.hash)
+    warm[key] = remote_records
+
+
+def _configured_domain(dns_config: DnsConfig, domain: str) -> DomainConfig:
+    for domain_config in dns_config.domains:
+        if domain_config.domain == domain:
+            return domain_config
+    raise DnsManipulationException('domain {} is not configured, add it with its account to the config'.format(domain))
+
+
+def check_dns_config(cfg_path, workers=1, use_cache=True, use_async=False, shard=None, out=None) -> int:
+    """
+    Compare the managed records of every domain with the config and print a one line json report of the domains
+    that drifted or could not be checked. Returns the exit status: 0 in sync, 1 drifted, 2 failed.
+    A config that cannot be loaded, or clients that cannot be built, give a report of no domain with the error.
+    """
+    started_at = time.monotonic()
+    try:
+        domains, reports = _check_domains(cfg_path, workers, use_cache, use_async, shard)
+    except Exception as e:
+        report = drift_report(0, [], time.monotonic() - started_at, error=e)
+    else:
+        report = drift_report(len(domains), [reports[domain_config.domain] for domain_config in domains
+                                             if reports.get(domain_config.domain)], time.monotonic() - started_at)
+    print(json.dumps(report, separators=(',', ':')), file=out)
+    return exit_status(report)
+
+
+def _check_domains(cfg_path, workers, use_cache, use_async, shard):
+    failed = {}
+    with registry.phase('load_config'):
+        configured = load_dns_config_from_file(cfg_path, use_cache=use_cache, shard=shard, resolve_sources=False)
+        dns_config = resolve_value_sources(configured, failed)
+    with registry.phase('build_clients'):
+        clients = build_dns_clients(dns_config)
+    with registry.phase('prefetch'):
+        prefetch_client_caches(dns_config.domains, clients)
+    snapshots = SnapshotStore()
+    # a domain whose value_from sources cannot be read fails, the others are still checked
+    reports = {domain_config.domain: domain_report(domain_config.domain, domain_config.account,
+                                                   error=failed[domain_config.domain])
+               for domain_config in configured.domains if domain_config.domain in failed}
+
+    if use_async:
+        async_clients = build_async_dns_clients(clients)
+        try:
+            run_domain_jobs_async([functools.partial(_check_domain_async, async_clients[domain_config.account],
+                                                     domain_config, snapshots, reports)
+                                   for domain_config in dns_config.domains], workers=workers)
+        finally:
+            close_async_dns_clients(async_clients)
+    else:
+        jobs = []
+        for domain_config in dns_config.domains:
+            client = clients[domain_config.account]
+            jobs.append((client.in_flight,
+                         functools.partial(_check_domain, client, domain_config, snapshots, reports)))
+        run_domain_jobs(jobs, workers=workers)
+    return configured.domains, reports
+
+
+def _check_fetch_names(client, domain_config: DomainConfig, sizes):
+    # the sidecar of the snapshot only tells the largest name, which bounds the pages of every name
+    zone_size, largest_name = sizes
+    names = managed_names(domain_config.record_groups)
+    name_sizes = dict.fromkeys(names, largest_name or 0)
+    return names if prefers_filtered_fetch(client.client, names, zone_size, name_sizes) else None
+
+
+def _check_domain(client, domain_config: DomainConfig, snapshots, reports, out):
+    # a domain that cannot be checked is reported, the others are still checked
+    domain, account = domain_config.domain, domain_config.account
+    try:
+        check = DriftCheck(domain, domain_config.record_groups)
+        names = _check_fetch_names(client, domain_config, snapshots.sizes(account, domain))
+        with registry.phase('list'):
+            check.feed(iter_remote_records(client.client, domain) if names is None
+                       else fetch_named_records(client.client, domain, names))
+        with registry.phase('diff'):
+            changeset = check.changeset()
+    except Exception as e:
+        reports[domain] = domain_report(domain, account, error=e)
+        return
+    reports[domain] = domain_report(domain, account, changeset) if changeset else None
+
+
+async def _check_domain_async(client, domain_config: DomainConfig, snapshots, reports, out):
+    domain, account = domain_config.domain, domain_config.account
+    import asyncio
+    loop = asyncio.get_running_loop()
+    try:
+        check = DriftCheck(domain, domain_config.record_groups)
+        names = _check_fetch_names(client, domain_config,
+                                   await loop.run_in_executor(None, snapshots.sizes, account, domain))
+        with registry.phase('list'):
+            check.feed(await client.client.get_domain_records(domain) if names is None
+                       else await fetch_named_records_async(client.client, domain, names))
+        with registry.phase('diff'):
+            changeset = check.changeset()
+    except Exception as e:
+        reports[domain] = domain_report(domain, account, error=e)
+        return
+    reports[domain] = domain_report(domain, account, changeset) if changeset else None
+
+
+def export_zone(cfg_path, domain, out_path=None, use_cache=True):
+    """
+    Stream the remote records of a configured domain into a zone file, or to stdout without out_path
+    """
+    if not domain:
+        raise DnsManipulationException('name the domain to export with --domain')
+    with registry.phase('load_config'):
+        dns_config = load_dns_config_from_file(cfg_path, use_cache=use_cache, resolve_sources=False)
+    domain_config = _configured_domain(dns_config, domain)
+    client = build_dns_clients(dns_config, [domain_config])[domain_config.account]
+
+    with registry.phase('export'):
+        records = iter_remote_records(client.client, domain)
+        if out_path is None:
+            count = write_zone(sys.stdout, domain, records)
+        else:
+            # a listing or a record failing halfway leaves an existing zone file untouched
+            with open_atomic(out_path) as fp:
+                count = write_zone(fp, domain, records)
+    print('Exported {} records of {}'.format(count, domain), file=sys.stderr)
+
+
+def _keep_remote_proxied(record_groups: dict, remote_records: List[DnsRecord]):
+    """
+    A zone file has no proxied flag, keep the records that are proxied remotely proxied instead of turning them
+    into dns only ones
+    """
+    proxied = {(record.name, record.type) for record in remote_records if getattr(record, 'proxied', False)}
+    for key in proxied & set(record_groups):
+        record_groups[key] = [record.copy(proxied=True) for record in record_groups[key]]
+
+
+def import_zone(cfg_path, zone_path, domain=None, refresh=False, use_cache=True):
+    """
+    Reconcile a configured domain with the records of a zone file instead of its config entry.
+    Like with the config, names and types absent from the zone file are left alone.
+    """
+    if not zone_path:
+        raise DnsManipulationException('name the zone file to import with --zone-file')
+    if domain is None:
+        with open(zone_path) as fp:
+            domain = zone_file_origin(fp)
+        if domain is None:
+            raise DnsManipulationException('{} sets no $ORIGIN, name the domain with --domain'.format(zone_path))
+    with registry.phase('load_config'):
+        dns_config = load_dns_config_from_file(cfg_path, use_cache=use_cache, resolve_sources=False)
+    domain_config = _configured_domain(dns_config, domain)
+    plugin = get_vendor(domain_config.vendor)
+
+    record_groups = {}
+    with registry.phase('parse_zone'):
+        with open(zone_path) as fp:
+            for entry in iter_zone_records(fp, domain):
+                # the name servers of the zone itself are the vendor's
+                if entry[CFG_KEY_DNS_RECORD_RR] == '@' and entry[CFG_KEY_DNS_RECORD_TYPE] == 'NS':
+                    continue
+                for record in plugin.parse_records(entry):
+                    record_groups.setdefault((record.name, record.type), []).append(record)
+    print('Read {} records of {} from {}'.format(sum(len(g) for g in record_groups.values()), domain, zone_path))
+
+    with registry.phase('build_clients'):
+        client = build_dns_clients(dns_config, [domain_config])[domain_config.account]
+    if any(hasattr(group[0], 'proxied') for group in record_groups.values()):
+        with registry.phase('list'):
+            remote_records = fetch_named_records(client.client, domain, {name for name, _ in record_groups})
+        _keep_remote_proxied(record_groups, remote_records)
+    zone_config = DomainConfig(domain, domain_config.vendor, list(record_groups.values()),
+                               account=domain_config.account)
+    journal = StateJournal()
+    try:
+        _update_domain(client, zone_config, SnapshotStore(), journal, refresh, sys.stdout)
+    finally:
+        journal.save()
     print('Done.')
 
 
-def upsert_records(client, domain, remote_records, local_records):
-    has_diff = False
-    for local_record in local_records:
-        matches_remote_records = _find_matches_records(remote_records, local_record.name, local_record.type)
-        same_name_remote_records = _find_matches_records(remote_records, local_record.name)
-
-        value_match_record = next(
-            (r for r in matches_remote_records if _is_record_value_match_any(r, local_record.type, local_record.value)),
-            None)
-
-        if value_match_record is None:  # value not exist, create it
-            for same_name_remote_record in same_name_remote_records:  # resolve conflict record first
-                if has_conflict(same_name_remote_record, local_record):
-                    print('try delete old record due to conflict {}'
-                          .format(same_name_remote_record.sprint_with_domain(domain)))
-                    client.client.delete_domain_record(domain, same_name_remote_record)
-            print('try add record {}'.format(local_record.sprint_with_domain(domain)))
-            # create domain record
-            print(client.client.add_domain_record(domain, local_record))
-            has_diff = True
-        elif not value_match_record.equals(local_record):
-            # value matches but other configuration not equals, such as ttl, priority.
-            print('try update record {} => {}'.format(value_match_record.sprint_with_domain(domain),
-                                                      local_record.sprint_with_domain(domain)))
-            print(client.client.update_domain_record(domain, local_record))
-            has_diff = True
-
-        print('status now {}'.format(local_record.sprint_with_domain(domain)))
-
-    return client.client.get_domain_records(domain) if has_diff else remote_records
-
-
-def cleanup_staled_records(client, domain, remote_records, local_records):
-    local_values = {r.value for r in local_records}
-    has_diff = False
-    for record in local_records:
-        matches_remote_records = _find_matches_records(remote_records, record.name, record.type)
-        for matches_remote_record in matches_remote_records:
-            if _is_record_value_match_any(matches_remote_record, record.type, local_values):
-                continue
-            print('try delete old record {}'.format(matches_remote_record.sprint_with_domain(domain)))
-            print(client.client.delete_domain_record(domain, matches_remote_record))
-            has_diff = True
-
-    return client.client.get_domain_records(domain) if has_diff else remote_records
-
-
-def show_online_config(cfg_path):
-    dns_conf = load_dns_conf_from_file(cfg_path)
-    clients = build_dns_clients(dns_conf)
-
-    for config in dns_conf.get(CFG_KEY_DNS):
-        domain = config.get(CFG_KEY_DNS_DOMAIN)
-        client = clients[config.get(CFG_KEY_DNS_VENDOR)]
-        online_records = client.client.get_domain_records(domain)
-
-        for r in config.get(CFG_KEY_DNS_RECORDS):
-            record = client.record_parser(r)
-            _print_matches_records(online_records, domain, record[0].name, record[0].type)
+def show_online_config(cfg_path, workers=1, max_age=None, use_cache=True, use_async=False, shard=None):
+    with registry.phase('load_config'):
+        # status only prints the remote records of the configured names, it never reads value_from sources
+        dns_config = load_dns_config_from_file(cfg_path, use_cache=use_cache, shard=shard, resolve_sources=False)
+    snapshots = SnapshotStore()
+    fresh = {}
+    if max_age is not None:
+        with registry.phase('snapshots'):
+            for domain_config in dns_config.domains:
+                snapshot = snapshots.load(domain_config.account, domain_config.domain, max_age=max_age)
+                if snapshot is not None:
+                    fresh[domain_config.domain] = snapshot
+    # clients, and so vendor sdks, are only built for the domains that have to be listed
+    stale = [domain_config for domain_config in dns_config.domains if domain_config.domain not in fresh]
+    clients = {}
+    if stale:
+        with registry.phase('build_clients'):
+            clients = build_dns_clients(dns_config, stale)
+        with registry.phase('prefetch'):
+            prefetch_client_caches(stale, clients)
+
+    if use_async:
+        async_clients = build_async_dns_clients(clients)
+        try:
+            run_domain_jobs_async([functools.partial(_show_domain_async, async_clients.get(domain_config.account),
+                                                     domain_config, snapshots, fresh.get(domain_config.domain))
+                                   for domain_config in dns_config.domains], workers=workers)
+        finally:
+            close_async_dns_clients(async_clients)
+    else:
+        jobs = []
+        snapshot_reads = InFlightLimit()
+        for domain_config in dns_config.domains:
+            snapshot = fresh.get(domain_config.domain)
+            client = clients[domain_config.account] if snapshot is None else None
+            jobs.append((snapshot_reads if client is None else client.in_flight,
+                         functools.partial(_show_domain, client, domain_config, snapshots, snapshot)))
+        run_domain_jobs(jobs, workers=workers)
 
     print('End.')
 
 
-def _print_matches_records(records, domain, rr, record_type):
-    matches_records = _find_matches_records(records, rr, record_type)
-    if not matches_records:
-        print('status now [{}] {}.{} -> nil'.format(record_type, rr, domain))
+def _show_domain(client, domain_config: DomainConfig, snapshots, snapshot, out):
+    if snapshot is not None:
+        online_index = ZoneIndex(snapshot.records)
+    else:
+        with registry.phase('list'):
+            online_index = ZoneIndex(iter_remote_records(client.client, domain_config.domain))
+        snapshots.save(domain_config.account, domain_config.domain, online_index.records())
+    _print_domain_status(domain_config, online_index, out)
 
-    for record in matches_records:
-        print('status now {}'.format(record.sprint_with_domain(domain)))
 
+async def _show_domain_async(client, domain_config: DomainConfig, snapshots, snapshot, out):
+    if snapshot is not None:
+        online_records = snapshot.records
+    else:
+        with registry.phase('list'):
+            online_records = await client.client.get_domain_records(domain_config.domain)
+        import asyncio
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, snapshots.save, domain_config.account, domain_config.domain,
+                                   online_records)
+    _print_domain_status(domain_config, ZoneIndex(online_records), out)
 
-def has_conflict(old_record: DnsRecord, new_record: DnsRecord) -> bool:
-    if new_record.type == 'CNAME':
-        return old_record.type in ['CNAME', 'A', 'AAAA']
-    elif new_record.type in ['A', 'AAAA']:
-        return old_record.type == 'CNAME'
-    return new_record.type == old_record.type and new_record.value == old_record.value
 
+def _print_domain_status(domain_config: DomainConfig, online_index: ZoneIndex, out):
+    for records in domain_config.record_groups:
+        _print_matches_records(online_index, domain_config.domain, records[0].name, records[0].type, out=out)
 
-def _find_matches_records(records, rr, record_type=None) -> List[DnsRecord]:
-    return [record for record in records if record.name == rr
-            and (record_type is None or record.type == record_type)]
 
+def _print_matches_records(index: ZoneIndex, domain, rr, record_type, out=None):
+    matches_records = index.find(rr, record_type)
+    if not matches_records:
+        print('status now [{}] {}.{} -> nil'.format(record_type, rr, domain), file=out)
 
-def _is_record_value_match_any(record: DnsRecord, record_type: str, values: Set[str]):
-    if record.value in values:
-        return True
-    if record_type == 'CNAME':
-        return any(remove_suffix(record.value, '.') == remove_suffix(value, '.') for value in values)
-    return False
+    for record in matches_records:
+        print('status now {}'.format(record.sprint_with_domain(domain)), file=out)
 
 
 GUIDE_DOC = '''
 Usage:
-    dns-manager <command> [/path/to/dns/config]
+    dns-manager <command> [/path/to/dns/config] [options]
 
 Commands:
     status    show current dns status
+    check     compare the managed records of every domain with the config, print a json report of the drifted
+              ones and exit 1 on drift, 2 when some domain could not be checked
     update    load dns config from local, flush local config to name server
+    plan      list every domain and print the changes update would make, save them with -o <plan.json>
+    apply     carry out a saved plan: dns-manager apply <plan.json>, domains changed since the plan are refused
+    export    write the remote records of a domain as a zone file: --domain <domain> [-o <file>], stdout by default
+    import    reconcile a domain with the records of a zone file: --zone-file <file> [--domain <domain>]
+    ddns      update the domains whose value_from records read new values since they were last applied
+    watch     update once, then update the changed domains whenever the config file is saved
+
+Options:
+    -o <path>        plan: save the plan to path, export: write the zone file to path
+    --domain <domain>
+                     export, import: the configured domain to work on, import defaults to the $ORIGIN of the file
+    --zone-file <path>
+                     import: the zone file to read
+    --changed-only   update: skip domains whose config and last known remote state did not change since they
+                     were last updated
+    --full           update: reconcile every domain, even with --changed-only
+    --refresh        update: list each changed domain once more after applying, to confirm its records
+    --verify         update: after applying, query the authoritative nameservers of the changed names until they
+                     serve the new values, and fail when some do not within --verify-timeout
+    --verify-timeout <s>
+                     update: seconds to wait for the nameservers with --verify, 120 by default
+    --nameserver <host[:port]>
+                     update: query this nameserver with --verify instead of looking up the NS records of the
+                     domains, may be given more than once
+    --workers <n>    reconcile up to n domains concurrently, bounded by max_in_flight of each account
+    --shard <i/n>    work on shard i of n only, domains are split by a hash of their name, so n hosts running
+                     shards 1/n to n/n cover every domain once
+    --debounce <s>   watch: wait until the config file was left untouched for s seconds, 0.2 by default
+    --poll-interval <s>
+                     watch: seconds between checks of the config file where inotify is not available, 1 by default
+    --max-age <s>    status: answer from the local snapshot of a domain when it was fetched within s seconds
+    --no-config-cache
+                     parse the config file again instead of loading its compiled cache
+    --async          run the domains on one event loop, vendor calls of an account share its connection pool
+    --profile        print call counts, latencies and phase durations of the run to stderr as json
+    --metrics-out <path>
+                     write the same metrics to path, as a prometheus textfile when it ends with .prom
 '''
 
 
+def _parse_nameserver(spec):
+    from dnsmanager.verify import parse_server
+    return parse_server(spec)
+
+
+def _parse_args(params):
+    parser = argparse.ArgumentParser(prog='dns-manager', usage=GUIDE_DOC, add_help=False)
+    parser.add_argument('command')
+    parser.add_argument('cfg_path')
+    parser.add_argument('-o', '--out')
+    parser.add_argument('--domain')
+    parser.add_argument('--zone-file')
+    parser.add_argument('--changed-only', action='store_true')
+    parser.add_argument('--full', action='store_true')
+    parser.add_argument('--refresh', action='store_true')
+    parser.add_argument('--verify', action='store_true')
+    parser.add_argument('--verify-timeout', type=float)
+    parser.add_argument('--nameserver', dest='nameservers', action='append', type=_parse_nameserver)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--shard')
+    parser.add_argument('--debounce', type=float, default=DEFAULT_DEBOUNCE)
+    parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL)
+    parser.add_argument('--max-age', type=float, default=None)
+    parser.add_argument('--no-config-cache', action='store_true')
+    parser.add_argument('--async', dest='use_async', action='store_true')
+    parser.add_argument('--profile', action='store_true')
+    parser.add_argument('--metrics-out')
+    return parser.parse_args(params)
+
+
 def main():
     params = sys.argv[1:]
 
@@ -188,15 +859,46 @@ def main():
         print(GUIDE_DOC)
         return
 
-    command = params[0]
-    cfg_path = params[1]
-
-    if command == 'update':
-        load_and_update_dns_config(cfg_path)
-    elif command == 'status':
-        show_online_config(cfg_path)
-    else:
-        print('unknown command', command)
+    args = _parse_args(params)
+    command = args.command
+    cfg_path = args.cfg_path
+
+    shard = parse_shard(args.shard) if args.shard else None
+    try:
+        if command == 'update':
+            load_and_update_dns_config(cfg_path, refresh=args.refresh, workers=args.workers,
+                                       use_cache=not args.no_config_cache, use_async=args.use_async,
+                                       changed_only=args.changed_only and not args.full, shard=shard,
+                                       verify=args.verify, verify_timeout=args.verify_timeout,
+                                       nameservers=args.nameservers)
+        elif command == 'plan':
+            plan_dns_config(cfg_path, out_path=args.out, workers=args.workers, use_cache=not args.no_config_cache,
+                            shard=shard)
+        elif command == 'apply':
+            apply_plan(cfg_path, workers=args.workers, use_cache=not args.no_config_cache)
+        elif command == 'export':
+            export_zone(cfg_path, args.domain, out_path=args.out, use_cache=not args.no_config_cache)
+        elif command == 'import':
+            import_zone(cfg_path, args.zone_file, domain=args.domain, refresh=args.refresh,
+                        use_cache=not args.no_config_cache)
+        elif command == 'ddns':
+            update_dynamic_dns(cfg_path, workers=args.workers, use_cache=not args.no_config_cache, shard=shard)
+        elif command == 'watch':
+            watch_dns_config(cfg_path, workers=args.workers, use_cache=not args.no_config_cache,
+                             debounce=args.debounce, poll_interval=args.poll_interval, shard=shard)
+        elif command == 'check':
+            sys.exit(check_dns_config(cfg_path, workers=args.workers, use_cache=not args.no_config_cache,
+                                      use_async=args.use_async, shard=shard))
+        elif command == 'status':
+            show_online_config(cfg_path, workers=args.workers, max_age=args.max_age,
+                               use_cache=not args.no_config_cache, use_async=args.use_async, shard=shard)
+        else:
+            print('unknown command', command)
+    finally:
+        if args.profile:
+            print(json.dumps(registry.to_dict(), indent=2), file=sys.stderr)
+        if args.metrics_out:
+            registry.write(args.metrics_out)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import hashlib
+from typing import Iterable, List, Optional
+
+from dnsmanager.model import DnsRecord, ChangeSet
+from dnsmanager.plan import change_to_dict
+from dnsmanager.reconciler import ZoneIndex, compute_changeset
+
+# exit status of check: every domain matches its config, some drifted, some could not be checked
+EXIT_IN_SYNC = 0
+EXIT_DRIFT = 1
+EXIT_FAILED = 2
+
+
+def _digest(keys: Iterable[tuple]) -> str:
+    digest = hashlib.sha256()
+    for line in sorted(repr(key) for key in keys):
+        digest.update(line.encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+class DriftCheck:
+    """
+    Compares the remote records of one domain with its config as they stream in, by fingerprints of the
+    managed records normalized with drift_key. Only records of managed names are kept, and they are diffed
+    record by record only when the fingerprints differ.
+    """
+
+    def __init__(self, domain: str, record_groups: List[List[DnsRecord]]):
+        self.domain = domain
+        self.record_groups = record_groups
+        # the diff matches remote records against the first config record of each identity key
+        self._local = {}
+        for records in record_groups:
+            for record in records:
+                self._local.setdefault(record.key, record)
+        self._slots = {(record.name, record.type) for record in self._local.values()}
+        self._names = {name for name, _ in self._slots}
+        self.fingerprint = _digest({record.drift_key() for records in record_groups for record in records})
+        self.records = []  # type: List[DnsRecord]
+        self._remote_keys = set()
+        self._seen = set()
+
+    def feed(self, records: Iterable[DnsRecord]) -> 'DriftCheck':
+        for record in records:
+            # conflicting records of other types under a managed name are part of the diff too
+            if record.name not in self._names:
+                continue
+            self.records.append(record)
+            key = record.key
+            # like the index of the diff, duplicates of a value are not looked at
+            if (record.name, record.type) in self._slots and key not in self._seen:
+                self._seen.add(key)
+                self._remote_keys.add(record.drift_key(self._local.get(key)))
+        return self
+
+    @property
+    def remote_fingerprint(self) -> str:
+        return _digest(self._remote_keys)
+
+    def drifted(self) -> bool:
+        return self.remote_fingerprint != self.fingerprint
+
+    def changeset(self) -> ChangeSet:
+        """
+        The changes update would make, empty without diffing when the fingerprints match
+        """
+        if not self.drifted():
+            return ChangeSet(self.domain)
+        return compute_changeset(self.domain, ZoneIndex(self.records), self.record_groups)
+
+
+def _error_message(error: Exception) -> str:
+    return '{}: {}'.format(type(error).__name__, error)
+
+
+def domain_report(domain: str, account: str, changeset: Optional[ChangeSet] = None, error=None) -> dict:
+    report = {'domain': domain, 'account': account}
+    if error is not None:
+        report['error'] = _error_message(error)
+    else:
+        report['changes'] = [change_to_dict(change) for change in changeset]
+    return report
+
+
+def drift_report(checked: int, domains: List[dict], elapsed: float, error=None) -> dict:
+    """
+    Summary of a check run, listing only the domains that drifted or failed,
+    with the error of a run that failed as a whole
+    """
+    report = {
+        'checked': checked,
+        'drifted': sum(1 for domain in domains if domain.get('changes')),
+        'failed': sum(1 for domain in domains if 'error' in domain),
+        'elapsed': round(elapsed, 3),
+        'domains': domains,
+    }
+    if error is not None:
+        report['error'] = _error_message(error)
+    return report
+
+
+def exit_status(report: dict) -> int:
+    if report['failed'] or 'error' in report:
+        return EXIT_FAILED
+    return EXIT_DRIFT if report['drifted'] else EXIT_IN_SYNC
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import io
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Iterable, Tuple
+
+
+class InFlightLimit:
+    """
+    Caps how many domains of one vendor account are being worked on at the same time, unlimited when limit is None
+    """
+
+    def __init__(self, limit: int = None):
+        self.limit = limit
+
+
+def run_domain_jobs(jobs: Iterable[Tuple[InFlightLimit, Callable]], workers: int = 1, out=None):
+    """
+    Run one job per domain, each job is called with the stream it should print to.
+    With more than one worker, jobs run on a thread pool. A job is only handed to the pool once its account
+    has a free in flight slot, the earliest queued job of such an account first, so domains of a capped account
+    wait in their own queue instead of holding workers the other accounts could use. The output of every
+    domain is buffered and written out in one piece once the domain is done, so lines of different domains
+    never interleave. The first failure is raised after all jobs finished, with one worker too.
+    """
+    if workers <= 1:
+        error = None
+        for _, job in jobs:
+            try:
+                job(out)
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return
+
+    out = out if out is not None else sys.stdout
+    lock = threading.Lock()
+    dispatch = threading.Condition()
+    queues = {}
+    active = {}
+    futures = []
+    for index, (in_flight, job) in enumerate(jobs):
+        queues.setdefault(in_flight, deque()).append((index, job))
+        active[in_flight] = 0
+        futures.append(None)
+
+    def run(in_flight, job):
+        buf = io.StringIO()
+        try:
+            job(buf)
+        finally:
+            with lock:
+                out.write(buf.getvalue())
+                out.flush()
+            with dispatch:
+                active[in_flight] -= 1
+                dispatch.notify()
+
+    def next_account():
+        if sum(active.values()) >= workers:
+            return None
+        ready = [in_flight for in_flight in queues if not in_flight.limit or active[in_flight] < in_flight.limit]
+        return min(ready, key=lambda in_flight: queues[in_flight][0][0], default=None)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        with dispatch:
+            while queues:
+                in_flight = next_account()
+                if in_flight is None:
+                    dispatch.wait()
+                    continue
+                index, job = queues[in_flight].popleft()
+                if not queues[in_flight]:
+                    del queues[in_flight]
+                active[in_flight] += 1
+                futures[index] = pool.submit(run, in_flight, job)
+
+    for future in futures:
+        future.result()
+
+
+def run_domain_jobs_async(jobs: Iterable[Callable[..., Awaitable]], workers: int = 1, out=None):
+    """
+    Run one coroutine job per domain on a single event loop, up to `workers` domains at a time.
+    Calls in flight per vendor account are bounded by its AsyncDnsOps. Output is buffered per domain
+    like run_domain_jobs, and the first failure is raised after all jobs finished.
+    """
+    import asyncio
+    out = out if out is not None else sys.stdout
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(max(1, workers))
+
+        async def run(job):
+            buf = io.StringIO()
+            try:
+                async with semaphore:
+                    await job(buf)
+            finally:
+                out.write(buf.getvalue())
+                out.flush()
+
+        return await asyncio.gather(*[run(job) for job in jobs], return_exceptions=True)
+
+    for result in asyncio.run(run_all()):
+        if isinstance(result, BaseException):
+            raise result
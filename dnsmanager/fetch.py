@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import math
+from typing import Iterable, List, Mapping, Optional, Set
+
+from dnsmanager.model import DnsRecord
+
+# records per page of a full listing, for ops that do not tell their own
+DEFAULT_LIST_PAGE_SIZE = 100
+# share of a call that transferring one listed record is worth, so a listing of a few large pages still counts
+# the bandwidth it takes
+LISTED_RECORD_COST = 0.01
+
+
+def managed_names(record_groups: Iterable[List[DnsRecord]]) -> Set[str]:
+    """
+    Names of the records a domain config manages, the diff only looks at remote records of these names
+    """
+    return {record.name for records in record_groups for record in records}
+
+
+def _page_count(ops, size: int) -> int:
+    return max(1, math.ceil(size / getattr(ops, 'LIST_PAGE_SIZE', DEFAULT_LIST_PAGE_SIZE)))
+
+
+def listing_cost(ops, zone_size: int) -> float:
+    return _page_count(ops, zone_size) + zone_size * LISTED_RECORD_COST
+
+
+def filtered_fetch_cost(ops, names: Set[str], name_sizes: Mapping[str, int] = None) -> int:
+    """
+    Calls of one filtered query per name, a name with more records than a page holds takes a call per page.
+    name_sizes maps names to their record count, names it does not know take one call.
+    """
+    name_sizes = name_sizes or {}
+    return sum(_page_count(ops, name_sizes.get(name, 0)) for name in names)
+
+
+def prefers_filtered_fetch(ops, names: Set[str], zone_size: Optional[int],
+                           name_sizes: Mapping[str, int] = None) -> bool:
+    """
+    True when one filtered query per name is cheaper than listing the zone, counted in calls.
+    Zones of unknown size are listed, which tells their size for the next run.
+    """
+    if zone_size is None or getattr(ops, 'get_records_by_name', None) is None:
+        return False
+    return filtered_fetch_cost(ops, names, name_sizes) < listing_cost(ops, zone_size)
+
+
+def iter_remote_records(ops, domain: str) -> Iterable[DnsRecord]:
+    """
+    Records of a domain as a stream when the ops can page through them, as a list otherwise
+    """
+    iter_domain_records = getattr(ops, 'iter_domain_records', None)
+    if iter_domain_records is None:
+        return ops.get_domain_records(domain)
+    return iter_domain_records(domain)
+
+
+def fetch_named_records(ops, domain: str, names: Iterable[str]) -> List[DnsRecord]:
+    """
+    Remote records of the given names, with one filtered query per name when the ops can filter by name,
+    with a single listing otherwise
+    """
+    names = set(names)
+    get_records_by_name = getattr(ops, 'get_records_by_name', None)
+    if get_records_by_name is None:
+        return [record for record in ops.get_domain_records(domain) if record.name in names]
+    records = []
+    for name in sorted(names):
+        records += get_records_by_name(domain, name)
+    return records
+
+
+async def fetch_named_records_async(ops, domain: str, names: Iterable[str]) -> List[DnsRecord]:
+    """
+    fetch_named_records for AsyncDnsOps
+    """
+    names = set(names)
+    get_records_by_name = getattr(ops, 'get_records_by_name', None)
+    if get_records_by_name is None:
+        return [record for record in await ops.get_domain_records(domain) if record.name in names]
+    records = []
+    for name in sorted(names):
+        records += await get_records_by_name(domain, name)
+    return records
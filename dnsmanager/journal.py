@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import os
+import threading
+import time
+from typing import Optional
+
+from dnsmanager.config import DomainConfig
+from dnsmanager.utils import default_cache_dir, read_json, write_json_atomic
+
+# bump when the layout of the journal changes, older journals are then ignored
+JOURNAL_FORMAT = 1
+
+
+class StateJournal:
+    """
+    What every domain looked like after its last successful update: the hash of its config entry and of
+    each record block, and the content hash of the remote snapshot saved afterwards.
+    Kept in one json file for all config files, keyed by account and domain.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or os.path.join(default_cache_dir(), 'journal.json')
+        self._lock = threading.Lock()
+        data = read_json(self.path) or {}
+        self._domains = data.get('domains', {}) if data.get('format') == JOURNAL_FORMAT else {}
+
+    @staticmethod
+    def _key(account: str, domain: str) -> str:
+        return '{}/{}'.format(account, domain)
+
+    def get(self, account: str, domain: str) -> Optional[dict]:
+        with self._lock:
+            return self._domains.get(self._key(account, domain))
+
+    def is_applied(self, domain_config: DomainConfig) -> bool:
+        """
+        True when the last successful update applied the config entry as it is now
+        """
+        entry = self.get(domain_config.account, domain_config.domain)
+        return entry is not None and entry['config_hash'] == domain_config.hash
+
+    def is_unchanged(self, domain_config: DomainConfig, remote_hash: Optional[str]) -> bool:
+        """
+        True when the config entry was applied as is, and the last known remote state is the one left by that update
+        """
+        entry = self.get(domain_config.account, domain_config.domain)
+        return self.is_applied(domain_config) and remote_hash is not None and entry['remote_hash'] == remote_hash
+
+    def changed_blocks(self, domain_config: DomainConfig) -> Optional[int]:
+        """
+        Number of record blocks not applied as they are now, None when the domain was never applied
+        """
+        entry = self.get(domain_config.account, domain_config.domain)
+        if entry is None:
+            return None
+        applied = set(entry['blocks'])
+        return sum(1 for block_hash in domain_config.block_hashes if block_hash not in applied)
+
+    def record(self, domain_config: DomainConfig, remote_hash: str):
+        with self._lock:
+            self._domains[self._key(domain_config.account, domain_config.domain)] = {
+                'config_hash': domain_config.hash,
+                'blocks': domain_config.block_hashes,
+                'remote_hash': remote_hash,
+                'applied_at': time.time(),
+            }
+
+    def save(self):
+        with self._lock:
+            write_json_atomic(self.path, {'format': JOURNAL_FORMAT, 'domains': self._domains})
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import json
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# ops methods that talk to the vendor, timed by InstrumentedOps and awaitable through AsyncDnsOps
+INSTRUMENTED_METHODS = (
+    'get_domain_records',
+    'get_records_by_name',
+    'add_domain_record',
+    'update_domain_record',
+    'delete_domain_record',
+    'apply_changeset',
+    'prefetch_zone_ids',
+    'desc_domain_record',
+)
+# ops methods that stream from the vendor, timed by InstrumentedOps until the stream is used up
+INSTRUMENTED_GENERATORS = (
+    'iter_domain_records',
+)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self) -> dict:
+        cumulative, total = {}, 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            cumulative['+Inf' if bound == float('inf') else repr(bound)] = total
+        return {'count': self.count, 'sum': self.sum, 'buckets': cumulative}
+
+
+class Metrics:
+    """
+    Call counts, latency histograms and retries of vendor calls, and durations of the phases of a run
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = {}
+        self.errors = Counter()
+        self.requests = {}
+        self.retries = Counter()
+        self.phases = {}
+
+    def observe_call(self, vendor: str, op: str, seconds: float, error: bool = False):
+        with self._lock:
+            self.calls.setdefault((vendor, op), Histogram()).observe(seconds)
+            if error:
+                self.errors[(vendor, op)] += 1
+
+    def observe_request(self, vendor: str, seconds: float):
+        with self._lock:
+            self.requests.setdefault(vendor, Histogram()).observe(seconds)
+
+    def observe_retry(self, vendor: str):
+        with self._lock:
+            self.retries[vendor] += 1
+
+    @contextmanager
+    def phase(self, name: str):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started_at
+            with self._lock:
+                self.phases.setdefault(name, Histogram()).observe(seconds)
+
+    def instrument(self, ops, vendor: str):
+        return InstrumentedOps(ops, vendor, self)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'calls': [dict(vendor=vendor, op=op, errors=self.errors[(vendor, op)], **histogram.to_dict())
+                          for (vendor, op), histogram in sorted(self.calls.items())],
+                'requests': [dict(vendor=vendor, retries=self.retries[vendor], **histogram.to_dict())
+                             for vendor, histogram in sorted(self.requests.items())],
+                'phases': [dict(phase=name, count=histogram.count, sum=histogram.sum)
+                           for name, histogram in sorted(self.phases.items())],
+            }
+
+    def to_prometheus(self) -> str:
+        data = self.to_dict()
+        lines = []
+
+        def histogram(metric, help_text, samples):
+            lines.append('# HELP {} {}'.format(metric, help_text))
+            lines.append('# TYPE {} histogram'.format(metric))
+            for labels, sample in samples:
+                for bound, count in sample['buckets'].items():
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(metric, labels, bound, count))
+                lines.append('{}_sum{{{}}} {}'.format(metric, labels, sample['sum']))
+                lines.append('{}_count{{{}}} {}'.format(metric, labels, sample['count']))
+
+        def counter(metric, help_text, samples):
+            lines.append('# HELP {} {}'.format(metric, help_text))
+            lines.append('# TYPE {} counter'.format(metric))
+            for labels, value in samples:
+                lines.append('{}{{{}}} {}'.format(metric, labels, value))
+
+        histogram('dns_manager_vendor_call_duration_seconds', 'Duration of dns ops calls by vendor and operation.',
+                  [('vendor="{}",op="{}"'.format(c['vendor'], c['op']), c) for c in data['calls']])
+        counter('dns_manager_vendor_call_errors_total', 'Failed dns ops calls by vendor and operation.',
+                [('vendor="{}",op="{}"'.format(c['vendor'], c['op']), c['errors']) for c in data['calls']])
+        histogram('dns_manager_vendor_request_duration_seconds', 'Duration of vendor api requests, retries included.',
+                  [('vendor="{}"'.format(r['vendor']), r) for r in data['requests']])
+        counter('dns_manager_vendor_retries_total', 'Throttled vendor api requests that were retried.',
+                [('vendor="{}"'.format(r['vendor']), r['retries']) for r in data['requests']])
+        lines.append('# HELP dns_manager_phase_duration_seconds Time spent in each phase of a run.')
+        lines.append('# TYPE dns_manager_phase_duration_seconds summary')
+        for p in data['phases']:
+            lines.append('dns_manager_phase_duration_seconds_sum{{phase="{}"}} {}'.format(p['phase'], p['sum']))
+            lines.append('dns_manager_phase_duration_seconds_count{{phase="{}"}} {}'.format(p['phase'], p['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str):
+        """
+        Write a prometheus textfile when the path ends with .prom, json otherwise
+        """
+        content = self.to_prometheus() if path.endswith('.prom') else json.dumps(self.to_dict(), indent=2)
+        with open(path, 'w') as fp:
+            fp.write(content)
+
+
+class InstrumentedOps:
+    """
+    Proxy of a vendor ops object that times its vendor calls and the api requests of its scheduler
+    """
+
+    def __init__(self, ops, vendor: str, metrics: Metrics):
+        self._ops = ops
+        self._vendor = vendor
+        self._metrics = metrics
+        scheduler = getattr(ops, 'scheduler', None)
+        if scheduler is not None:
+            scheduler.on_request = lambda seconds, error: metrics.observe_request(vendor, seconds)
+            scheduler.on_retry = lambda error, delay: metrics.observe_retry(vendor)
+
+    def __getattr__(self, name):
+        attr = getattr(self._ops, name)
+        if name in INSTRUMENTED_GENERATORS:
+            return self._timed_generator(name, attr)
+        if name not in INSTRUMENTED_METHODS:
+            return attr
+
+        def timed(*args, **kwargs):
+            started_at = time.perf_counter()
+            error = True
+            try:
+                result = attr(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                self._metrics.observe_call(self._vendor, name, time.perf_counter() - started_at, error)
+
+        return timed
+
+    def _timed_generator(self, name: str, attr):
+        # the time covers the whole stream, pages fetched while the consumer works on the records included
+        def timed(*args, **kwargs):
+            started_at = time.perf_counter()
+            error = False
+            try:
+                yield from attr(*args, **kwargs)
+            except Exception:
+                error = True
+                raise
+            finally:
+                self._metrics.observe_call(self._vendor, name, time.perf_counter() - started_at, error)
+
+        return timed
+
+
+# metrics of the current process, reported by --profile and --metrics-out
+registry = Metrics()
@@ -1,17 +1,25 @@
 #!/usr/bin/env python
 # coding=utf-8
+import operator
 from typing import List
 from .utils import remove_suffix
 
 CFG_KEY_CLIENTS = 'clients'
+CFG_KEY_ACCOUNTS = 'accounts'
+CFG_KEY_ACCOUNT_VENDOR = 'vendor'
+CFG_KEY_CLIENT_MAX_IN_FLIGHT = 'max_in_flight'
+# calls of one client in flight with --async when its max_in_flight is absent, also its http pool size
+DEFAULT_MAX_IN_FLIGHT = 16
 
 CFG_KEY_DNS = 'dns'
 CFG_KEY_DNS_DOMAIN = 'domain'
 CFG_KEY_DNS_VENDOR = 'vendor'
+CFG_KEY_DNS_ACCOUNT = 'account'
 CFG_KEY_DNS_RECORDS = 'records'
 CFG_KEY_DNS_RECORD_RR = 'rr'
 CFG_KEY_DNS_RECORD_TYPE = 'type'
 CFG_KEY_DNS_RECORD_VALUE = 'value'
+CFG_KEY_DNS_RECORD_VALUE_FROM = 'value_from'
 CFG_KEY_DNS_RECORD_TTL = 'ttl'
 
 # Cloudflare DNS
@@ -23,38 +31,114 @@ CFG_KEY_DNS_RECORD_NC_MX_PREF = 'mx_pref'
 
 DEFAULT_DNS_TTL = 300
 
+ACTION_ADD = 'add'
+ACTION_UPDATE = 'update'
+ACTION_DELETE = 'delete'
+
+
+def normalize_record_value(record_type: str, value: str) -> str:
+    if record_type == 'CNAME' and value is not None:
+        return remove_suffix(value, '.')
+    return value
+
+
+# read-only fields of DnsRecord and the slots behind them
+_IDENTITY_SLOTS = {'name': '_name', 'type': '_type', 'value': '_value'}
+
 
 class DnsRecord:
-    id = None
-    name = str
-    type = str
-    value = str
-    ttl = int
+    """
+    DNS record, hashed and compared by its identity key (name, type, normalized value),
+    so sets of records tell which values are missing or staled. Use `equals` to compare every field.
+    The identity fields are read-only, the key is computed once, use `copy` to change them.
+    """
+    __slots__ = ('id', '_name', '_type', '_value', 'ttl', '_key')
+
+    KIND = 'dns'
+    FIELDS = ('id', 'name', 'type', 'value', 'ttl')
 
     def __init__(self, id=None, name=None, type=None, value=None, ttl=None):
         self.id = id
-        self.name = name
-        self.type = type
-        self.value = value
+        self._name = name
+        self._type = type
+        self._value = value
         self.ttl = ttl
+        # only CNAME values are normalized, skip the call for the others
+        self._key = (name, type, normalize_record_value(type, value) if type == 'CNAME' else value)
+
+    name = property(operator.attrgetter('_name'))
+    type = property(operator.attrgetter('_type'))
+    value = property(operator.attrgetter('_value'))
+
+    @property
+    def key(self) -> tuple:
+        return self._key
+
+    @property
+    def normalized_value(self) -> str:
+        return self.key[2]
+
+    def __getstate__(self):
+        return tuple(getattr(self, field) for field in self.FIELDS)
+
+    def __setstate__(self, state):
+        for field, value in zip(self.FIELDS, state):
+            setattr(self, _IDENTITY_SLOTS.get(field, field), value)
+        self._key = (self._name, self._type, normalize_record_value(self._type, self._value))
+
+    def __eq__(self, other):
+        if not isinstance(other, DnsRecord):
+            return NotImplemented
+        return self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join('{}={!r}'.format(f, getattr(self, f))
+                                                              for f in self.FIELDS))
 
     def sprint_with_domain(self, domain: str) -> str:
         return '[{}] {}.{} -> {} TTL {}'.format(self.type, self.name, domain, self.value, self.ttl)
 
+    def copy(self, **changes):
+        fields = {field: getattr(self, field) for field in self.FIELDS}
+        fields.update(changes)
+        return type(self)(**fields)
+
+    def to_dict(self) -> dict:
+        data = {'kind': self.KIND}
+        for field in self.FIELDS:
+            data[field] = getattr(self, field)
+        return data
+
     def equals(self, other) -> bool:
         return self._matches(other)
 
     def _matches(self, other, bypass_ttl_check=False) -> bool:
-        return self.name == other.name and self.type == other.type \
-            and (self.value == other.value
-                 or self.type == 'CNAME' and remove_suffix(self.value, '.') == remove_suffix(other.value, '.')) \
+        return self.key == other.key \
             and (bypass_ttl_check or self.ttl is None or other.ttl is None or self.ttl == other.ttl)
 
+    def drift_key(self, local: 'DnsRecord' = None) -> tuple:
+        """
+        What equals compares, as a tuple: a remote record gives the same tuple for the config record local
+        as local gives on its own exactly when remote.equals(local). Fields either side leaves unset take
+        the value of local, since equals does not compare them.
+        """
+        return self.key + (self._field_against(local, 'ttl'),)
+
+    def _field_against(self, local, field: str):
+        value = getattr(self, field)
+        if local is not None and (value is None or getattr(local, field) is None):
+            return getattr(local, field)
+        return value
+
 
 def parse_dns_record_from_config(config: dict) -> List[DnsRecord]:
     name = config[CFG_KEY_DNS_RECORD_RR]
     type = config[CFG_KEY_DNS_RECORD_TYPE]
-    raw_values = config[CFG_KEY_DNS_RECORD_VALUE]
+    # values read from a value_from source are filled in when the config is loaded, keep one template record
+    raw_values = config[CFG_KEY_DNS_RECORD_VALUE] if CFG_KEY_DNS_RECORD_VALUE_FROM not in config else None
     values = raw_values if isinstance(raw_values, List) else [raw_values]
     ttl = config.get(CFG_KEY_DNS_RECORD_TTL, DEFAULT_DNS_TTL)
     return [DnsRecord(name=name, type=type, value=value, ttl=ttl) for value in values]
@@ -64,11 +148,10 @@ class CloudflareDnsRecord(DnsRecord):
     """
     DNS record type for CloudFlare DNS
     """
-    proxiable = bool
-    proxied = bool
-    priority = int
-    zone_id = str
-    zone_name = str
+    __slots__ = ('proxiable', 'proxied', 'priority', 'zone_id', 'zone_name')
+
+    KIND = 'cloudflare'
+    FIELDS = DnsRecord.FIELDS + __slots__
 
     def __init__(self, id=None, name=None, type=None, value=None, ttl=None, proxiable=None,
                  proxied=None, priority=None, zone_id=None, zone_name=None):
@@ -88,6 +171,11 @@ class CloudflareDnsRecord(DnsRecord):
             and super(CloudflareDnsRecord, self)._matches(other, bypass_ttl_check=self.proxied) \
             and (self.priority is None or other.priority is None or self.priority == other.priority)
 
+    def drift_key(self, local: DnsRecord = None) -> tuple:
+        # the ttl of proxied records is managed by cloudflare
+        ttl = local.ttl if local is not None and self.proxied else self._field_against(local, 'ttl')
+        return self.key + (ttl, self.proxied, self._field_against(local, 'priority'))
+
 
 def parse_cloudflare_dns_record_from_config(config: dict) -> List[CloudflareDnsRecord]:
     records = parse_dns_record_from_config(config)
@@ -99,7 +187,10 @@ def parse_cloudflare_dns_record_from_config(config: dict) -> List[CloudflareDnsR
 
 
 class NamecheapDnsRecord(DnsRecord):
-    mx_pref = int
+    __slots__ = ('mx_pref',)
+
+    KIND = 'namecheap'
+    FIELDS = DnsRecord.FIELDS + __slots__
 
     def __init__(self, id=None, name=None, type=None, value=None, ttl=None, mx_pref=None):
         super(NamecheapDnsRecord, self).__init__(id=id, name=name, type=type, value=value, ttl=ttl)
@@ -109,8 +200,13 @@ class NamecheapDnsRecord(DnsRecord):
         return '{}{}'.format(super(NamecheapDnsRecord, self).sprint_with_domain(domain),
                              ' mx_pref={}'.format(self.mx_pref) if self.mx_pref else '')
 
+    # getHosts returns an MXPref for hosts of every type, it only means something for MX records
     def equals(self, other) -> bool:
-        return super(NamecheapDnsRecord, self).equals(other) and self.mx_pref == other.mx_pref
+        return super(NamecheapDnsRecord, self).equals(other) \
+            and (self.type != 'MX' or self.mx_pref == other.mx_pref)
+
+    def drift_key(self, local: DnsRecord = None) -> tuple:
+        return super(NamecheapDnsRecord, self).drift_key(local) + (self.mx_pref if self.type == 'MX' else None,)
 
 
 def parse_namecheap_dns_record_from_config(config: dict) -> List[NamecheapDnsRecord]:
@@ -121,5 +217,74 @@ def parse_namecheap_dns_record_from_config(config: dict) -> List[NamecheapDnsRec
                                mx_pref=mx_pref) for record in records]
 
 
+class AliyunDnsRecord(DnsRecord):
+    """
+    Remote record of Aliyun DNS, priority is the preference of MX records as the api returns it.
+    It is only read, for the export, records are compared and written as plain DnsRecord.
+    """
+    __slots__ = ('priority',)
+
+    KIND = 'aliyun'
+    FIELDS = DnsRecord.FIELDS + __slots__
+
+    def __init__(self, id=None, name=None, type=None, value=None, ttl=None, priority=None):
+        super(AliyunDnsRecord, self).__init__(id=id, name=name, type=type, value=value, ttl=ttl)
+        self.priority = priority
+
+
+RECORD_KINDS = {record_class.KIND: record_class
+                for record_class in (DnsRecord, CloudflareDnsRecord, NamecheapDnsRecord, AliyunDnsRecord)}
+
+
+def dns_record_from_dict(data: dict) -> DnsRecord:
+    """
+    Inverse of DnsRecord.to_dict
+    """
+    fields = dict(data)
+    record_class = RECORD_KINDS[fields.pop('kind', 'dns')]
+    return record_class(**fields)
+
+
+class Change:
+    """
+    A single record mutation, `old` holds the remote record an update replaces
+    """
+
+    def __init__(self, action: str, record: DnsRecord, old: DnsRecord = None, reason: str = None):
+        self.action = action
+        self.record = record
+        self.old = old
+        self.reason = reason
+
+    def sprint_with_domain(self, domain: str) -> str:
+        if self.action == ACTION_UPDATE:
+            return 'try update record {} => {}'.format(self.old.sprint_with_domain(domain),
+                                                       self.record.sprint_with_domain(domain))
+        if self.action == ACTION_ADD:
+            return 'try add record {}'.format(self.record.sprint_with_domain(domain))
+        if self.reason == 'conflict':
+            return 'try delete old record due to conflict {}'.format(self.record.sprint_with_domain(domain))
+        return 'try delete old record {}'.format(self.record.sprint_with_domain(domain))
+
+
+class ChangeSet:
+    def __init__(self, domain: str):
+        self.domain = domain
+        self.changes = []  # type: List[Change]
+        self.local_records = []  # type: List[DnsRecord]
+
+    def append(self, change: Change):
+        self.changes.append(change)
+
+    def of_action(self, action: str) -> List[Change]:
+        return [change for change in self.changes if change.action == action]
+
+    def __len__(self):
+        return len(self.changes)
+
+    def __iter__(self):
+        return iter(self.changes)
+
+
 class DnsManipulationException(Exception):
     pass
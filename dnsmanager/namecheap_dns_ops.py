@@ -1,29 +1,48 @@
 #!/usr/bin/env python
 # coding=utf-8
 
-from namecheap import Api
-from dnsmanager.model import NamecheapDnsRecord
+from namecheap import Api, ApiError
+from dnsmanager.model import NamecheapDnsRecord, ChangeSet, DnsManipulationException, ACTION_ADD, \
+    ACTION_UPDATE, ACTION_DELETE, normalize_record_value
+from dnsmanager.scheduler import RequestScheduler, build_request_scheduler
 from typing import List
 
+# setHosts replaces the whole host list of a domain, larger lists are rejected by namecheap
+DEFAULT_MAX_HOSTS = 150
+
 
 class NamecheapDnsOps:
-    def __init__(self, api_key, username, ip_address, sandbox, debug):
+    def __init__(self, api_key, username, ip_address, sandbox, debug, batch=False, max_hosts=DEFAULT_MAX_HOSTS,
+                 scheduler: RequestScheduler = None):
         self.api = Api(username, api_key, username, ip_address, sandbox=sandbox, debug=debug)
+        self.batch = batch
+        self.max_hosts = max_hosts
+        self.scheduler = scheduler or RequestScheduler(is_throttle_error=self.is_throttle_error)
+
+    # https://www.namecheap.com/support/api/intro/ , calls over the limit fail with "Too many requests"
+    @staticmethod
+    def is_throttle_error(e: Exception) -> bool:
+        return isinstance(e, ApiError) and 'too many requests' in str(e).lower()
 
     def get_domain_records(self, domain: str) -> List[NamecheapDnsRecord]:
-        records = self.api.domains_dns_getHosts(domain)
+        records = self.scheduler.call(self.api.domains_dns_getHosts, domain)
         return [self._convert_to_dns_record(record) for record in records]
 
     @staticmethod
     def _convert_to_dns_record(dict_record: dict) -> NamecheapDnsRecord:
-        record = NamecheapDnsRecord()
-        record.id = dict_record['HostId']
-        record.name = dict_record['Name']
-        record.type = dict_record['Type']
-        record.value = dict_record['Address']
-        record.ttl = dict_record['TTL']
-        record.mx_pref = dict_record.get('MXPref', None)
-        return record
+        # host attributes come back as strings, numbers are converted to compare with the config
+        mx_pref = dict_record.get('MXPref', None)
+        return NamecheapDnsRecord(id=dict_record['HostId'],
+                                  name=dict_record['Name'],
+                                  type=dict_record['Type'],
+                                  value=dict_record['Address'],
+                                  ttl=int(dict_record['TTL']),
+                                  mx_pref=int(mx_pref) if mx_pref is not None else None)
+
+    @staticmethod
+    def record_id_from_response(response):
+        # every host is rewritten by setHosts, so no stable id is returned
+        return None
 
     # https://www.namecheap.com/support/api/methods/domains-dns/set-hosts/
     def add_domain_record(self, domain: str, record: NamecheapDnsRecord):
@@ -34,10 +53,10 @@ class NamecheapDnsOps:
             'MXPref': str(record.mx_pref),
             'TTL': str(record.ttl)
         }
-        return self.api.domains_dns_addHost(domain, data)
+        return self.scheduler.call(self.api.domains_dns_addHost, domain, data)
 
     def update_domain_record(self, domain: str, record: NamecheapDnsRecord):
-        host_records_remote = self.api.domains_dns_getHosts(domain)
+        host_records_remote = self.scheduler.call(self.api.domains_dns_getHosts, domain)
 
         host_records_new = []
         for r in host_records_remote:
@@ -58,7 +77,7 @@ class NamecheapDnsOps:
             'MXPref': str(record.mx_pref),
             'TTL': str(record.ttl)
         })
-        return self.api.domains_dns_setHosts(domain, host_records_new)
+        return self.scheduler.call(self.api.domains_dns_setHosts, domain, host_records_new)
 
     def delete_domain_record(self, domain, record: NamecheapDnsRecord):
         data = {
@@ -66,7 +85,56 @@ class NamecheapDnsOps:
             'HostName': record.name,
             'Address': record.value
         }
-        return self.api.domains_dns_delHost(domain, data)
+        return self.scheduler.call(self.api.domains_dns_delHost, domain, data)
+
+    def apply_changeset(self, domain: str, changeset: ChangeSet):
+        """
+        Apply all changes of a domain with one getHosts and one setHosts call
+        """
+        host_records_remote = self.scheduler.call(self.api.domains_dns_getHosts, domain)
+        host_records = [self._convert_to_host_record(r) for r in host_records_remote]
+
+        for change in changeset:
+            if change.action != ACTION_ADD:
+                target = change.old if change.action == ACTION_UPDATE else change.record
+                host_records = [r for r in host_records if not self._is_same_host(r, target)]
+            if change.action != ACTION_DELETE:
+                host_records.append(self._convert_to_host_record_from_dns_record(change.record))
+
+        if len(host_records) > self.max_hosts:
+            raise DnsManipulationException('set hosts failed: {} hosts for domain {} exceeds the limit of {}'
+                                           .format(len(host_records), domain, self.max_hosts))
+        return self.scheduler.call(self.api.domains_dns_setHosts, domain, host_records)
+
+    @staticmethod
+    def _convert_to_host_record(dict_record: dict) -> dict:
+        host_record = {
+            'RecordType': dict_record['Type'],
+            'HostName': dict_record['Name'],
+            'Address': dict_record['Address'],
+            'TTL': str(dict_record['TTL']),
+        }
+        if dict_record.get('MXPref') is not None:
+            host_record['MXPref'] = str(dict_record['MXPref'])
+        return host_record
+
+    @staticmethod
+    def _convert_to_host_record_from_dns_record(record: NamecheapDnsRecord) -> dict:
+        host_record = {
+            'RecordType': record.type,
+            'HostName': record.name,
+            'Address': record.value,
+            'TTL': str(record.ttl)
+        }
+        if record.mx_pref is not None:
+            host_record['MXPref'] = str(record.mx_pref)
+        return host_record
+
+    @staticmethod
+    def _is_same_host(host_record: dict, record: NamecheapDnsRecord) -> bool:
+        if host_record['RecordType'] != record.type or host_record['HostName'] != record.name:
+            return False
+        return normalize_record_value(record.type, host_record['Address']) == record.normalized_value
 
 
 def build_namecheap_dns_client_from_config(namecheap_conf: dict) -> NamecheapDnsOps:
@@ -75,4 +143,8 @@ def build_namecheap_dns_client_from_config(namecheap_conf: dict) -> NamecheapDns
     ip = namecheap_conf.get('ip')
     sandbox = namecheap_conf.get('sandbox')
     debug = namecheap_conf.get('debug')
-    return NamecheapDnsOps(api_key, username, ip, sandbox, debug)
+    batch = namecheap_conf.get('batch', False)
+    max_hosts = namecheap_conf.get('max_hosts', DEFAULT_MAX_HOSTS)
+    scheduler = build_request_scheduler(namecheap_conf, NamecheapDnsOps.is_throttle_error)
+    return NamecheapDnsOps(api_key, username, ip, sandbox, debug, batch=batch, max_hosts=max_hosts,
+                           scheduler=scheduler)
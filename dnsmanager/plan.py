@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import time
+from typing import Iterable, List, Optional, Set
+
+from dnsmanager.model import DnsRecord, Change, ChangeSet, DnsManipulationException, dns_record_from_dict, \
+    ACTION_ADD, ACTION_UPDATE
+from dnsmanager.reconciler import ZoneIndex
+from dnsmanager.snapshot import content_hash
+from dnsmanager.utils import read_json, write_json_atomic
+
+# bump when the layout of plan files changes, plans of another format are refused
+PLAN_FORMAT = 2
+
+
+def touched_names(changeset: ChangeSet) -> Set[str]:
+    return {change.record.name for change in changeset}
+
+
+def fingerprint(records: Iterable[DnsRecord]) -> str:
+    """
+    Hash of the records a plan touches, ids included, so a record deleted and created again counts as drift
+    """
+    return content_hash(records, unhashed=())
+
+
+def change_to_dict(change: Change) -> dict:
+    return {
+        'action': change.action,
+        'reason': change.reason,
+        'record': change.record.to_dict(),
+        'old': change.old.to_dict() if change.old is not None else None,
+    }
+
+
+def change_from_dict(data: dict) -> Change:
+    old = data.get('old')
+    return Change(data['action'], dns_record_from_dict(data['record']),
+                  old=dns_record_from_dict(old) if old is not None else None, reason=data.get('reason'))
+
+
+def _indexed(index: ZoneIndex, record: DnsRecord) -> Optional[DnsRecord]:
+    # records read back from a plan are copies, find the indexed record they stand for
+    for candidate in index.find(record.name, record.type):
+        if candidate.id == record.id and candidate.key == record.key:
+            return candidate
+    return None
+
+
+def bind_changes(changeset: ChangeSet, index: ZoneIndex):
+    """
+    Point the changes read from a plan to the records of the index, so applying them patches the index
+    """
+    for change in changeset:
+        if change.action == ACTION_UPDATE:
+            change.old = _indexed(index, change.old) or change.old
+        elif change.action != ACTION_ADD:
+            change.record = _indexed(index, change.record) or change.record
+
+
+def patch_index(index: ZoneIndex, changeset: ChangeSet):
+    """
+    Replay applied changes on another index of the same zone, like the saved snapshot of the domain
+    """
+    for change in changeset:
+        if change.action == ACTION_ADD:
+            index.add(change.record)
+            continue
+        target = _indexed(index, change.old if change.action == ACTION_UPDATE else change.record)
+        if target is None:
+            continue
+        if change.action == ACTION_UPDATE:
+            index.replace(target, change.record)
+        else:
+            index.remove(target)
+
+
+class DomainPlan:
+    """
+    Changes planned for one domain, with the fingerprint of the remote records they touch
+    and the content hash of the whole zone as it was listed
+    """
+
+    def __init__(self, domain: str, account: str, config_hash: str, changeset: ChangeSet, names: List[str],
+                 fingerprint: str, remote_hash: str):
+        self.domain = domain
+        self.account = account
+        self.config_hash = config_hash
+        self.changeset = changeset
+        self.names = names
+        self.fingerprint = fingerprint
+        self.remote_hash = remote_hash
+
+    def to_dict(self) -> dict:
+        return {
+            'domain': self.domain,
+            'account': self.account,
+            'config_hash': self.config_hash,
+            'names': self.names,
+            'fingerprint': self.fingerprint,
+            'remote_hash': self.remote_hash,
+            'changes': [change_to_dict(change) for change in self.changeset],
+        }
+
+    @staticmethod
+    def from_dict(data: dict) -> 'DomainPlan':
+        changeset = ChangeSet(data['domain'])
+        for change in data['changes']:
+            changeset.append(change_from_dict(change))
+        return DomainPlan(data['domain'], data['account'], data['config_hash'], changeset, data['names'],
+                          data['fingerprint'], data['remote_hash'])
+
+
+def write_plan(path: str, config_path: str, domains: List[DomainPlan]):
+    write_json_atomic(path, {
+        'format': PLAN_FORMAT,
+        'created_at': time.time(),
+        'config': config_path,
+        'domains': [domain_plan.to_dict() for domain_plan in domains],
+    }, indent=2)
+
+
+def read_plan(path: str):
+    """
+    Returns the config path the plan was made from and the plans of its domains
+    """
+    data = read_json(path)
+    if data is None:
+        raise DnsManipulationException('cannot read plan {}'.format(path))
+    if data.get('format') != PLAN_FORMAT:
+        raise DnsManipulationException('plan {} has format {}, expected {}'.format(
+            path, data.get('format'), PLAN_FORMAT))
+    return data['config'], [DomainPlan.from_dict(domain) for domain in data['domains']]
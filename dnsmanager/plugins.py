@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import importlib
+import threading
+from typing import Callable, List, Union
+
+from dnsmanager.model import DnsRecord, DnsManipulationException
+
+# third-party vendors register a VendorPlugin under this entry point group, named after the vendor
+ENTRY_POINT_GROUP = 'dnsmanager.vendors'
+
+DEFAULT_RECORD_PARSER = 'dnsmanager.model:parse_dns_record_from_config'
+
+
+def _resolve(target: Union[str, Callable]) -> Callable:
+    if not isinstance(target, str):
+        return target
+    module_name, _, attr = target.partition(':')
+    return getattr(importlib.import_module(module_name), attr)
+
+
+class VendorPlugin:
+    """
+    A dns vendor. `client_factory` and `record_parser` are callables, or `module:attr` paths imported on first use,
+    so the sdk of a vendor is only imported when a configured domain needs it.
+    """
+
+    def __init__(self, name: str, client_factory: Union[str, Callable[[dict], any]],
+                 record_parser: Union[str, Callable[[dict], List[DnsRecord]]] = DEFAULT_RECORD_PARSER):
+        self.name = name
+        self.client_factory = client_factory
+        self.record_parser = record_parser
+
+    def build_client(self, config: dict):
+        return _resolve(self.client_factory)(config)
+
+    def parse_records(self, config: dict) -> List[DnsRecord]:
+        return _resolve(self.record_parser)(config)
+
+
+BUILTIN_PLUGINS = (
+    VendorPlugin('namecheap', 'dnsmanager.namecheap_dns_ops:build_namecheap_dns_client_from_config',
+                 'dnsmanager.model:parse_namecheap_dns_record_from_config'),
+    VendorPlugin('aliyun', 'dnsmanager.aliyun_dns_ops:build_aliyun_dns_client_from_config'),
+    VendorPlugin('cloudflare', 'dnsmanager.cloudflare_dns_ops:build_cloudflare_dns_client_from_config',
+                 'dnsmanager.model:parse_cloudflare_dns_record_from_config'),
+)
+
+_plugins = {plugin.name: plugin for plugin in BUILTIN_PLUGINS}
+_entry_points_loaded = False
+_lock = threading.Lock()
+
+
+def register_vendor(plugin: VendorPlugin):
+    """
+    Register a vendor, replacing any vendor of the same name
+    """
+    with _lock:
+        _plugins[plugin.name] = plugin
+
+
+def _vendor_entry_points():
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:  # python < 3.8
+        return []
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        return eps.select(group=ENTRY_POINT_GROUP)
+    return eps.get(ENTRY_POINT_GROUP, [])
+
+
+def _load_entry_points():
+    global _entry_points_loaded
+    with _lock:
+        if _entry_points_loaded:
+            return
+        _entry_points_loaded = True
+        for entry_point in _vendor_entry_points():
+            # vendors registered in code take precedence over installed ones
+            if entry_point.name not in _plugins:
+                _plugins[entry_point.name] = _EntryPointPlugin(entry_point)
+
+
+class _EntryPointPlugin(VendorPlugin):
+    """
+    Vendor of an installed distribution, its module is imported on first use as well
+    """
+
+    def __init__(self, entry_point):
+        super().__init__(entry_point.name, None, None)
+        self._entry_point = entry_point
+        self._plugin = None
+
+    def _load(self) -> VendorPlugin:
+        if self._plugin is None:
+            self._plugin = self._entry_point.load()
+        return self._plugin
+
+    def build_client(self, config: dict):
+        return self._load().build_client(config)
+
+    def parse_records(self, config: dict) -> List[DnsRecord]:
+        return self._load().parse_records(config)
+
+
+def get_vendor(name: str) -> VendorPlugin:
+    plugin = _plugins.get(name)
+    if plugin is None:
+        _load_entry_points()
+        plugin = _plugins.get(name)
+    if plugin is None:
+        raise DnsManipulationException('unknown dns vendor: {}'.format(name))
+    return plugin
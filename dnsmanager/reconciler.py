@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from __future__ import print_function
+
+from typing import Iterable, List, Optional, Tuple
+
+from dnsmanager.fetch import iter_remote_records
+from dnsmanager.metrics import registry
+from dnsmanager.model import DnsRecord, Change, ChangeSet, ACTION_ADD, ACTION_UPDATE, ACTION_DELETE, \
+    normalize_record_value
+
+
+def has_conflict(old_record: DnsRecord, new_record: DnsRecord) -> bool:
+    if new_record.type == 'CNAME':
+        return old_record.type in ['CNAME', 'A', 'AAAA']
+    elif new_record.type in ['A', 'AAAA']:
+        return old_record.type == 'CNAME'
+    return new_record.type == old_record.type and new_record.value == old_record.value
+
+
+class ZoneIndex:
+    """
+    Hash indexes over the records of one domain, keyed by name, (name, type) and identity key
+    """
+
+    def __init__(self, records: Iterable[DnsRecord] = ()):
+        self._by_name = {}
+        self._by_type = {}
+        self._by_value = {}
+        for record in records:
+            self.add(record)
+
+    def add(self, record: DnsRecord):
+        self._by_name.setdefault(record.name, []).append(record)
+        self._by_type.setdefault((record.name, record.type), []).append(record)
+        self._by_value.setdefault(record.key, record)
+
+    def remove(self, record: DnsRecord):
+        self._remove_from(self._by_name, record.name, record)
+        self._remove_from(self._by_type, (record.name, record.type), record)
+        key = record.key
+        if self._by_value.get(key) is record:
+            del self._by_value[key]
+            # another record may carry the same value, keep the first one of them indexed
+            replacement = next((r for r in self._by_type.get((record.name, record.type), []) if r.key == key), None)
+            if replacement is not None:
+                self._by_value[key] = replacement
+
+    def replace(self, old_record: DnsRecord, new_record: DnsRecord):
+        self.remove(old_record)
+        self.add(new_record)
+
+    @staticmethod
+    def _remove_from(index: dict, key, record: DnsRecord):
+        records = index.get(key)
+        if not records:
+            return
+        index[key] = [r for r in records if r is not record]
+        if not index[key]:
+            del index[key]
+
+    def find(self, name: str, record_type: str = None) -> List[DnsRecord]:
+        if record_type is None:
+            return list(self._by_name.get(name, []))
+        return list(self._by_type.get((name, record_type), []))
+
+    def find_value(self, name: str, record_type: str, value: str) -> Optional[DnsRecord]:
+        return self._by_value.get((name, record_type, normalize_record_value(record_type, value)))
+
+    def find_key(self, key: tuple) -> Optional[DnsRecord]:
+        return self._by_value.get(key)
+
+    def records(self) -> List[DnsRecord]:
+        return [record for records in self._by_name.values() for record in records]
+
+    def __len__(self):
+        return sum(len(records) for records in self._by_name.values())
+
+
+def _inherit_identity(local_record: DnsRecord, remote_record: DnsRecord):
+    # updates address the remote record, so carry over vendor identifiers the config can not know about
+    for attr in ('id', 'zone_id'):
+        if getattr(local_record, attr, None) is None and getattr(remote_record, attr, None) is not None:
+            setattr(local_record, attr, getattr(remote_record, attr))
+
+
+def compute_changeset(domain: str, index: ZoneIndex, record_groups: Iterable[List[DnsRecord]]) -> ChangeSet:
+    """
+    Diff the config record groups of a domain against its remote records in a single pass.
+    The index is patched with every planned change, so it describes the zone as it will be once applied.
+    """
+    changeset = ChangeSet(domain)
+    for local_records in record_groups:
+        _upsert_records(changeset, index, local_records)
+        _cleanup_staled_records(changeset, index, local_records)
+        changeset.local_records.extend(local_records)
+    return changeset
+
+
+def _upsert_records(changeset: ChangeSet, index: ZoneIndex, local_records: List[DnsRecord]):
+    for local_record in local_records:
+        value_match_record = index.find_key(local_record.key)
+
+        if value_match_record is None:  # value not exist, create it
+            for same_name_record in index.find(local_record.name):  # resolve conflict record first
+                if has_conflict(same_name_record, local_record):
+                    changeset.append(Change(ACTION_DELETE, same_name_record, reason='conflict'))
+                    index.remove(same_name_record)
+            changeset.append(Change(ACTION_ADD, local_record))
+            index.add(local_record)
+        elif not value_match_record.equals(local_record):
+            # value matches but other configuration not equals, such as ttl, priority.
+            _inherit_identity(local_record, value_match_record)
+            changeset.append(Change(ACTION_UPDATE, local_record, old=value_match_record))
+            index.replace(value_match_record, local_record)
+
+
+def _cleanup_staled_records(changeset: ChangeSet, index: ZoneIndex, local_records: List[DnsRecord]):
+    # delete record which record's value not present at config file
+    local_keys = set(local_records)
+    for name, record_type in {(record.name, record.type) for record in local_records}:
+        for remote_record in index.find(name, record_type):
+            if remote_record in local_keys:
+                continue
+            changeset.append(Change(ACTION_DELETE, remote_record, reason='stale'))
+            index.remove(remote_record)
+
+
+def _record_id_from_response(client, response):
+    extract = getattr(client.client, 'record_id_from_response', None)
+    if extract is None or not isinstance(response, dict):
+        return None
+    return extract(response)
+
+
+def _patch_snapshot(snapshot: ZoneIndex, change: Change):
+    if change.action == ACTION_ADD:
+        snapshot.add(change.record)
+    elif change.action == ACTION_UPDATE:
+        snapshot.replace(change.old, change.record)
+    else:
+        snapshot.remove(change.record)
+
+
+def _change_operation(ops, change: Change):
+    if change.action == ACTION_ADD:
+        return ops.add_domain_record
+    if change.action == ACTION_UPDATE:
+        return ops.update_domain_record
+    return ops.delete_domain_record
+
+
+def _change_applied(client, change: Change, response, snapshot: ZoneIndex):
+    if change.action == ACTION_ADD and change.record.id is None:
+        change.record.id = _record_id_from_response(client, response)
+    _patch_snapshot(snapshot, change)
+
+
+def _print_status(changeset: ChangeSet, out):
+    for record in changeset.local_records:
+        print('status now {}'.format(record.sprint_with_domain(changeset.domain)), file=out)
+
+
+def apply_changeset(client, changeset: ChangeSet, snapshot: ZoneIndex, out=None) -> ZoneIndex:
+    """
+    Apply the changeset and patch the snapshot from every successful response,
+    so it keeps describing the remote zone without listing it again.
+    Clients in batch mode take the whole changeset of the domain at once.
+    """
+    domain = changeset.domain
+    if changeset and getattr(client.client, 'batch', False):
+        for change in changeset:
+            print(change.sprint_with_domain(domain), file=out)
+        print(client.client.apply_changeset(domain, changeset), file=out)
+        for change in changeset:
+            _patch_snapshot(snapshot, change)
+    else:
+        for change in changeset:
+            print(change.sprint_with_domain(domain), file=out)
+            response = _change_operation(client.client, change)(domain, change.record)
+            _change_applied(client, change, response, snapshot)
+            print(response, file=out)
+
+    _print_status(changeset, out)
+    return snapshot
+
+
+def reconcile_domain(client, domain: str, record_groups: Iterable[List[DnsRecord]], refresh: bool = False,
+                     out=None, remote_records: List[DnsRecord] = None) -> Tuple[ChangeSet, List[DnsRecord]]:
+    """
+    Reconcile one domain with a single listing, returns the changeset and the remote records after it is applied.
+    With refresh, the remote records are listed once more to confirm the patched snapshot.
+    Remote records already known, like those kept by watch or fetched by name, replace the listing.
+    """
+    if remote_records is None:
+        # listed records stream straight into the index, pages are not collected into a list first
+        with registry.phase('list'):
+            index = ZoneIndex(iter_remote_records(client.client, domain))
+    else:
+        index = ZoneIndex(remote_records)
+    snapshot = ZoneIndex(index.records())
+    with registry.phase('diff'):
+        changeset = compute_changeset(domain, index, record_groups)
+    with registry.phase('apply'):
+        apply_changeset(client, changeset, snapshot, out=out)
+    if refresh and changeset:
+        with registry.phase('refresh'):
+            return changeset, client.client.get_domain_records(domain)
+    return changeset, snapshot.records()
+
+
+async def apply_changeset_async(client, changeset: ChangeSet, snapshot: ZoneIndex, out=None) -> ZoneIndex:
+    """
+    apply_changeset for clients whose ops are AsyncDnsOps. Changes of one domain are still applied in order,
+    conflicting records are deleted before their replacement is added.
+    """
+    domain = changeset.domain
+    if changeset and getattr(client.client, 'batch', False):
+        for change in changeset:
+            print(change.sprint_with_domain(domain), file=out)
+        print(await client.client.apply_changeset(domain, changeset), file=out)
+        for change in changeset:
+            _patch_snapshot(snapshot, change)
+    else:
+        for change in changeset:
+            print(change.sprint_with_domain(domain), file=out)
+            response = await _change_operation(client.client, change)(domain, change.record)
+            _change_applied(client, change, response, snapshot)
+            print(response, file=out)
+
+    _print_status(changeset, out)
+    return snapshot
+
+
+async def reconcile_domain_async(client, domain: str, record_groups: Iterable[List[DnsRecord]],
+                                 refresh: bool = False, out=None,
+                                 remote_records: List[DnsRecord] = None) -> Tuple[ChangeSet, List[DnsRecord]]:
+    """
+    reconcile_domain for clients whose ops are AsyncDnsOps
+    """
+    if remote_records is None:
+        with registry.phase('list'):
+            remote_records = await client.client.get_domain_records(domain)
+    with registry.phase('diff'):
+        changeset = compute_changeset(domain, ZoneIndex(remote_records), record_groups)
+    with registry.phase('apply'):
+        snapshot = await apply_changeset_async(client, changeset, ZoneIndex(remote_records), out=out)
+    if refresh and changeset:
+        with registry.phase('refresh'):
+            return changeset, await client.client.get_domain_records(domain)
+    return changeset, snapshot.records()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Callable, Optional
+
+CFG_KEY_RATE_LIMIT = 'rate_limit'
+
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BASE_DELAY = 0.5
+DEFAULT_MAX_DELAY = 30.0
+
+
+class TokenBucket:
+    """
+    Allows `rate` calls per second on average and bursts of up to `burst` calls, shared by all threads
+    """
+
+    def __init__(self, rate: float, burst: int = None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, int(rate)))
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def acquire(self, sleep: Callable[[float], None] = time.sleep):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                else:
+                    wait = (1 - self._tokens) / self.rate
+            sleep(wait)
+
+    def pause(self, seconds: float):
+        """
+        Hold back every caller, used when the vendor asked to slow down
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens = 0
+            self._paused_until = max(self._paused_until, now + seconds)
+
+
+def parse_retry_after(value) -> Optional[float]:
+    """
+    Seconds to wait from the value of a Retry-After header, given in seconds or as an http date
+    """
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_after_from_exception(e: Exception) -> Optional[float]:
+    """
+    Seconds the server asked to wait, for exceptions that carry a retry_after or a response with a Retry-After
+    header. The exceptions of the vendor sdks carry neither, clients that see the responses pass their own.
+    """
+    retry_after = getattr(e, 'retry_after', None)
+    if retry_after is None:
+        headers = getattr(getattr(e, 'response', None), 'headers', None) or {}
+        retry_after = headers.get('Retry-After')
+    if retry_after is None:
+        return None
+    return parse_retry_after(retry_after)
+
+
+class RequestScheduler:
+    """
+    Every vendor api call goes through `call`, which waits for the token bucket of the account
+    and retries throttled calls with jittered exponential backoff, or after the delay the server asked for,
+    either at most max_delay.
+    """
+
+    def __init__(self, rate: float = None, burst: int = None, max_retries: int = DEFAULT_MAX_RETRIES,
+                 base_delay: float = DEFAULT_BASE_DELAY, max_delay: float = DEFAULT_MAX_DELAY,
+                 is_throttle_error: Callable[[Exception], bool] = None,
+                 retry_after: Callable[[Exception], Optional[float]] = retry_after_from_exception,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.is_throttle_error = is_throttle_error or (lambda e: False)
+        self.retry_after = retry_after
+        self.sleep = sleep
+        self.retries = 0
+        # observers, called with (seconds, error) after every attempt and with (error, delay) before a retry
+        self.on_request = None  # type: Optional[Callable[[float, Optional[Exception]], None]]
+        self.on_retry = None  # type: Optional[Callable[[Exception, float], None]]
+
+    def call(self, fn: Callable, *args, **kwargs):
+        attempt = 0
+        while True:
+            if self.bucket is not None:
+                self.bucket.acquire(self.sleep)
+            started_at = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if self.on_request is not None:
+                    self.on_request(time.perf_counter() - started_at, e)
+                if attempt >= self.max_retries or not self.is_throttle_error(e):
+                    raise
+                delay = self.retry_after(e)
+                if delay is None:
+                    delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                else:
+                    # a worker never waits longer than max_delay, whatever date the server sent
+                    delay = min(delay, self.max_delay)
+                attempt += 1
+                self.retries += 1
+                if self.on_retry is not None:
+                    self.on_retry(e, delay)
+                if self.bucket is not None:
+                    self.bucket.pause(delay)
+                else:
+                    self.sleep(delay)
+            else:
+                if self.on_request is not None:
+                    self.on_request(time.perf_counter() - started_at, None)
+                return result
+
+
+def build_request_scheduler(config: dict, is_throttle_error: Callable[[Exception], bool]) -> RequestScheduler:
+    """
+    Build the scheduler of a client from its `rate_limit` config, calls are unlimited but still retried without it
+    """
+    config = (config or {}).get(CFG_KEY_RATE_LIMIT) or {}
+    return RequestScheduler(rate=config.get('rate'),
+                            burst=config.get('burst'),
+                            max_retries=config.get('max_retries', DEFAULT_MAX_RETRIES),
+                            base_delay=config.get('base_delay', DEFAULT_BASE_DELAY),
+                            max_delay=config.get('max_delay', DEFAULT_MAX_DELAY),
+                            is_throttle_error=is_throttle_error)
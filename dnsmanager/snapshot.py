@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import hashlib
+import os
+import time
+from collections import Counter
+from typing import Iterable, List, Optional, Tuple
+
+from dnsmanager.model import DnsRecord, dns_record_from_dict
+from dnsmanager.utils import default_cache_dir, read_json, write_json_atomic
+
+# vendor identifiers do not describe what a zone serves, they are left out of the content hash
+_UNHASHED_FIELDS = ('id', 'zone_id', 'zone_name')
+
+
+def content_hash(records: Iterable[DnsRecord], unhashed=_UNHASHED_FIELDS) -> str:
+    """
+    Order independent hash of what the records serve
+    """
+    lines = sorted('\t'.join('{}={}'.format(k, v) for k, v in sorted(record.to_dict().items())
+                             if k not in unhashed)
+                   for record in records)
+    digest = hashlib.sha256()
+    for line in lines:
+        digest.update(line.encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+def largest_name_size(names: Iterable[str]) -> int:
+    """
+    Most records under one name, given the name of every record
+    """
+    return max(Counter(names).values(), default=0)
+
+
+class Snapshot:
+    """
+    Remote records of one domain as they were at fetched_at
+    """
+
+    def __init__(self, domain: str, records: List[DnsRecord], fetched_at: float, digest: str):
+        self.domain = domain
+        self.records = records
+        self.fetched_at = fetched_at
+        self.hash = digest
+
+    def age(self) -> float:
+        return time.time() - self.fetched_at
+
+
+class SnapshotStore:
+    """
+    Last known remote records of every domain, one json file per account and domain
+    """
+
+    def __init__(self, directory: str = None):
+        self.directory = directory or os.path.join(default_cache_dir(), 'snapshots')
+
+    def _path(self, account: str, domain: str) -> str:
+        return os.path.join(self.directory, account, domain + '.json')
+
+    def _meta_path(self, account: str, domain: str) -> str:
+        return self._path(account, domain) + '.meta'
+
+    def _meta(self, account: str, domain: str) -> Optional[dict]:
+        """
+        Hash, fetch time, record count and largest name of the snapshot of a domain, from the small sidecar file
+        written with it. A sidecar that is missing or was not written for the snapshot on disk falls back to reading
+        the snapshot.
+        """
+        path = self._path(account, domain)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        meta = read_json(self._meta_path(account, domain))
+        if meta is not None and meta.get('mtime_ns') == stat.st_mtime_ns and meta.get('file_size') == stat.st_size \
+                and 'largest_name' in meta:
+            return meta
+        data = read_json(path)
+        if data is None:
+            return None
+        return {'hash': data['hash'], 'fetched_at': data['fetched_at'], 'size': len(data['records']),
+                'largest_name': largest_name_size(r['name'] for r in data['records'])}
+
+    def load(self, account: str, domain: str, max_age: float = None) -> Optional[Snapshot]:
+        if max_age is not None:
+            meta = self._meta(account, domain)
+            if meta is None or time.time() - meta['fetched_at'] > max_age:
+                return None
+        data = read_json(self._path(account, domain))
+        if data is None:
+            return None
+        if max_age is not None and time.time() - data['fetched_at'] > max_age:
+            return None
+        records = [dns_record_from_dict(r) for r in data['records']]
+        return Snapshot(domain, records, data['fetched_at'], data['hash'])
+
+    def digest(self, account: str, domain: str) -> Optional[str]:
+        """
+        Content hash of the snapshot of a domain, read from its sidecar
+        """
+        meta = self._meta(account, domain)
+        return meta['hash'] if meta is not None else None
+
+    def sizes(self, account: str, domain: str) -> Tuple[Optional[int], Optional[int]]:
+        """
+        Number of records in the snapshot of a domain and most records under one of its names,
+        read from its sidecar
+        """
+        meta = self._meta(account, domain)
+        return (meta['size'], meta['largest_name']) if meta is not None else (None, None)
+
+    def save(self, account: str, domain: str, records: List[DnsRecord], fetched_at: float = None) -> Snapshot:
+        """
+        Save the records of a domain, fetched_at defaults to now and is kept from the previous snapshot
+        when only some names of the zone were fetched again
+        """
+        snapshot = Snapshot(domain, records, time.time() if fetched_at is None else fetched_at,
+                            content_hash(records))
+        path = self._path(account, domain)
+        write_json_atomic(path, {
+            'domain': domain,
+            'fetched_at': snapshot.fetched_at,
+            'hash': snapshot.hash,
+            'records': [r.to_dict() for r in records],
+        })
+        # the sidecar names the snapshot file it describes, one left from an interrupted save is not trusted
+        stat = os.stat(path)
+        write_json_atomic(self._meta_path(account, domain), {
+            'fetched_at': snapshot.fetched_at,
+            'hash': snapshot.hash,
+            'size': len(records),
+            'largest_name': largest_name_size(r.name for r in records),
+            'mtime_ns': stat.st_mtime_ns,
+            'file_size': stat.st_size,
+        })
+        return snapshot
@@ -1,7 +1,55 @@
 #!/usr/bin/env python
 # coding=utf-8
 
+import contextlib
+import json
+import os
+import tempfile
+
+ENV_CACHE_DIR = 'DNS_MANAGER_CACHE_DIR'
+
+
 def remove_suffix(s, suffix):
     if s.endswith(suffix):
         return s[:-len(suffix)]
     return s
+
+
+def default_cache_dir() -> str:
+    cache_dir = os.environ.get(ENV_CACHE_DIR)
+    if cache_dir:
+        return cache_dir
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'dns-manager')
+
+
+def read_json(path: str, default=None):
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (IOError, OSError, ValueError):
+        return default
+
+
+@contextlib.contextmanager
+def open_atomic(path: str):
+    """
+    Write next to the target and rename it over once the block is done, so readers never see a partial file,
+    and a block that raises leaves the target as it was
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            yield fp
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def write_json_atomic(path: str, data, indent: int = None):
+    with open_atomic(path) as fp:
+        # json.dumps runs the C encoder, json.dump to a file falls back to the pure python one
+        fp.write(json.dumps(data, indent=indent, separators=(',', ': ') if indent else (',', ':')))
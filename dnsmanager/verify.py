@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from __future__ import print_function
+
+import asyncio
+import ipaddress
+import random
+import socket
+import struct
+import time
+from typing import FrozenSet, Iterable, List, Tuple
+
+from dnsmanager.model import DnsRecord, ChangeSet, DnsManipulationException
+
+DEFAULT_VERIFY_TIMEOUT = 120.0
+DEFAULT_QUERY_TIMEOUT = 2.0
+DEFAULT_DNS_PORT = 53
+# first pause between two rounds of queries of a record, doubled after every round that did not converge
+INITIAL_BACKOFF = 0.5
+MAX_BACKOFF = 8.0
+# queries in flight at once over all records and nameservers
+MAX_QUERIES_IN_FLIGHT = 64
+RESOLV_CONF = '/etc/resolv.conf'
+
+# https://www.rfc-editor.org/rfc/rfc1035#section-3.2.2
+QTYPES = {'A': 1, 'NS': 2, 'CNAME': 5, 'MX': 15, 'TXT': 16, 'AAAA': 28}
+_TYPE_NAMES = {code: name for name, code in QTYPES.items()}
+CLASS_IN = 1
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+# https://www.rfc-editor.org/rfc/rfc1035#section-4.1.1, only these are answers about the name,
+# the others say the server could not or would not look it up
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+RCODE_NAMES = {1: 'FORMERR', 2: 'SERVFAIL', 4: 'NOTIMP', 5: 'REFUSED'}
+
+Server = Tuple[str, int]
+
+
+def parse_server(spec: str) -> Server:
+    """
+    Parse a nameserver given as host, host:port or [ipv6]:port
+    """
+    if spec.startswith('['):
+        host, _, port = spec[1:].partition(']')
+        return host, int(port[1:]) if port.startswith(':') else DEFAULT_DNS_PORT
+    if spec.count(':') == 1:
+        host, port = spec.split(':')
+        return host, int(port)
+    return spec, DEFAULT_DNS_PORT
+
+
+def system_resolvers(path: str = RESOLV_CONF) -> List[Server]:
+    try:
+        with open(path) as fp:
+            return [(line.split()[1], DEFAULT_DNS_PORT) for line in fp
+                    if line.startswith('nameserver') and len(line.split()) > 1]
+    except (IOError, OSError):
+        return []
+
+
+def build_query(query_id: int, qname: str, qtype: str, recursion: bool = False) -> bytes:
+    header = struct.pack('!HHHHHH', query_id, FLAG_RD if recursion else 0, 1, 0, 0, 0)
+    labels = b''.join(struct.pack('!B', len(label)) + label
+                      for label in (part.encode('idna') for part in qname.rstrip('.').split('.')) if label)
+    return header + labels + b'\x00' + struct.pack('!HH', QTYPES[qtype], CLASS_IN)
+
+
+def _read_name(message: bytes, offset: int) -> Tuple[str, int]:
+    # returns the name and the offset after it where it was read, following compression pointers
+    labels = []
+    end = None
+    for _ in range(128):
+        length = message[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3F) << 8) | message[offset + 1]
+            continue
+        offset += 1
+        if length == 0:
+            return '.'.join(labels), end if end is not None else offset
+        labels.append(message[offset:offset + length].decode('ascii', 'replace'))
+        offset += length
+    raise DnsManipulationException('malformed name in dns response')
+
+
+def _rdata_value(message: bytes, rtype: int, offset: int, length: int) -> str:
+    if rtype == QTYPES['A']:
+        return socket.inet_ntop(socket.AF_INET, message[offset:offset + length])
+    if rtype == QTYPES['AAAA']:
+        return socket.inet_ntop(socket.AF_INET6, message[offset:offset + length])
+    if rtype in (QTYPES['CNAME'], QTYPES['NS']):
+        return _read_name(message, offset)[0]
+    if rtype == QTYPES['MX']:
+        return _read_name(message, offset + 2)[0]
+    if rtype == QTYPES['TXT']:
+        chunks, end = [], offset + length
+        while offset < end:
+            size = message[offset]
+            chunks.append(message[offset + 1:offset + 1 + size])
+            offset += 1 + size
+        return b''.join(chunks).decode('utf-8', 'replace')
+    return message[offset:offset + length].hex()
+
+
+def _normalize(record_type: str, value: str) -> str:
+    value = str(value)
+    if record_type in ('A', 'AAAA'):
+        try:
+            return str(ipaddress.ip_address(value))
+        except ValueError:
+            return value
+    if record_type in ('CNAME', 'NS', 'MX'):
+        return value.rstrip('.').lower()
+    if record_type == 'TXT' and len(value) >= 2 and value[0] == value[-1] == '"':
+        return value[1:-1]
+    return value
+
+
+class DnsAnswer:
+    """
+    Response code and answer records of a dns response, records as (name, type, value)
+    """
+
+    def __init__(self, rcode: int, records: List[Tuple[str, str, str]]):
+        self.rcode = rcode
+        self.records = records
+
+    def values(self, name: str, record_type: str) -> FrozenSet[str]:
+        name = name.rstrip('.').lower()
+        return frozenset(_normalize(record_type, value) for owner, rtype, value in self.records
+                         if owner.lower() == name and rtype == record_type)
+
+
+def parse_response(message: bytes, query_id: int) -> Tuple[DnsAnswer, bool]:
+    """
+    Returns the answer and whether it was truncated
+    """
+    answer_id, flags, qdcount, ancount, _, _ = struct.unpack('!HHHHHH', message[:12])
+    if answer_id != query_id:
+        raise DnsManipulationException('dns response id {} does not match query {}'.format(answer_id, query_id))
+    offset = 12
+    for _ in range(qdcount):
+        offset = _read_name(message, offset)[1] + 4
+    records = []
+    for _ in range(ancount):
+        name, offset = _read_name(message, offset)
+        rtype, _, _, length = struct.unpack('!HHIH', message[offset:offset + 10])
+        offset += 10
+        if rtype in _TYPE_NAMES:
+            records.append((name, _TYPE_NAMES[rtype], _rdata_value(message, rtype, offset, length)))
+        offset += length
+    return DnsAnswer(flags & 0x000F, records), bool(flags & FLAG_TC)
+
+
+class _UdpQuery(asyncio.DatagramProtocol):
+
+    def __init__(self, query_id: int, future: asyncio.Future):
+        self.query_id = query_id
+        self.future = future
+
+    def datagram_received(self, data, addr):
+        # answers of other queries or spoofed ones are dropped
+        if len(data) >= 12 and struct.unpack('!H', data[:2])[0] == self.query_id and not self.future.done():
+            self.future.set_result(data)
+
+    def error_received(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+async def _query_udp(server: Server, message: bytes, query_id: int, timeout: float) -> bytes:
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    transport, _ = await loop.create_datagram_endpoint(lambda: _UdpQuery(query_id, future), remote_addr=server)
+    try:
+        transport.sendto(message)
+        return await asyncio.wait_for(future, timeout)
+    finally:
+        transport.close()
+
+
+async def _query_tcp(server: Server, message: bytes, timeout: float) -> bytes:
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(*server), timeout)
+    try:
+        writer.write(struct.pack('!H', len(message)) + message)
+        length = struct.unpack('!H', await asyncio.wait_for(reader.readexactly(2), timeout))[0]
+        return await asyncio.wait_for(reader.readexactly(length), timeout)
+    finally:
+        writer.close()
+
+
+async def query(server: Server, qname: str, qtype: str, timeout: float = DEFAULT_QUERY_TIMEOUT,
+                recursion: bool = False) -> DnsAnswer:
+    """
+    Ask one nameserver over UDP, and over TCP again when the answer came back truncated
+    """
+    query_id = random.getrandbits(16)
+    message = build_query(query_id, qname, qtype, recursion)
+    answer, truncated = parse_response(await _query_udp(server, message, query_id, timeout), query_id)
+    if truncated:
+        answer, _ = parse_response(await _query_tcp(server, message, timeout), query_id)
+    return answer
+
+
+async def find_nameservers(domain: str, resolvers: List[Server], timeout: float = DEFAULT_QUERY_TIMEOUT) \
+        -> List[Server]:
+    """
+    Addresses of the authoritative nameservers of a zone, from its NS records as the resolvers see them
+    """
+    loop = asyncio.get_running_loop()
+    for resolver in resolvers:
+        try:
+            answer = await query(resolver, domain, 'NS', timeout, recursion=True)
+        except (OSError, asyncio.TimeoutError, DnsManipulationException):
+            continue
+        servers = []
+        for host in sorted(answer.values(domain, 'NS')):
+            try:
+                infos = await loop.getaddrinfo(host, DEFAULT_DNS_PORT, type=socket.SOCK_DGRAM)
+            except OSError:
+                continue
+            servers += [address for address in ((info[4][0], DEFAULT_DNS_PORT) for info in infos)
+                        if address not in servers]
+        if servers:
+            return servers
+    raise DnsManipulationException('no nameserver found for {}, name them with --nameserver'.format(domain))
+
+
+class RecordCheck:
+    """
+    Values the nameservers of a domain should serve for a name and type once a changeset is applied,
+    none at all when the last record of that name and type was deleted
+    """
+
+    def __init__(self, domain: str, name: str, record_type: str, expected: FrozenSet[str]):
+        self.domain = domain
+        self.name = name
+        self.type = record_type
+        self.expected = expected
+        self.fqdn = domain if name == '@' else '{}.{}'.format(name, domain)
+        self.converged_after = None
+        self.last_answers = {}
+
+    def sprint(self) -> str:
+        return '[{}] {}'.format(self.type, self.fqdn)
+
+
+def checks_from_changeset(changeset: ChangeSet, remote_records: Iterable[DnsRecord]) -> List[RecordCheck]:
+    """
+    One check per name and type the changeset touched, expecting the values of the records left after it.
+    Proxied records are served from the vendor's edge and types without a decoder here are left out.
+    """
+    touched = {(change.record.name, change.record.type) for change in changeset if change.record.type in QTYPES}
+    if not touched:
+        return []
+    expected = {key: set() for key in touched}
+    proxied = set()
+    for record in remote_records:
+        key = (record.name, record.type)
+        if key in expected:
+            expected[key].add(_normalize(record.type, record.value))
+            if getattr(record, 'proxied', False):
+                proxied.add(key)
+    return [RecordCheck(changeset.domain, name, record_type, frozenset(expected[(name, record_type)]))
+            for name, record_type in sorted(touched) if (name, record_type) not in proxied]
+
+
+async def _converge(check: RecordCheck, servers: List[Server], started_at: float, deadline: float,
+                    limit: asyncio.Semaphore):
+    async def ask(server):
+        async with limit:
+            try:
+                answer = await query(server, check.fqdn, check.type)
+            except (OSError, asyncio.TimeoutError, DnsManipulationException) as e:
+                check.last_answers[server] = e
+                return False
+        if answer.rcode not in (RCODE_NOERROR, RCODE_NXDOMAIN):
+            # an empty SERVFAIL or REFUSED answer would otherwise pass for a deleted record
+            check.last_answers[server] = DnsManipulationException(
+                RCODE_NAMES.get(answer.rcode, 'rcode {}'.format(answer.rcode)))
+            return False
+        served = answer.values(check.fqdn, check.type)
+        check.last_answers[server] = sorted(served)
+        return served == check.expected
+
+    backoff = INITIAL_BACKOFF
+    while True:
+        results = await asyncio.gather(*(ask(server) for server in servers))
+        now = time.monotonic()
+        if all(results):
+            check.converged_after = now - started_at
+            return
+        if now >= deadline:
+            return
+        await asyncio.sleep(min(backoff * random.uniform(0.8, 1.2), max(0.0, deadline - now)))
+        backoff = min(backoff * 2, MAX_BACKOFF)
+
+
+async def verify_propagation(checks: List[RecordCheck], nameservers: List[Server] = None,
+                             timeout: float = DEFAULT_VERIFY_TIMEOUT, resolvers: List[Server] = None):
+    """
+    Query the authoritative nameservers of every check concurrently, with backoff, until all of them serve
+    the expected values or timeout seconds passed. Nameservers given replace the ones of the zones.
+    """
+    started_at = time.monotonic()
+    deadline = started_at + timeout
+    limit = asyncio.Semaphore(MAX_QUERIES_IN_FLIGHT)
+    servers_by_domain = {}
+    if nameservers:
+        servers_by_domain = {check.domain: nameservers for check in checks}
+    else:
+        resolvers = resolvers if resolvers is not None else system_resolvers()
+        domains = sorted({check.domain for check in checks})
+        found = await asyncio.gather(*(find_nameservers(domain, resolvers) for domain in domains),
+                                     return_exceptions=True)
+        for domain, servers in zip(domains, found):
+            if isinstance(servers, Exception):
+                raise servers
+            servers_by_domain[domain] = servers
+    await asyncio.gather(*(_converge(check, servers_by_domain[check.domain], started_at, deadline, limit)
+                           for check in checks))
+
+
+def print_verify_report(checks: List[RecordCheck], out=None) -> int:
+    """
+    Print how long each record took to be served, returns the number of records that were not by the deadline
+    """
+    pending = 0
+    for check in checks:
+        if check.converged_after is not None:
+            print('verified {} -> {} after {:.1f}s'.format(
+                check.sprint(), ', '.join(sorted(check.expected)) or 'nil', check.converged_after), file=out)
+            continue
+        pending += 1
+        answers = '; '.join('{}: {}'.format(server[0], answer if isinstance(answer, Exception)
+                                            else ', '.join(answer) or 'nil')
+                            for server, answer in sorted(check.last_answers.items()))
+        print('not served yet {} -> {}, nameservers answered {}'.format(
+            check.sprint(), ', '.join(sorted(check.expected)) or 'nil', answers), file=out)
+    return pending
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import time
+from typing import Optional, Tuple
+
+DEFAULT_DEBOUNCE = 0.2
+DEFAULT_POLL_INTERVAL = 1.0
+
+# https://man7.org/linux/man-pages/man7/inotify.7.html
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0o2000000)
+_WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+def _signature(path: str) -> Optional[Tuple[int, int, int]]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+class PollingWatcher:
+    """
+    Notices changes of a file by comparing its inode, mtime and size every `interval` seconds
+    """
+
+    def __init__(self, path: str, interval: float = DEFAULT_POLL_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self._signature = _signature(path)
+
+    def _changed(self) -> bool:
+        signature = _signature(self.path)
+        if signature == self._signature:
+            return False
+        self._signature = signature
+        return True
+
+    def _wait_events(self, timeout: Optional[float]):
+        time.sleep(self.interval if timeout is None else min(self.interval, timeout))
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Block until the file changed, True when it did and False when timeout seconds passed without a change
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            self._wait_events(remaining)
+            if self._changed():
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(PollingWatcher):
+    """
+    Wakes up on inotify events of the directory holding the file, so changes are noticed right away.
+    The directory is watched rather than the file, editors and config deployers replace files by renaming
+    over them or by swapping a symlink.
+    """
+
+    def __init__(self, path: str, interval: float = DEFAULT_POLL_INTERVAL):
+        super().__init__(path, interval)
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        directory = os.path.dirname(os.path.abspath(path))
+        if self._libc.inotify_add_watch(self._fd, os.fsencode(directory), _WATCH_MASK) < 0:
+            err = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(err, 'inotify_add_watch {} failed'.format(directory))
+
+    def _wait_events(self, timeout: Optional[float]):
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if readable:
+            self._drain()
+
+    def _drain(self):
+        # the events only wake us up, the file signature decides whether it really changed
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            if not data:
+                return
+
+    def close(self):
+        os.close(self._fd)
+
+
+def make_file_watcher(path: str, poll_interval: float = DEFAULT_POLL_INTERVAL) -> PollingWatcher:
+    """
+    An inotify watcher on linux, a polling one where inotify is not available
+    """
+    try:
+        return InotifyWatcher(path, poll_interval)
+    except (OSError, AttributeError, TypeError):
+        return PollingWatcher(path, poll_interval)
+
+
+def wait_for_change(watcher: PollingWatcher, debounce: float = DEFAULT_DEBOUNCE):
+    """
+    Block until the file changed and then stayed untouched for debounce seconds, so a burst of writes
+    is handled once
+    """
+    watcher.wait()
+    while watcher.wait(debounce):
+        pass
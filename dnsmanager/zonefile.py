@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import re
+from typing import Iterable, Iterator, List, Optional, TextIO, Tuple
+
+from dnsmanager.model import DnsRecord, DnsManipulationException, DEFAULT_DNS_TTL, CFG_KEY_DNS_RECORD_RR, \
+    CFG_KEY_DNS_RECORD_TYPE, CFG_KEY_DNS_RECORD_VALUE, CFG_KEY_DNS_RECORD_TTL, CFG_KEY_DNS_RECORD_CF_PRIORITY, \
+    CFG_KEY_DNS_RECORD_NC_MX_PREF
+
+# https://www.rfc-editor.org/rfc/rfc1035#section-5.1
+CLASSES = ('IN', 'CH', 'HS', 'CS')
+# rdata holding a single domain name, written absolute and read relative to the current origin
+HOST_TYPES = ('CNAME', 'NS', 'PTR', 'DNAME')
+TEXT_TYPES = ('TXT', 'SPF')
+# character strings are at most 255 bytes, longer values are split over several of them
+MAX_TEXT_CHUNK = 255
+# bind accepts ttls like 1h30m, https://www.rfc-editor.org/rfc/rfc2308#section-4
+_TTL_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+_TTL_PATTERN = re.compile(r'^(\d+[smhdw]?)+$', re.IGNORECASE)
+_TTL_PART = re.compile(r'(\d+)([smhdw]?)', re.IGNORECASE)
+_ESCAPE = re.compile(r'\\(\d{3}|.)')
+
+
+def _is_ttl(token: str) -> bool:
+    return _TTL_PATTERN.match(token) is not None
+
+
+def parse_ttl(token: str) -> int:
+    if not _is_ttl(token):
+        raise DnsManipulationException('invalid ttl {}'.format(token))
+    return sum(int(number) * _TTL_UNITS[unit.lower() or 's'] for number, unit in _TTL_PART.findall(token))
+
+
+def _unescape(text: str) -> str:
+    return _ESCAPE.sub(lambda m: chr(int(m.group(1))) if m.group(1).isdigit() else m.group(1), text)
+
+
+def _split_line(line: str, line_no: int) -> List[str]:
+    # quoted strings keep their quotes, so TXT data can be told apart from bare words
+    tokens = []
+    i, n = 0, len(line)
+    while i < n:
+        c = line[i]
+        if c in ' \t\r\n':
+            i += 1
+        elif c == ';':
+            break
+        elif c in '()':
+            tokens.append(c)
+            i += 1
+        elif c == '"':
+            j = i + 1
+            while j < n and line[j] != '"':
+                j += 2 if line[j] == '\\' else 1
+            if j >= n:
+                raise DnsManipulationException('unterminated quoted string at line {}'.format(line_no))
+            tokens.append(line[i:j + 1])
+            i = j + 1
+        else:
+            j = i
+            while j < n and line[j] not in ' \t\r\n;()"':
+                j += 2 if line[j] == '\\' else 1
+            tokens.append(line[i:j])
+            i = j
+    return tokens
+
+
+def _entries(fp: TextIO) -> Iterator[Tuple[int, bool, List[str]]]:
+    """
+    Line number, whether the owner is left blank, and tokens of every entry, the lines of an entry
+    in parentheses joined. One entry is held at a time.
+    """
+    tokens, depth, start, blank_owner = [], 0, 0, False
+    for line_no, line in enumerate(fp, 1):
+        line_tokens = _split_line(line, line_no)
+        if depth == 0:
+            if not line_tokens:
+                continue
+            tokens, start, blank_owner = [], line_no, line[:1] in (' ', '\t')
+        for token in line_tokens:
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                depth -= 1
+                if depth < 0:
+                    raise DnsManipulationException('unbalanced parentheses at line {}'.format(line_no))
+            else:
+                tokens.append(token)
+        if depth == 0 and tokens:
+            yield start, blank_owner, tokens
+    if depth != 0:
+        raise DnsManipulationException('unbalanced parentheses in entry of line {}'.format(start))
+
+
+def _absolute_name(name: str, origin: str) -> str:
+    # names are kept without the trailing dot, like vendor apis return them
+    if name == '@':
+        return origin
+    if name.endswith('.'):
+        return name[:-1]
+    return '{}.{}'.format(name, origin) if origin else name
+
+
+def _relative_name(name: str, domain: str, line_no: int) -> str:
+    if name.lower() == domain.lower():
+        return '@'
+    if name.lower().endswith('.' + domain.lower()):
+        return name[:-len(domain) - 1]
+    raise DnsManipulationException('{} at line {} is outside of zone {}'.format(name, line_no, domain))
+
+
+def _unquote(token: str) -> str:
+    if len(token) >= 2 and token[0] == token[-1] == '"':
+        token = token[1:-1]
+    return _unescape(token)
+
+
+def zone_file_origin(fp: TextIO) -> Optional[str]:
+    """
+    The $ORIGIN set before the first record of a zone file, None when there is none
+    """
+    for _, _, tokens in _entries(fp):
+        directive = tokens[0].upper()
+        if directive == '$ORIGIN':
+            return _absolute_name(tokens[1], '')
+        # $TTL and other directives may come before it
+        if not directive.startswith('$'):
+            return None
+    return None
+
+
+def iter_zone_records(fp: TextIO, domain: str, default_ttl: int = None) -> Iterator[dict]:
+    """
+    Stream the records of an RFC 1035 zone file as config entries of one value each: rr, type, value, ttl,
+    and the preference of MX records as priority and mx_pref. SOA records are left out, vendors manage them.
+    Records without a TTL take the $TTL, then the last TTL given, then the default TTL.
+    """
+    origin = domain
+    ttl_default = default_ttl
+    last_ttl = None
+    owner = None
+    for line_no, blank_owner, tokens in _entries(fp):
+        directive = tokens[0].upper()
+        if directive == '$ORIGIN':
+            origin = _absolute_name(tokens[1], origin)
+            continue
+        if directive == '$TTL':
+            ttl_default = parse_ttl(tokens[1])
+            continue
+        if directive.startswith('$'):
+            raise DnsManipulationException('{} at line {} is not supported'.format(tokens[0], line_no))
+
+        if not blank_owner:
+            owner = _absolute_name(tokens.pop(0), origin)
+        elif owner is None:
+            raise DnsManipulationException('record without owner name at line {}'.format(line_no))
+
+        # ttl and class may come in either order before the type
+        ttl = None
+        while tokens and (tokens[0].upper() in CLASSES or _is_ttl(tokens[0])):
+            token = tokens.pop(0)
+            if token.upper() not in CLASSES:
+                ttl = parse_ttl(token)
+        if not tokens:
+            raise DnsManipulationException('record without type at line {}'.format(line_no))
+        record_type = tokens.pop(0).upper()
+        if ttl is not None:
+            last_ttl = ttl
+        elif ttl_default is not None:
+            ttl = ttl_default
+        else:
+            ttl = last_ttl if last_ttl is not None else DEFAULT_DNS_TTL
+        if record_type == 'SOA':
+            continue
+        if not tokens:
+            raise DnsManipulationException('record without data at line {}'.format(line_no))
+
+        entry = {
+            CFG_KEY_DNS_RECORD_RR: _relative_name(owner, domain, line_no),
+            CFG_KEY_DNS_RECORD_TYPE: record_type,
+            CFG_KEY_DNS_RECORD_TTL: ttl,
+        }
+        if record_type == 'MX':
+            entry[CFG_KEY_DNS_RECORD_CF_PRIORITY] = entry[CFG_KEY_DNS_RECORD_NC_MX_PREF] = int(tokens[0])
+            entry[CFG_KEY_DNS_RECORD_VALUE] = _absolute_name(tokens[1], origin)
+        elif record_type in HOST_TYPES:
+            entry[CFG_KEY_DNS_RECORD_VALUE] = _absolute_name(tokens[0], origin)
+        elif record_type in TEXT_TYPES:
+            entry[CFG_KEY_DNS_RECORD_VALUE] = ''.join(_unquote(token) for token in tokens)
+        else:
+            entry[CFG_KEY_DNS_RECORD_VALUE] = ' '.join(tokens)
+        yield entry
+
+
+def _quote(text: str) -> str:
+    escaped = text.replace('\\', '\\\\').replace('"', '\\"')
+    return '"{}"'.format(escaped)
+
+
+def _rdata(record: DnsRecord) -> str:
+    value = str(record.value)
+    if record.type in HOST_TYPES:
+        return value if value.endswith('.') else value + '.'
+    if record.type == 'MX':
+        preference = getattr(record, 'priority', None)
+        if preference is None:
+            preference = getattr(record, 'mx_pref', None)
+        if preference is None:
+            # a made-up preference would reorder the mail servers of the zone
+            raise DnsManipulationException('MX record {} -> {} has no preference'.format(record.name, value))
+        host = value if value.endswith('.') else value + '.'
+        return '{} {}'.format(preference, host)
+    if record.type in TEXT_TYPES:
+        # values some vendors already return quoted are written as they are
+        if len(value) >= 2 and value[0] == value[-1] == '"':
+            return value
+        return ' '.join(_quote(value[i:i + MAX_TEXT_CHUNK]) for i in range(0, len(value), MAX_TEXT_CHUNK)) \
+            or '""'
+    return value
+
+
+def format_zone_record(record: DnsRecord) -> str:
+    return '{}\t{}\tIN\t{}\t{}\n'.format(record.name, record.ttl, record.type, _rdata(record))
+
+
+def write_zone(fp: TextIO, domain: str, records: Iterable[DnsRecord]) -> int:
+    """
+    Write records to fp as an RFC 1035 zone file of domain, one line each as they come.
+    Returns the number of records written.
+    """
+    fp.write('$ORIGIN {}.\n'.format(domain))
+    count = 0
+    for record in records:
+        fp.write(format_zone_record(record))
+        count += 1
+    return count
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import http.client
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import yaml
+
+from dnsmanager import dns_cli, plugins
+from dnsmanager.model import DnsRecord
+from dnsmanager.utils import ENV_CACHE_DIR
+
+LATENCY = 0.05
+
+
+class StandInApi(BaseHTTPRequestHandler):
+    """
+    Vendor api stand-in: GET /<domain> lists the records of a zone, POST adds one, PUT and DELETE /<domain>/<id>
+    update and delete one. Every call takes LATENCY seconds, connections are kept alive.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _handle(self):
+        server = self.server
+        with server.lock:
+            server.connections.add(self.client_address)
+            server.in_flight += 1
+            server.peak_in_flight = max(server.peak_in_flight, server.in_flight)
+            server.calls[self.command] += 1
+        try:
+            time.sleep(LATENCY)
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length)) if length else None
+            domain, _, record_id = self.path.strip('/').partition('/')
+            with server.lock:
+                records = server.zones.setdefault(domain, [])
+                if self.command == 'GET':
+                    result = list(records)
+                elif self.command == 'POST':
+                    server.next_id += 1
+                    result = dict(body, id=str(server.next_id))
+                    records.append(result)
+                elif self.command == 'PUT':
+                    records[:] = [dict(body, id=record_id) if r['id'] == record_id else r for r in records]
+                    result = {'id': record_id}
+                else:
+                    records[:] = [r for r in records if r['id'] != record_id]
+                    result = {}
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+        data = json.dumps(result).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+
+class StandInOps:
+    """
+    Blocking ops of the stand-in api, every thread keeps its own keep-alive connection like a pooled session
+    """
+
+    def __init__(self, port: int):
+        self.port = port
+        self._local = threading.local()
+
+    def _call(self, method: str, path: str, body=None):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection('127.0.0.1', self.port)
+        conn.request(method, path, body=json.dumps(body) if body is not None else None,
+                     headers={'Content-Type': 'application/json'})
+        return json.loads(conn.getresponse().read())
+
+    @staticmethod
+    def _record_data(record: DnsRecord) -> dict:
+        return {'name': record.name, 'type': record.type, 'value': record.value, 'ttl': record.ttl}
+
+    def get_domain_records(self, domain: str):
+        return [DnsRecord(**r) for r in self._call('GET', '/' + domain)]
+
+    def add_domain_record(self, domain: str, record: DnsRecord):
+        return self._call('POST', '/' + domain, self._record_data(record))
+
+    def update_domain_record(self, domain: str, record: DnsRecord):
+        return self._call('PUT', '/{}/{}'.format(domain, record.id), self._record_data(record))
+
+    def delete_domain_record(self, domain: str, record: DnsRecord):
+        return self._call('DELETE', '/{}/{}'.format(domain, record.id))
+
+    @staticmethod
+    def record_id_from_response(response: dict):
+        return response.get('id')
+
+
+class AsyncUpdateTest(unittest.TestCase):
+    DOMAINS = 20
+    MAX_IN_FLIGHT = 8
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInApi)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.zones = {}
+        self.server.connections = set()
+        self.server.calls = {'GET': 0, 'POST': 0, 'PUT': 0, 'DELETE': 0}
+        self.server.in_flight = self.server.peak_in_flight = self.server.next_id = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        port = self.server.server_address[1]
+        plugins.register_vendor(plugins.VendorPlugin('standin', lambda conf: StandInOps(port)))
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        env = mock.patch.dict(os.environ, {ENV_CACHE_DIR: self.tmp.name})
+        env.start()
+        self.addCleanup(env.stop)
+        self.cfg_path = os.path.join(self.tmp.name, 'dns.yml')
+        with open(self.cfg_path, 'w') as fp:
+            yaml.safe_dump({
+                'accounts': {'standin': {'vendor': 'standin', 'max_in_flight': self.MAX_IN_FLIGHT}},
+                'dns': [{'domain': 'd{}.com'.format(i), 'account': 'standin', 'records': [
+                    {'rr': 'www', 'type': 'A', 'value': ['1.1.1.{}'.format(i), '2.2.2.2']},
+                ]} for i in range(self.DOMAINS)],
+            }, fp)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _update(self):
+        with redirect_stdout(io.StringIO()):
+            dns_cli.load_and_update_dns_config(self.cfg_path, workers=self.DOMAINS, use_cache=False, use_async=True)
+
+    def test_calls_of_many_domains_run_concurrently_on_pooled_connections(self):
+        started_at = time.monotonic()
+        self._update()
+        elapsed = time.monotonic() - started_at
+
+        for i in range(self.DOMAINS):
+            values = sorted(r['value'] for r in self.server.zones['d{}.com'.format(i)])
+            self.assertEqual(['1.1.1.{}'.format(i), '2.2.2.2'], values)
+        calls = sum(self.server.calls.values())
+        self.assertEqual(self.DOMAINS * 3, calls)
+        # one list and two adds per domain, one after the other within a domain
+        self.assertLess(elapsed, calls * LATENCY / 2)
+        self.assertGreater(self.server.peak_in_flight, 1)
+        self.assertLessEqual(self.server.peak_in_flight, self.MAX_IN_FLIGHT)
+        self.assertLessEqual(len(self.server.connections), self.MAX_IN_FLIGHT)
+
+    def test_update_in_sync_only_lists(self):
+        self._update()
+        self.server.calls.update({'GET': 0, 'POST': 0})
+        self._update()
+        self.assertEqual({'GET': self.DOMAINS, 'POST': 0, 'PUT': 0, 'DELETE': 0}, self.server.calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
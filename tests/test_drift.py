@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import itertools
+import unittest
+
+from dnsmanager.drift import EXIT_DRIFT, EXIT_FAILED, EXIT_IN_SYNC, DriftCheck, domain_report, drift_report, \
+    exit_status
+from dnsmanager.model import AliyunDnsRecord, CloudflareDnsRecord, DnsManipulationException, DnsRecord, \
+    NamecheapDnsRecord
+
+TTLS = (None, 60, 600)
+KEYS = (('www', 'A', '1.1.1.1'), ('www', 'A', '2.2.2.2'), ('@', 'MX', 'mx.example.com'))
+
+
+def _records(record_class, **fields):
+    names = sorted(fields)
+    for name, record_type, value in KEYS:
+        for ttl in TTLS:
+            for values in itertools.product(*(fields[field] for field in names)):
+                yield record_class(name=name, type=record_type, value=value, ttl=ttl, **dict(zip(names, values)))
+
+
+class DriftKeyTest(unittest.TestCase):
+    """
+    remote.drift_key(local) == local.drift_key() exactly when remote.equals(local), for every record class
+    """
+
+    def assert_invariant(self, remote_records, local_records):
+        local_records = list(local_records)
+        for remote in remote_records:
+            for local in local_records:
+                self.assertEqual(remote.equals(local), remote.drift_key(local) == local.drift_key(),
+                                 '{!r} against {!r}'.format(remote, local))
+
+    def test_dns_record(self):
+        self.assert_invariant(_records(DnsRecord), _records(DnsRecord))
+
+    def test_cloudflare_record(self):
+        fields = {'proxied': (False, True), 'priority': (None, 10, 20)}
+        self.assert_invariant(_records(CloudflareDnsRecord, **fields), _records(CloudflareDnsRecord, **fields))
+
+    def test_namecheap_record(self):
+        fields = {'mx_pref': (None, 10, 20)}
+        self.assert_invariant(_records(NamecheapDnsRecord, **fields), _records(NamecheapDnsRecord, **fields))
+
+    def test_aliyun_record(self):
+        # config records of aliyun domains are plain records, the priority listed is not compared
+        self.assert_invariant(_records(AliyunDnsRecord, priority=(None, 10)), _records(DnsRecord))
+
+
+class DriftCheckTest(unittest.TestCase):
+    LOCAL = [[DnsRecord(name='www', type='A', value='1.1.1.1', ttl=600)]]
+
+    def test_in_sync_with_unmanaged_names(self):
+        check = DriftCheck('example.com', self.LOCAL).feed([
+            DnsRecord(id='1', name='www', type='A', value='1.1.1.1', ttl=600),
+            DnsRecord(id='2', name='other', type='A', value='2.2.2.2', ttl=600)])
+
+        self.assertFalse(check.drifted())
+        self.assertEqual([], list(check.changeset()))
+
+    def test_drifted(self):
+        check = DriftCheck('example.com', self.LOCAL).feed([
+            DnsRecord(id='1', name='www', type='A', value='1.1.1.1', ttl=60)])
+
+        self.assertTrue(check.drifted())
+        self.assertEqual(['update'], [change.action for change in check.changeset()])
+
+
+class DriftReportTest(unittest.TestCase):
+
+    def test_exit_status(self):
+        in_sync = domain_report('a.com', 'aliyun', DriftCheck('a.com', []).changeset())
+        drifted = domain_report('b.com', 'aliyun', DriftCheck('b.com', DriftCheckTest.LOCAL).changeset())
+        failed = domain_report('c.com', 'aliyun', error=DnsManipulationException('listing failed'))
+
+        self.assertEqual(EXIT_IN_SYNC, exit_status(drift_report(1, [in_sync], 0.1)))
+        self.assertEqual(EXIT_DRIFT, exit_status(drift_report(2, [in_sync, drifted], 0.1)))
+        self.assertEqual(EXIT_FAILED, exit_status(drift_report(3, [in_sync, drifted, failed], 0.1)))
+        report = drift_report(0, [], 0.1, error=DnsManipulationException('unknown account'))
+        self.assertEqual('DnsManipulationException: unknown account', report['error'])
+        self.assertEqual(EXIT_FAILED, exit_status(report))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import io
+import threading
+import time
+import unittest
+
+from dnsmanager.executor import InFlightLimit, run_domain_jobs
+
+
+class Account:
+    """
+    Counts the jobs of one account running at the same time
+    """
+
+    def __init__(self, limit: int = None):
+        self.in_flight = InFlightLimit(limit)
+        self.running = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def job(self, name: str, delay: float = 0.05, error: Exception = None):
+        def run(out):
+            with self.lock:
+                self.running += 1
+                self.peak = max(self.peak, self.running)
+            try:
+                print('{} start'.format(name), file=out)
+                time.sleep(delay)
+                if error is not None:
+                    raise error
+                print('{} done'.format(name), file=out)
+            finally:
+                with self.lock:
+                    self.running -= 1
+        return self.in_flight, run
+
+
+class RunDomainJobsTest(unittest.TestCase):
+
+    def test_max_in_flight_caps_each_account(self):
+        capped, free = Account(limit=2), Account()
+        jobs = [capped.job('c{}'.format(i)) for i in range(6)] + [free.job('f{}'.format(i)) for i in range(4)]
+
+        run_domain_jobs(jobs, workers=8, out=io.StringIO())
+
+        self.assertEqual(2, capped.peak)
+        # the jobs queued behind the capped account do not hold workers the other account could use
+        self.assertEqual(4, free.peak)
+
+    def test_workers_cap_every_account(self):
+        accounts = [Account(limit=4) for _ in range(3)]
+        running = []
+        jobs = [account.job('{}-{}'.format(a, i)) for a, account in enumerate(accounts) for i in range(4)]
+
+        def watch():
+            while not done.is_set():
+                running.append(sum(account.running for account in accounts))
+                time.sleep(0.005)
+
+        done = threading.Event()
+        watcher = threading.Thread(target=watch)
+        watcher.start()
+        try:
+            run_domain_jobs(jobs, workers=3, out=io.StringIO())
+        finally:
+            done.set()
+            watcher.join()
+        self.assertLessEqual(max(running), 3)
+
+    def test_output_of_each_domain_is_written_in_one_piece(self):
+        account = Account()
+        out = io.StringIO()
+
+        run_domain_jobs([account.job('d{}'.format(i), delay=0.01 * (5 - i)) for i in range(5)], workers=5, out=out)
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual(10, len(lines))
+        for start, done in zip(lines[::2], lines[1::2]):
+            self.assertEqual(start.replace('start', 'done'), done)
+
+    def test_failures_are_raised_after_every_job_ran(self):
+        for workers in (1, 4):
+            account = Account()
+            out = io.StringIO()
+            jobs = [account.job('d0'), account.job('d1', error=ValueError('first')),
+                    account.job('d2', error=KeyError('second')), account.job('d3')]
+
+            with self.assertRaises(ValueError):
+                run_domain_jobs(jobs, workers=workers, out=out)
+
+            self.assertIn('d3 done', out.getvalue(), 'workers={}'.format(workers))
+            self.assertIn('d0 done', out.getvalue(), 'workers={}'.format(workers))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import unittest
+
+from dnsmanager.fetch import iter_remote_records
+from dnsmanager.metrics import Metrics
+from dnsmanager.model import DnsManipulationException, DnsRecord
+
+
+class PagedOps:
+    """
+    Ops that stream the records of a zone page by page, and fail on the page given
+    """
+
+    def __init__(self, pages: int, fail_on_page: int = None):
+        self.pages = pages
+        self.fail_on_page = fail_on_page
+
+    def iter_domain_records(self, domain: str):
+        for page in range(1, self.pages + 1):
+            if page == self.fail_on_page:
+                raise DnsManipulationException('page {} failed'.format(page))
+            yield DnsRecord(name='h{}'.format(page), type='A', value='1.1.1.1')
+
+    def get_domain_records(self, domain: str):
+        return list(self.iter_domain_records(domain))
+
+
+class InstrumentedOpsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def _call(self, op: str) -> dict:
+        calls = [call for call in self.metrics.to_dict()['calls'] if call['op'] == op]
+        return calls[0] if calls else None
+
+    def test_listing_streamed_through_iter_remote_records_is_timed(self):
+        ops = self.metrics.instrument(PagedOps(pages=3), 'fake')
+
+        records = list(iter_remote_records(ops, 'example.com'))
+
+        self.assertEqual(3, len(records))
+        call = self._call('iter_domain_records')
+        self.assertEqual((1, 0), (call['count'], call['errors']))
+
+    def test_errors_raised_while_iterating_are_counted(self):
+        ops = self.metrics.instrument(PagedOps(pages=3, fail_on_page=2), 'fake')
+
+        stream = iter_remote_records(ops, 'example.com')
+        self.assertEqual('h1', next(stream).name)
+        # nothing is observed before the stream is used up
+        self.assertIsNone(self._call('iter_domain_records'))
+        with self.assertRaises(DnsManipulationException):
+            list(stream)
+
+        call = self._call('iter_domain_records')
+        self.assertEqual((1, 1), (call['count'], call['errors']))
+
+    def test_stream_closed_early_is_no_error(self):
+        ops = self.metrics.instrument(PagedOps(pages=3), 'fake')
+
+        stream = ops.iter_domain_records('example.com')
+        next(stream)
+        stream.close()
+
+        call = self._call('iter_domain_records')
+        self.assertEqual((1, 0), (call['count'], call['errors']))
+
+    def test_calls_are_timed(self):
+        ops = self.metrics.instrument(PagedOps(pages=2, fail_on_page=2), 'fake')
+
+        with self.assertRaises(DnsManipulationException):
+            ops.get_domain_records('example.com')
+
+        call = self._call('get_domain_records')
+        self.assertEqual((1, 1), (call['count'], call['errors']))
+        self.assertIn('dns_manager_vendor_call_errors_total{vendor="fake",op="get_domain_records"} 1',
+                      self.metrics.to_prometheus())
+
+
+if __name__ == '__main__':
+    unittest.main()
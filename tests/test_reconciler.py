@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import unittest
+
+from dnsmanager.model import ACTION_ADD, ACTION_DELETE, ACTION_UPDATE, CloudflareDnsRecord, DnsRecord
+from dnsmanager.reconciler import ZoneIndex, compute_changeset
+
+
+def _actions(changeset):
+    return [(change.action, change.record.name, change.record.type, change.record.value, change.reason)
+            for change in changeset]
+
+
+class ZoneIndexTest(unittest.TestCase):
+
+    def test_find_by_name_type_and_value(self):
+        a = DnsRecord(id='1', name='www', type='A', value='1.1.1.1')
+        cname = DnsRecord(id='2', name='blog', type='CNAME', value='pages.example.net.')
+        index = ZoneIndex([a, cname])
+
+        self.assertEqual([a], index.find('www'))
+        self.assertEqual([], index.find('www', 'AAAA'))
+        self.assertIs(a, index.find_value('www', 'A', '1.1.1.1'))
+        # CNAME values are compared without the trailing dot
+        self.assertIs(cname, index.find_value('blog', 'CNAME', 'pages.example.net'))
+        self.assertEqual(2, len(index))
+
+    def test_remove_keeps_a_duplicate_value_indexed(self):
+        first = DnsRecord(id='1', name='www', type='A', value='1.1.1.1')
+        duplicate = DnsRecord(id='2', name='www', type='A', value='1.1.1.1')
+        index = ZoneIndex([first, duplicate])
+
+        index.remove(first)
+
+        self.assertIs(duplicate, index.find_key(first.key))
+        self.assertEqual([duplicate], index.records())
+
+    def test_replace(self):
+        old = DnsRecord(id='1', name='www', type='A', value='1.1.1.1', ttl=60)
+        new = DnsRecord(id='1', name='www', type='A', value='1.1.1.1', ttl=600)
+        index = ZoneIndex([old])
+
+        index.replace(old, new)
+
+        self.assertIs(new, index.find_key(new.key))
+        self.assertEqual([new], index.find('www', 'A'))
+
+
+class ComputeChangesetTest(unittest.TestCase):
+
+    def test_in_sync(self):
+        remote = [DnsRecord(id='1', name='www', type='A', value='1.1.1.1', ttl=600)]
+        local = [[DnsRecord(name='www', type='A', value='1.1.1.1', ttl=600)]]
+        self.assertEqual([], _actions(compute_changeset('example.com', ZoneIndex(remote), local)))
+
+    def test_add_and_delete_stale_values(self):
+        remote = [DnsRecord(id='1', name='www', type='A', value='1.1.1.1', ttl=600),
+                  DnsRecord(id='2', name='www', type='A', value='2.2.2.2', ttl=600),
+                  DnsRecord(id='3', name='other', type='A', value='3.3.3.3', ttl=600)]
+        local = [[DnsRecord(name='www', type='A', value='1.1.1.1', ttl=600),
+                  DnsRecord(name='www', type='A', value='4.4.4.4', ttl=600)]]
+
+        changeset = compute_changeset('example.com', ZoneIndex(remote), local)
+
+        # names and types the config does not manage are left alone
+        self.assertEqual([(ACTION_ADD, 'www', 'A', '4.4.4.4', None),
+                          (ACTION_DELETE, 'www', 'A', '2.2.2.2', 'stale')], _actions(changeset))
+        self.assertEqual(2, len(changeset.local_records))
+
+    def test_update_carries_the_remote_identity(self):
+        remote = [CloudflareDnsRecord(id='r1', name='www', type='A', value='1.1.1.1', ttl=60, zone_id='z1')]
+        local = CloudflareDnsRecord(name='www', type='A', value='1.1.1.1', ttl=600)
+
+        changeset = compute_changeset('example.com', ZoneIndex(remote), [[local]])
+
+        self.assertEqual([(ACTION_UPDATE, 'www', 'A', '1.1.1.1', None)], _actions(changeset))
+        self.assertIs(remote[0], changeset.changes[0].old)
+        self.assertEqual(('r1', 'z1'), (local.id, local.zone_id))
+
+    def test_cname_replaces_conflicting_address_records(self):
+        remote = [DnsRecord(id='1', name='www', type='A', value='1.1.1.1', ttl=600),
+                  DnsRecord(id='2', name='www', type='AAAA', value='::1', ttl=600),
+                  DnsRecord(id='3', name='www', type='TXT', value='keep', ttl=600)]
+        local = [[DnsRecord(name='www', type='CNAME', value='web.example.net', ttl=600)]]
+
+        changeset = compute_changeset('example.com', ZoneIndex(remote), local)
+
+        self.assertEqual([(ACTION_DELETE, 'www', 'A', '1.1.1.1', 'conflict'),
+                          (ACTION_DELETE, 'www', 'AAAA', '::1', 'conflict'),
+                          (ACTION_ADD, 'www', 'CNAME', 'web.example.net', None)], _actions(changeset))
+
+    def test_address_record_replaces_conflicting_cname(self):
+        remote = [DnsRecord(id='1', name='www', type='CNAME', value='web.example.net', ttl=600)]
+        local = [[DnsRecord(name='www', type='A', value='1.1.1.1', ttl=600)]]
+
+        changeset = compute_changeset('example.com', ZoneIndex(remote), local)
+
+        self.assertEqual([(ACTION_DELETE, 'www', 'CNAME', 'web.example.net', 'conflict'),
+                          (ACTION_ADD, 'www', 'A', '1.1.1.1', None)], _actions(changeset))
+
+    def test_index_is_patched_within_the_pass(self):
+        remote = [DnsRecord(id='1', name='www', type='CNAME', value='web.example.net', ttl=600)]
+        index = ZoneIndex(remote)
+        # the second group must see the CNAME already deleted by the first one, and not delete it again
+        local = [[DnsRecord(name='www', type='A', value='1.1.1.1', ttl=600)],
+                 [DnsRecord(name='www', type='AAAA', value='::1', ttl=600)]]
+
+        changeset = compute_changeset('example.com', index, local)
+
+        self.assertEqual([(ACTION_DELETE, 'www', 'CNAME', 'web.example.net', 'conflict'),
+                          (ACTION_ADD, 'www', 'A', '1.1.1.1', None),
+                          (ACTION_ADD, 'www', 'AAAA', '::1', None)], _actions(changeset))
+        self.assertEqual({('www', 'A', '1.1.1.1'), ('www', 'AAAA', '::1')},
+                         {record.key for record in index.records()})
+
+
+if __name__ == '__main__':
+    unittest.main()
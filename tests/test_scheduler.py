@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import unittest
+from email.utils import formatdate
+from unittest import mock
+
+from dnsmanager import scheduler
+from dnsmanager.scheduler import RequestScheduler, TokenBucket, parse_retry_after
+
+
+class FakeClock:
+    """
+    Stands in for the time module of the scheduler, sleeping only moves the clock forward
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    perf_counter = time = monotonic
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class Throttled(Exception):
+
+    def __init__(self, retry_after=None):
+        super(Throttled, self).__init__('throttled')
+        self.retry_after = retry_after
+
+
+class FlakyCall:
+    """
+    Raises the given errors one call after the other, then returns ok
+    """
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+
+class SchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(scheduler, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TokenBucketTest(SchedulerTestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        for _ in range(3):
+            bucket.acquire(self.clock.sleep)
+        self.assertEqual([], self.clock.sleeps)
+
+        bucket.acquire(self.clock.sleep)
+        self.assertEqual([0.5], self.clock.sleeps)
+
+    def test_tokens_refill_while_idle_up_to_the_burst(self):
+        bucket = TokenBucket(rate=1, burst=2)
+        bucket.acquire(self.clock.sleep)
+        bucket.acquire(self.clock.sleep)
+        self.clock.now += 60
+
+        for _ in range(2):
+            bucket.acquire(self.clock.sleep)
+        self.assertEqual([], self.clock.sleeps)
+        bucket.acquire(self.clock.sleep)
+        self.assertEqual([1.0], self.clock.sleeps)
+
+    def test_pause_holds_back_callers(self):
+        bucket = TokenBucket(rate=10, burst=10)
+        bucket.pause(5)
+
+        bucket.acquire(self.clock.sleep)
+
+        self.assertEqual(5, sum(self.clock.sleeps))
+
+
+class ParseRetryAfterTest(SchedulerTestCase):
+
+    def test_seconds(self):
+        self.assertEqual(3.0, parse_retry_after('3'))
+        self.assertEqual(1.5, parse_retry_after(1.5))
+        self.assertEqual(0.0, parse_retry_after('-4'))
+
+    def test_http_date(self):
+        self.clock.now = 1700000000.0
+        self.assertEqual(120.0, parse_retry_after(formatdate(1700000120.0, usegmt=True)))
+        self.assertEqual(0.0, parse_retry_after(formatdate(1699999000.0, usegmt=True)))
+
+    def test_malformed(self):
+        self.assertIsNone(parse_retry_after('soon'))
+        self.assertIsNone(parse_retry_after(None))
+
+
+class RequestSchedulerTest(SchedulerTestCase):
+
+    def _scheduler(self, **kwargs):
+        return RequestScheduler(is_throttle_error=lambda e: isinstance(e, Throttled), sleep=self.clock.sleep,
+                                **kwargs)
+
+    def test_throttled_calls_are_retried_with_growing_backoff(self):
+        call = FlakyCall(Throttled(), Throttled(), Throttled())
+        requests = self._scheduler(base_delay=1, max_delay=3)
+
+        with mock.patch.object(scheduler.random, 'uniform', side_effect=lambda low, high: high):
+            self.assertEqual('ok', requests.call(call))
+
+        self.assertEqual(4, call.calls)
+        self.assertEqual(3, requests.retries)
+        self.assertEqual([1, 2, 3], self.clock.sleeps)
+
+    def test_other_errors_are_not_retried(self):
+        call = FlakyCall(ValueError('bad request'))
+        requests = self._scheduler()
+
+        with self.assertRaises(ValueError):
+            requests.call(call)
+        self.assertEqual(1, call.calls)
+        self.assertEqual([], self.clock.sleeps)
+
+    def test_gives_up_after_max_retries(self):
+        call = FlakyCall(*[Throttled() for _ in range(5)])
+        requests = self._scheduler(max_retries=2)
+
+        with self.assertRaises(Throttled):
+            requests.call(call)
+        self.assertEqual(3, call.calls)
+
+    def test_waits_as_long_as_the_server_asks_up_to_max_delay(self):
+        call = FlakyCall(Throttled(retry_after='7'), Throttled(retry_after='86400'))
+        requests = self._scheduler(max_delay=30)
+
+        self.assertEqual('ok', requests.call(call))
+        self.assertEqual([7.0, 30], self.clock.sleeps)
+
+    def test_retry_after_pauses_the_bucket(self):
+        call = FlakyCall(Throttled(retry_after=4))
+        requests = self._scheduler(rate=100, burst=100)
+
+        self.assertEqual('ok', requests.call(call))
+        self.assertEqual(4, sum(self.clock.sleeps))
+
+    def test_observers(self):
+        seen = []
+        requests = self._scheduler()
+        requests.on_request = lambda seconds, error: seen.append(('request', type(error).__name__))
+        requests.on_retry = lambda error, delay: seen.append(('retry', delay))
+
+        requests.call(FlakyCall(Throttled(retry_after=2)))
+
+        self.assertEqual([('request', 'Throttled'), ('retry', 2.0), ('request', 'NoneType')], seen)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import asyncio
+import io
+import socket
+import struct
+import time
+import unittest
+from unittest import mock
+
+from dnsmanager import verify
+from dnsmanager.model import DnsManipulationException
+from dnsmanager.verify import FLAG_TC, QTYPES, RecordCheck, build_query, parse_response, print_verify_report, \
+    query, verify_propagation
+
+_TYPE_NAMES = {code: name for name, code in QTYPES.items()}
+FLAG_RESPONSE = 0x8400  # QR and AA
+
+
+def _encode_name(name: str) -> bytes:
+    return b''.join(struct.pack('!B', len(label)) + label.encode('ascii') for label in name.split('.') if label) \
+        + b'\x00'
+
+
+def _rdata(record_type: str, value: str) -> bytes:
+    if record_type == 'A':
+        return socket.inet_pton(socket.AF_INET, value)
+    if record_type == 'AAAA':
+        return socket.inet_pton(socket.AF_INET6, value)
+    if record_type == 'MX':
+        preference, host = value.split()
+        return struct.pack('!H', int(preference)) + _encode_name(host)
+    if record_type == 'TXT':
+        data = value.encode('utf-8')
+        return b''.join(struct.pack('!B', len(data[i:i + 255])) + data[i:i + 255] for i in range(0, len(data), 255))
+    return _encode_name(value)
+
+
+class StubNameserver:
+    """
+    Authoritative nameserver stand-in on 127.0.0.1, answering over UDP and TCP on the same port from `zone`,
+    which maps (name, type) to values. Values of `pending` are served instead until `serve_at`.
+    With `truncate`, UDP answers come back empty with TC set. With `spoof`, every UDP answer is preceded
+    by one with another query id and a value the zone does not hold. `rcode` is set on every answer.
+    """
+
+    def __init__(self):
+        self.zone = {}
+        self.pending = {}
+        self.serve_at = 0.0
+        self.truncate = False
+        self.spoof = False
+        self.rcode = 0
+        self.queries = {'udp': 0, 'tcp': 0}
+        self.port = None
+        self._transport = None
+        self._server = None
+
+    def _answers(self, name: str, record_type: str) -> list:
+        key = (name.lower(), record_type)
+        if time.monotonic() < self.serve_at and key in self.pending:
+            return self.pending[key]
+        return self.zone.get(key, [])
+
+    def respond(self, message: bytes, over_udp: bool, query_id: int = None, values: list = None) -> bytes:
+        message_id, _, _, _, _, _ = struct.unpack('!HHHHHH', message[:12])
+        offset, labels = 12, []
+        while message[offset]:
+            labels.append(message[offset + 1:offset + 1 + message[offset]].decode('ascii'))
+            offset += 1 + message[offset]
+        question = message[12:offset + 5]
+        record_type = _TYPE_NAMES[struct.unpack('!H', message[offset + 1:offset + 3])[0]]
+        if values is None:
+            values = self._answers('.'.join(labels), record_type)
+        flags = FLAG_RESPONSE | self.rcode
+        if over_udp and self.truncate:
+            flags, values = flags | FLAG_TC, []
+        answers = b''
+        for value in values:
+            rdata = _rdata(record_type, value)
+            # the owner is a pointer to the name of the question
+            answers += struct.pack('!HHHIH', 0xC00C, QTYPES[record_type], 1, 60, len(rdata)) + rdata
+        header = struct.pack('!HHHHHH', message_id if query_id is None else query_id, flags, 1, len(values), 0, 0)
+        return header + question + answers
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        stub = self
+
+        class Udp(asyncio.DatagramProtocol):
+            def connection_made(self, transport):
+                self.transport = transport
+
+            def datagram_received(self, data, addr):
+                stub.queries['udp'] += 1
+                if stub.spoof:
+                    spoofed = (struct.unpack('!H', data[:2])[0] + 1) & 0xFFFF
+                    self.transport.sendto(stub.respond(data, True, spoofed, ['6.6.6.6']), addr)
+                self.transport.sendto(stub.respond(data, True), addr)
+
+        async def tcp(reader, writer):
+            length = struct.unpack('!H', await reader.readexactly(2))[0]
+            message = await reader.readexactly(length)
+            stub.queries['tcp'] += 1
+            response = stub.respond(message, False)
+            writer.write(struct.pack('!H', len(response)) + response)
+            await writer.drain()
+            writer.close()
+
+        self._transport, _ = await loop.create_datagram_endpoint(Udp, local_addr=('127.0.0.1', 0))
+        self.port = self._transport.get_extra_info('sockname')[1]
+        self._server = await asyncio.start_server(tcp, '127.0.0.1', self.port)
+        return '127.0.0.1', self.port
+
+    async def stop(self):
+        self._transport.close()
+        self._server.close()
+        await self._server.wait_closed()
+
+
+class VerifyTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.stub = StubNameserver()
+        self.server = await self.stub.start()
+        backoff = mock.patch.object(verify, 'INITIAL_BACKOFF', 0.05)
+        backoff.start()
+        self.addCleanup(backoff.stop)
+
+    async def asyncTearDown(self):
+        await self.stub.stop()
+
+    async def test_converges_once_the_new_values_are_served(self):
+        self.stub.zone[('www.example.com', 'A')] = ['1.1.1.1', '2.2.2.2']
+        self.stub.pending[('www.example.com', 'A')] = ['9.9.9.9']
+        self.stub.zone[('example.com', 'MX')] = ['10 mx.example.com']
+        self.stub.serve_at = time.monotonic() + 0.3
+        checks = [RecordCheck('example.com', 'www', 'A', frozenset({'1.1.1.1', '2.2.2.2'})),
+                  RecordCheck('example.com', '@', 'MX', frozenset({'mx.example.com'})),
+                  RecordCheck('example.com', 'old', 'TXT', frozenset())]
+
+        await verify_propagation(checks, [self.server], timeout=5)
+
+        self.assertGreaterEqual(checks[0].converged_after, 0.3)
+        self.assertLess(checks[1].converged_after, 0.3)
+        self.assertIsNotNone(checks[2].converged_after)
+        self.assertEqual(0, print_verify_report(checks, out=io.StringIO()))
+
+    async def test_record_never_served(self):
+        self.stub.zone[('www.example.com', 'A')] = ['1.1.1.1']
+        checks = [RecordCheck('example.com', 'www', 'A', frozenset({'2.2.2.2'}))]
+        started_at = time.monotonic()
+
+        await verify_propagation(checks, [self.server], timeout=0.5)
+
+        self.assertLess(time.monotonic() - started_at, 2)
+        self.assertIsNone(checks[0].converged_after)
+        self.assertEqual(['1.1.1.1'], checks[0].last_answers[self.server])
+        out = io.StringIO()
+        self.assertEqual(1, print_verify_report(checks, out=out))
+        self.assertIn('not served yet [A] www.example.com -> 2.2.2.2, nameservers answered 127.0.0.1: 1.1.1.1',
+                      out.getvalue())
+
+    async def test_servfail_is_not_taken_for_a_deleted_record(self):
+        self.stub.rcode = 2
+        checks = [RecordCheck('example.com', 'old', 'TXT', frozenset())]
+
+        await verify_propagation(checks, [self.server], timeout=0.3)
+
+        self.assertIsNone(checks[0].converged_after)
+        out = io.StringIO()
+        self.assertEqual(1, print_verify_report(checks, out=out))
+        self.assertIn('not served yet [TXT] old.example.com -> nil, nameservers answered 127.0.0.1: SERVFAIL',
+                      out.getvalue())
+
+        # NXDOMAIN is an answer, the name is gone
+        self.stub.rcode = 3
+        await verify_propagation(checks, [self.server], timeout=0.3)
+        self.assertIsNotNone(checks[0].converged_after)
+
+    async def test_truncated_answer_is_asked_again_over_tcp(self):
+        self.stub.zone[('txt.example.com', 'TXT')] = ['v=spf1 ' + 'include:example.net ' * 30]
+        self.stub.truncate = True
+
+        answer = await query(self.server, 'txt.example.com', 'TXT')
+
+        self.assertEqual(frozenset(self.stub.zone[('txt.example.com', 'TXT')]),
+                         answer.values('txt.example.com', 'TXT'))
+        self.assertEqual({'udp': 1, 'tcp': 1}, self.stub.queries)
+
+    async def test_answer_with_mismatched_query_id_is_ignored(self):
+        self.stub.zone[('www.example.com', 'A')] = ['1.1.1.1']
+        self.stub.spoof = True
+
+        answer = await query(self.server, 'www.example.com', 'A')
+
+        self.assertEqual(frozenset({'1.1.1.1'}), answer.values('www.example.com', 'A'))
+        self.assertEqual({'udp': 1, 'tcp': 0}, self.stub.queries)
+
+    def test_parse_response_rejects_mismatched_query_id(self):
+        response = self.stub.respond(build_query(1, 'www.example.com', 'A'), True)
+        with self.assertRaises(DnsManipulationException):
+            parse_response(response, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import io
+import os
+import tempfile
+import unittest
+
+from dnsmanager.dns_cli import _keep_remote_proxied
+from dnsmanager.model import AliyunDnsRecord, CloudflareDnsRecord, DnsManipulationException, DnsRecord, \
+    NamecheapDnsRecord, parse_cloudflare_dns_record_from_config
+from dnsmanager.utils import open_atomic
+from dnsmanager.zonefile import iter_zone_records, write_zone, zone_file_origin
+
+
+def _records(text: str, domain: str = 'example.com'):
+    return list(iter_zone_records(io.StringIO(text), domain))
+
+
+def _record(rr, record_type, value, ttl, **extra):
+    return dict({'rr': rr, 'type': record_type, 'value': value, 'ttl': ttl}, **extra)
+
+
+class ZoneFileOriginTest(unittest.TestCase):
+
+    def test_origin_after_ttl(self):
+        self.assertEqual('example.com', zone_file_origin(io.StringIO('$TTL 1h\n$ORIGIN example.com.\nwww A 1.1.1.1\n')))
+
+    def test_origin_after_first_record_is_not_the_origin_of_the_file(self):
+        self.assertIsNone(zone_file_origin(io.StringIO('$TTL 1h\nwww A 1.1.1.1\n$ORIGIN example.com.\n')))
+
+    def test_no_origin(self):
+        self.assertIsNone(zone_file_origin(io.StringIO('; comment only\n')))
+
+
+class IterZoneRecordsTest(unittest.TestCase):
+
+    def test_ttl_before_origin(self):
+        records = _records('$TTL 1h30m\n$ORIGIN example.com.\nwww IN A 1.1.1.1\nold 60 A 2.2.2.2\n')
+        self.assertEqual([_record('www', 'A', '1.1.1.1', 5400), _record('old', 'A', '2.2.2.2', 60)], records)
+
+    def test_parentheses_join_lines_and_soa_is_skipped(self):
+        records = _records('@ 3600 IN SOA ns1.example.com. admin.example.com. (\n'
+                           '    2024010101 ; serial\n'
+                           '    7200 3600 1209600 300 )\n'
+                           '@ 3600 IN TXT ( "v=spf1"\n'
+                           '    " -all" )\n')
+        self.assertEqual([_record('@', 'TXT', 'v=spf1 -all', 3600)], records)
+
+    def test_blank_owner_repeats_the_previous_owner(self):
+        records = _records('www 300 A 1.1.1.1\n    300 A 2.2.2.2\n\tAAAA ::1\n')
+        self.assertEqual(['www'] * 3, [record['rr'] for record in records])
+        self.assertEqual(['A', 'A', 'AAAA'], [record['type'] for record in records])
+
+    def test_blank_owner_without_previous_owner(self):
+        with self.assertRaises(DnsManipulationException):
+            _records('    300 A 1.1.1.1\n')
+
+    def test_quoted_and_escaped_text(self):
+        records = _records('txt 300 TXT "a \\"quoted\\" word; not a comment" "\\065\\\\"\n')
+        self.assertEqual('a "quoted" word; not a comment' + 'A\\', records[0]['value'])
+
+    def test_relative_and_absolute_names(self):
+        records = _records('$ORIGIN example.com.\n'
+                           'www 300 CNAME web\n'
+                           'web.example.com. 300 CNAME cdn.other.net.\n'
+                           '$ORIGIN sub.example.com.\n'
+                           'host 300 A 1.1.1.1\n'
+                           '@ 300 MX 5 mail\n')
+        self.assertEqual([_record('www', 'CNAME', 'web.example.com', 300),
+                          _record('web', 'CNAME', 'cdn.other.net', 300),
+                          _record('host.sub', 'A', '1.1.1.1', 300),
+                          _record('sub', 'MX', 'mail.sub.example.com', 300, priority=5, mx_pref=5)], records)
+
+    def test_name_outside_of_zone(self):
+        with self.assertRaises(DnsManipulationException):
+            _records('www.other.net. 300 A 1.1.1.1\n')
+
+
+class WriteZoneTest(unittest.TestCase):
+    RECORDS = [
+        DnsRecord(name='@', type='A', value='1.1.1.1', ttl=600),
+        DnsRecord(name='www', type='CNAME', value='example.com', ttl=300),
+        DnsRecord(name='txt', type='TXT', value='say "hi"; ' + 'x' * 300, ttl=300),
+        AliyunDnsRecord(name='@', type='MX', value='mx1.example.com', ttl=300, priority=5),
+        CloudflareDnsRecord(name='@', type='MX', value='mx2.example.com', ttl=300, priority=20),
+        NamecheapDnsRecord(name='@', type='MX', value='mx3.example.com', ttl=300, mx_pref=30),
+    ]
+
+    def test_export_import_round_trip(self):
+        fp = io.StringIO()
+        self.assertEqual(len(self.RECORDS), write_zone(fp, 'example.com', self.RECORDS))
+        fp.seek(0)
+        self.assertEqual('example.com', zone_file_origin(fp))
+        fp.seek(0)
+        imported = [record for entry in iter_zone_records(fp, 'example.com')
+                    for record in parse_cloudflare_dns_record_from_config(entry)]
+        self.assertEqual(len(self.RECORDS), len(imported))
+        for written, read in zip(self.RECORDS, imported):
+            self.assertEqual(written.key, read.key)
+            self.assertEqual(written.ttl, read.ttl)
+        self.assertEqual([5, 20, 30], [record.priority for record in imported if record.type == 'MX'])
+
+    def test_mx_without_preference(self):
+        with self.assertRaises(DnsManipulationException):
+            write_zone(io.StringIO(), 'example.com', [DnsRecord(name='@', type='MX', value='mx.example.com', ttl=1)])
+
+    def test_failed_export_leaves_the_zone_file_as_it_was(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'example.com.zone')
+            with open(path, 'w') as fp:
+                fp.write('previous export\n')
+
+            with self.assertRaises(DnsManipulationException):
+                with open_atomic(path) as fp:
+                    write_zone(fp, 'example.com',
+                               self.RECORDS[:3] + [DnsRecord(name='@', type='MX', value='mx', ttl=1)])
+
+            with open(path) as fp:
+                self.assertEqual('previous export\n', fp.read())
+            self.assertEqual(['example.com.zone'], os.listdir(directory))
+
+
+class ImportZoneTest(unittest.TestCase):
+
+    def test_records_proxied_remotely_stay_proxied(self):
+        text = 'www 300 A 1.1.1.1\nwww 300 AAAA ::1\napi 300 A 2.2.2.2\n'
+        record_groups = {}
+        for entry in iter_zone_records(io.StringIO(text), 'example.com'):
+            for record in parse_cloudflare_dns_record_from_config(entry):
+                record_groups.setdefault((record.name, record.type), []).append(record)
+        remote = [CloudflareDnsRecord(id='1', name='www', type='A', value='1.1.1.1', ttl=1, proxied=True),
+                  CloudflareDnsRecord(id='2', name='www', type='AAAA', value='::1', ttl=300, proxied=False)]
+
+        _keep_remote_proxied(record_groups, remote)
+
+        self.assertEqual({('www', 'A'): [True], ('www', 'AAAA'): [False], ('api', 'A'): [False]},
+                         {key: [record.proxied for record in group] for key, group in record_groups.items()})
+        # the proxied record is in sync, ttl included, cloudflare manages the ttl of proxied records
+        self.assertTrue(remote[0].equals(record_groups[('www', 'A')][0]))
+
+
+if __name__ == '__main__':
+    unittest.main()